@@ -0,0 +1,413 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Async_maestro,
+ containing the asynchronous Maestro controller client running on the
+ coroutine scheduler (event_loop.py) in Python. It is the counterpart of
+ Tel_net for coroutines:
+
+		 reply = yield client.command('m_din[7]')
+		 replies = yield client.pipeline(['m_dout[5]=1', 'm_dout[6]=0'])
+
+ Commands are not sent one prompt at a time: all commands queued by any task
+ during one pass of the event loop are written as one TCP segment (Nagle off),
+ and replies are matched to their commands in order by counting prompts, so
+ many commands are in flight at once and no task blocks the loop. Telnet option
+ negotiation is refused as telnetlib does and stripped from the replies; when
+ the connection is lost, requests made only of idempotent commands (as
+ Tel_net.idempotent) are replayed once on a new connection.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+import errno
+import select
+import socket
+import threading
+
+import wire_capture
+
+from wire_capture import WRITE, READ
+from event_loop import Lock, Readable, Return, Sleep, Writable
+from tel_net import Tel_net, Telnet_error, Telnet_timeout
+from telnetlib import IAC, DONT, DO, WONT, WILL, SB, SE
+
+class Request:
+
+	def __init__(self, task, write_strings):
+		"Initialize request object: a command burst whose replies are awaited by task."
+
+		self.task = task		# None once the task is cancelled - replies are dropped
+		self.write_strings = write_strings
+		self.replies = []
+		self.retried = False		# replayed once after a reconnect already
+
+class Async_maestro:
+
+	def __init__(self, loop, config=None, logger=None):
+		"Initialize asynchronous Maestro client object; the connection is opened by the first command."
+
+		if logger is not None:
+			self.logging = logger
+
+		self.loop = loop
+		self.address = Tel_net.maestro_address
+		self.port = Tel_net.maestro_port
+		self.timeout = 5.0
+
+		if config is not None:
+			self.address = config.get("communication","maestro_address")
+			self.port = int(config.get("communication","maestro_port"))
+			self.timeout = float(config.get("communication","telnet_timeout"))
+
+		self.sock = None
+		self.connecting = None		# task opening the connection
+		self.outgoing = []		# requests queued during this loop pass, not yet written
+		self.flusher = None		# task writing the queued requests
+		self.inflight = []		# requests written, oldest first
+		self.reader = None		# task reading replies while requests are in flight
+		self.buffer = ''
+		self.iac = ''			# incomplete telnet command at the end of the last read
+		self.sending = Lock()		# one flusher writes at a time
+
+		self.commands = 0		# statistics: commands and TCP writes
+		self.segments = 0
+
+	def connect(self):
+		"Coroutine: opens the TCP connection with Nagle's algorithm off and waits for the first prompt."
+
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.setblocking(0)
+
+		error = sock.connect_ex((self.address, self.port))
+
+		if error not in (0, errno.EINPROGRESS):
+			sock.close()
+			raise socket.error(error, "connection to Maestro %s:%i failed" % (self.address, self.port))
+
+		received = ''
+		t_end = time.time() + self.timeout
+
+		self.iac = ''
+
+		while received.find('>') < 0:
+			remaining = t_end - time.time()
+
+			if remaining <= 0 or not (yield Readable(sock.fileno(), remaining)):
+				sock.close()
+				raise Telnet_timeout("no Maestro prompt from %s:%i within %0.1f s" % (self.address, self.port, self.timeout))
+
+			try:
+				data = sock.recv(4096)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					continue
+				sock.close()
+				raise
+
+			if data == '':
+				sock.close()
+				raise Telnet_error("Maestro %s:%i closed the connection" % (self.address, self.port))
+
+			received = received + self.strip_iac(sock, data)	# banner, up to the first prompt
+
+		self.sock = sock		# anything after the banner prompt is dropped
+		self.buffer = ''
+
+		if hasattr(self, 'logging'):
+			self.logging.info("---\t-\t--> Initialized asynchronous Maestro connection to address %s:%i" % (self.address, self.port))
+
+	def strip_iac(self, sock, data):
+		"""Returns data without telnet commands; option requests are refused on sock as
+		telnetlib does (DO -> WONT, WILL -> DONT) and an incomplete command is kept for the
+		next read."""
+
+		data = self.iac + data
+		self.iac = ''
+		text = []
+		answers = []
+		i = 0
+
+		while i < len(data):
+			j = data.find(IAC, i)
+
+			if j < 0:
+				text.append(data[i:])
+				break
+
+			text.append(data[i:j])
+
+			if j + 1 >= len(data):
+				self.iac = data[j:]
+				break
+
+			command = data[j + 1]
+
+			if command == IAC:			# escaped 0xff data byte
+				text.append(IAC)
+				i = j + 2
+			elif command in (DO, DONT, WILL, WONT):
+				if j + 2 >= len(data):
+					self.iac = data[j:]
+					break
+
+				if command == DO:
+					answers.append(IAC + WONT + data[j + 2])
+				elif command == WILL:
+					answers.append(IAC + DONT + data[j + 2])
+				i = j + 3
+			elif command == SB:			# subnegotiation, up to IAC SE
+				k = data.find(IAC + SE, j + 2)
+
+				if k < 0:
+					self.iac = data[j:]
+					break
+				i = k + 2
+			else:					# NOP, GA and other two-byte commands
+				i = j + 2
+
+		if answers:
+			try:
+				sock.send(''.join(answers))	# a few bytes, fits the empty send buffer
+			except socket.error:
+				pass				# a dead connection shows on the next read
+
+		return ''.join(text)
+
+	def ensure_connected(self):
+		"Coroutine: opens the connection unless open; concurrent callers wait for the same attempt."
+
+		while self.sock is None:
+			if self.connecting is None or self.connecting.done:
+				self.connecting = self.loop.spawn(self.connect(), 'maestro connect')
+
+			yield self.connecting
+
+	def pipeline(self, write_strings):
+		"""Coroutine: queues a command burst and returns the list of replies. The burst is
+		written with all other commands queued in the same loop pass, in order of queueing
+		(queued before any wait, so callers may rely on it); if any reply reports an error,
+		raises Telnet_error naming each failed command."""
+
+		if not write_strings:
+			raise Return([])
+
+		task = yield None			# current task is sent back by the loop
+		request = Request(task, list(write_strings))
+		self.outgoing.append(request)
+		self.commands += len(write_strings)
+
+		if self.flusher is None:
+			self.flusher = self.loop.spawn(self.flush(), 'maestro flush')
+
+		try:
+			replies = yield Sleep(None)	# woken by read_replies() with the replies (or an error)
+		except:
+			request.task = None
+			raise
+
+		errors = []
+
+		for write_string, reply in zip(request.write_strings, replies):
+			if Tel_net.error_pattern.search(reply.replace(write_string, '', 1)):	# ignore command echo
+				errors.append("%r -> %r" % (write_string, reply.strip()))
+
+		if errors:
+			raise Telnet_error("%i of %i pipelined commands failed: %s" % (len(errors), len(request.write_strings), ', '.join(errors)))
+		raise Return(replies)
+
+	def command(self, write_string):
+		"Coroutine: writes one command and returns its reply, as Tel_net.parse_read_string()."
+
+		replies = yield self.pipeline([write_string])
+		raise Return(replies[0])
+
+	def flush(self):
+		"""Coroutine: after the current loop pass, connects if needed and writes all queued
+		requests as one segment."""
+
+		yield Sleep(0)				# let the other ready tasks queue their commands first
+		yield self.sending.acquire()		# an earlier burst may still be waiting to be written
+
+		try:
+			try:
+				yield self.ensure_connected()
+			except Exception, e:
+				requests = self.outgoing
+				self.outgoing = []
+				self.flusher = None
+				self.fail(requests, e)
+				return
+
+			requests = self.outgoing
+			self.outgoing = []
+			self.flusher = None
+
+			if not requests:		# taken by the flusher that held the lock
+				return
+
+			burst = ''.join([''.join([write_string + '\r' for write_string in request.write_strings]) for request in requests])
+			capture = wire_capture.current
+
+			if capture is not None:
+				capture.record('telnet', WRITE, burst)
+
+			self.inflight.extend(requests)
+			sock = self.sock
+			sent = 0
+			t_end = time.time() + self.timeout
+
+			try:
+				while sent < len(burst):
+					try:
+						sent = sent + sock.send(burst[sent:])
+						continue
+					except socket.error, e:
+						if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+							raise
+
+					remaining = t_end - time.time()
+
+					if remaining <= 0 or not (yield Writable(sock.fileno(), remaining)):
+						raise Telnet_timeout("Maestro took no data within %0.1f s, %i of %i bytes written" % (self.timeout, sent, len(burst)))
+
+					if self.sock is not sock:	# lost meanwhile - requests already failed
+						return
+			except (Telnet_timeout, socket.error), e:
+				if self.sock is sock:
+					self.disconnect(e)
+				return
+
+			self.segments += 1
+
+			if self.reader is None:
+				self.reader = self.loop.spawn(self.read_replies(), 'maestro reader')
+		finally:
+			self.sending.release()
+
+	def read_replies(self):
+		"Coroutine: reads replies while requests are in flight, waking each request when complete."
+
+		try:
+			while self.inflight and self.sock is not None:
+				try:
+					ready = yield Readable(self.sock.fileno(), self.timeout)
+				except select.error:
+					continue		# socket closed and reopened meanwhile - read the new one
+
+				if not ready:
+					self.disconnect(Telnet_timeout("no reply from Maestro within %0.1f s, %i requests in flight" % (self.timeout, len(self.inflight))))
+					return
+
+				try:
+					data = self.sock.recv(4096)
+				except socket.error, e:
+					if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+						continue
+					self.disconnect(e)
+					return
+
+				if data == '':
+					self.disconnect(Telnet_error("Maestro closed the connection"))
+					return
+
+				capture = wire_capture.current
+
+				if capture is not None:
+					capture.record('telnet', READ, data)
+
+				self.buffer = self.buffer + self.strip_iac(self.sock, data)
+
+				while self.inflight and self.buffer.find('>') >= 0:
+					reply, self.buffer = self.buffer.split('>', 1)
+					request = self.inflight[0]
+					request.replies.append(reply + '>')
+
+					if len(request.replies) == len(request.write_strings):
+						self.inflight.pop(0)
+
+						if request.task is not None:
+							self.loop.wake(request.task, request.replies)
+		finally:
+			self.reader = None
+
+	def fail(self, requests, exception):
+		"Wakes the tasks of given requests with exception."
+
+		for request in requests:
+			if request.task is not None:
+				self.loop.wake(request.task, exception=exception)
+
+	def disconnect(self, exception):
+		"""Closes the connection; requests in flight made only of idempotent commands are
+		queued again for one replay on a new connection, the others fail."""
+
+		if hasattr(self, 'logging'):
+			self.logging.warn("---\t-\t--> Asynchronous Maestro connection lost: %s" % exception)
+
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+		self.buffer = ''
+		self.iac = ''
+		replay = []
+		failed = []
+
+		for request in self.inflight:
+			if request.task is None:
+				continue			# cancelled - nobody waits for the replies
+			elif request.retried or [w for w in request.write_strings if not Tel_net.idempotent.match(w)]:
+				failed.append(request)
+			else:
+				request.retried = True
+				request.replies = []
+				replay.append(request)
+
+		self.inflight = []
+		self.fail(failed, Telnet_error("%s" % exception))
+
+		if replay:
+			if hasattr(self, 'logging'):
+				self.logging.warn("---\t-\t--> Replaying %i idempotent Maestro requests on a new connection" % len(replay))
+
+			self.outgoing = replay + self.outgoing
+
+			if self.flusher is None:
+				self.flusher = self.loop.spawn(self.flush(), 'maestro flush')
+
+	def close(self):
+		"Closes the connection."
+
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE CLIENT				       #
+#--------------------------------------------------------------------------------------#
+#
+# One client per event loop, so the mux latches of the thermal service and the status
+# LED writes of one loop pass share a TCP segment.
+#
+
+clients = {}		# event loop -> client
+clients_lock = threading.Lock()
+
+def get_async_maestro(loop, config=None, logger=None):
+	"Returns the asynchronous Maestro client of given event loop, creating it on first use."
+
+	clients_lock.acquire()
+
+	try:
+		if not clients.has_key(loop):
+			clients[loop] = Async_maestro(loop, config, logger)
+		return clients[loop]
+	finally:
+		clients_lock.release()
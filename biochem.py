@@ -25,11 +25,16 @@ from logger import Logger  # Import logger class.
 from threading import Thread  # Import threading class.
 
 from mux import Mux  # Import mux class.
+from command_queue import Command_queue  # Import device command queue class.
 from serial_port import Serial_port  # Import serial port class.
 
 from syringe_pump import Syringe_pump  # Import syringe_pump class. 
 from rotary_valve import Rotary_valve  # Import rotary valve class. 
 from temperature_control import Temperature_control  # Import temperature controller class.
+from poller import Poller  # Import adaptive temperature polling class.
+from thermal_model import get_model  # Import flowcell thermal model registry.
+import thermal_service  # Import process-wide thermal scheduler.
+from ramp_soak import Ramp_soak  # Import controller ramp/soak program class.
 
 class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance]
 
@@ -48,12 +53,16 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		self.logging = logger  # initialize logger object
 		Thread.__init__(self)  # instantiate thread
 
-		self.mux = Mux(self.logging)  # create mux
 		self.ser = Serial_port(self.config, self.logging)  # place serial port into Biochem
+		self.mux = Mux(self.logging, self.ser, self.config)  # create mux
+		self.mux.reset_discrete()  # discrete valves and mixer off at the start of each cycle
 
 		self.rotary_valve = Rotary_valve(self.config, self.ser, self.logging)  # create rotary valve
 		self.syringe_pump = Syringe_pump(self.config, self.ser, self.logging)  # create syringe pump
 		self.temperature_control = Temperature_control(self.config, self.ser, self.logging)  # create flowcell heater/cooler
+		self.temperature_control.invalidate_all()  # controller state is read back fresh each cycle
+		self.poller = Poller(self.read_temperature, self.config)  # adaptive temperature polling
+		self.queue = Command_queue(self.config, self.mux, self.ser, self.rotary_valve, self.logging)  # create device command scheduler
 
 		self.get_config_parameters()  # retrieve all configuatrion parameters from file
 		self.logging.info("%s\t%i\t--> Biochemistry object is constructed: [%s]" % (self.cycle_name, self.flowcell, self.state))
@@ -129,6 +138,7 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		self.back_gap = int(self.config.get("biochem_parameters","back_gap"))
 
 		self.time_limit = int(self.config.get("biochem_parameters","time_limit"))
+		self.use_thermal_model = int(self.config.get("thermal_model","use_model"))
 		self.mixer_iter = int(self.config.get("biochem_parameters","mixer_iter"))
 		self.syringe_iter = int(self.config.get("biochem_parameters","syringe_iter"))
 		self.slow_push_volume = int(self.config.get("biochem_parameters","slow_push_volume"))
@@ -200,6 +210,7 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 
 		self.mix_time = int(self.config.get("lig_parameters","mix_time"))
 		self.lig_extra = int(self.config.get("lig_parameters","lig_extra"))
+		self.use_ramp_soak = int(self.config.get("lig_parameters","ramp_soak"))
 
 		#------------------------- Cycle constants -------------------------------------
 
@@ -228,20 +239,14 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		self.logging.info("%s\t%i\t--> Clean V to V4 [%s]" % (self.cycle_name, self.flowcell, self.state))
 
 		if(rotary_valve == 'V1'):
-			self.mux.set_to_rotary_valve1()  #RCT switch communication to ten port rotary valve V1
-			self.rotary_valve.set_valve_position(9)  #RCT set rotary valve to position 9
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(1)  #RCT set rotary valve to position 1
+			self.queue.set_valve_position('V1', 9)  # queue rotary valve V1 to port 9
+			self.queue.set_valve_position('V4', 1)  # queue rotary valve V4 to port 1
 		elif(rotary_valve == 'V2'):
-			self.mux.set_to_rotary_valve2()  #RCT switch communication to ten port rotary valve V1
-			self.rotary_valve.set_valve_position(9)  #RCT set rotary valve to position 9
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(2) #RCT set rotary valve to position 2
+			self.queue.set_valve_position('V2', 9)  # queue rotary valve V2 to port 9
+			self.queue.set_valve_position('V4', 2)  # queue rotary valve V4 to port 2
 		elif(rotary_valve == 'V3'):
-			self.mux.set_to_rotary_valve3()  #RCT switch communication to ten port rotary valve V1
-			self.rotary_valve.set_valve_position(9)  #RCT set rotary valve to position 9
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(3)  #RCT set rotary valve to position 3
+			self.queue.set_valve_position('V3', 9)  # queue rotary valve V3 to port 9
+			self.queue.set_valve_position('V4', 3)  # queue rotary valve V4 to port 3
 
 		self.logging.info("%s\t%i\t--> Draw %i ul Wash 1 up to V4" % (self.cycle_name, self.flowcell, self.V_to_V4, 1))
 		self.move_reagent(self.V_to_V4, self.pull_speed, 1, self.empty_speed, 3)  #RCT draw wash up to syringe pump port 1 and eject tube content to waste
@@ -259,16 +264,16 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		else:
 			from_port = 2  #RCT3 # set syringe pump port variable to 3
 
-		self.mux.set_to_rotary_valve4()  # switch communication to ten port rotary valve V3
-		self.rotary_valve.set_valve_position(V4_port) # switch rotary valve V3 to designated port
+		self.queue.set_valve_position('V4', V4_port)  # queue rotary valve V4 to port V4_port
 
 		self.logging.info("%s\t%i\t--> Flush flowcells 3-times (%i ul) and eject to waste" % (self.cycle_name, self.flowcell, flowcell_wash))
 		self.move_reagent(self.FC_wash, self.fast_speed, from_port, self.empty_speed, 3)  #RCT flush flowcells 3-times and eject to waste
 
 #------------------------------- Draw reagent into flowcell ----------------------------
 
-	def draw_into_flowcell(self, draw_port, rotary_valve, rotary_port, reagent_volume):
-		"Draws reagent into flowcell."
+	def draw_into_flowcell(self, draw_port, rotary_valve, rotary_port, reagent_volume, ramp=None):
+		"""Draws reagent into flowcell. A ramp started by start_ramp() is joined once the
+		reagent is drawn into the system, before it enters the flowcell."""
 		
 		self.logging.info("%s\t%i\t--> Draw reagent into flowcell %i: [%s]" % (self.cycle_name, self.flowcell, self.flowcell, self.state))
 
@@ -284,7 +289,11 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 			FC_draw = self.V_to_FC_end	
 
 		self.draw_reagent(rotary_valve, rotary_port, reagent_volume)
-		self.rotary_valve.set_valve_position(draw_port)
+
+		if ramp is not None:
+			self.join_ramp(ramp)  # flowcell must be at temperature before the reagent enters it
+
+		self.queue.set_valve_position('V4', draw_port)  # queue rotary valve V4 to port draw_port
 		self.logging.info("%s\t%i\t--> Do iterative flushes (%i ul) and eject to waste" % (self.cycle_name, self.flowcell, FC_draw))
 		self.move_reagent_slow(FC_draw, self.pull_speed, from_port, self.empty_speed, 3)  #RCT do iterative flushes with last 200 ul stroke at slow syringe speed and eject to waste
 
@@ -295,8 +304,11 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		position [3], then transfers syringe content through valve position [4] into an other
 		location in the fluidic system. All parameters are integers respectively."""
 
-		if fill_volume != 0:
-			self.mux.set_to_syringe_pump()  # switch communication to nine port syringe pump
+		if fill_volume == 0:
+			self.queue.flush()  # no fluid moves, but the valve moves of the step are sent
+
+		else:
+			self.queue.select('syringe_pump')  # switch communication to nine port syringe pump
 
 			if fill_volume <= self.full_stroke:
 
@@ -341,8 +353,11 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		slower speed to avoid air bubble build up in the chambers. All parameters are integers 
 		respectively."""
 
-		if fill_volume != 0:
-			self.mux.set_to_syringe_pump()  # switch communication to nine port syringe pump
+		if fill_volume == 0:
+			self.queue.flush()  # no fluid moves, but the valve moves of the step are sent
+
+		else:
+			self.queue.select('syringe_pump')  # switch communication to nine port syringe pump
 
 			if fill_volume <= self.full_stroke:
 
@@ -430,29 +445,22 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 
 		if valve == 'V1':
 
-			self.mux.set_to_rotary_valve1()  # switch communication to ten port rotary valve V1
-			self.rotary_valve.set_valve_position(10)
-			self.mux.set_to_rotary_valve4()  # switch communication to ten port rotary valve V4 
-			self.rotary_valve.set_valve_position(1)
+			self.queue.set_valve_position('V1', 10)  # queue rotary valve V1 to port 10
+			self.queue.set_valve_position('V4', 1)  # queue rotary valve V4 to port 1
 
 		elif valve == 'V2':
 
-			self.mux.set_to_rotary_valve2()  # switch communication to ten port rotary valve V2
-			self.rotary_valve.set_valve_position(10)  # switch rotary valve V2 to port 10
-			self.mux.set_to_rotary_valve4()  # switch communication to ten port rotary valve V4 
-			self.rotary_valve.set_valve_position(2)
+			self.queue.set_valve_position('V2', 10)  # queue rotary valve V2 to port 10
+			self.queue.set_valve_position('V4', 2)  # queue rotary valve V4 to port 2
 
 		elif valve == 'V3':
 
-			self.mux.set_to_rotary_valve3()  # switch communication to ten port rotary valve V3
-			self.rotary_valve.set_valve_position(10)  # switch rotary valve V3 to port 10
-			self.mux.set_to_rotary_valve4()  # switch communication to ten port rotary valve V4 
-			self.rotary_valve.set_valve_position(3)
+			self.queue.set_valve_position('V3', 10)  # queue rotary valve V3 to port 10
+			self.queue.set_valve_position('V4', 3)  # queue rotary valve V4 to port 3
 
 		elif valve == 'V4':
 
-			self.mux.set_to_rotary_valve4()  # switch communication to ten port rotary valve V2
-			self.rotary_valve.set_valve_position(10)  # switch rotary valve V2 to port 10
+			self.queue.set_valve_position('V4', 10)  # queue rotary valve V4 to port 10
 
 		if self.flowcell == 0:
 			from_port = 1 # set syringe pump port variable to 1
@@ -477,23 +485,157 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 
 		self.temperature_control.set_temperature(self.room_temp)  # set temperature controller to 30 C
 
-		t0 = time.time()  # get current time
-		tc = self.temperature_control.get_temperature()  # get current flowcell temperature
+		self.poller.wait_until(self.room_temp, 2, self.time_limit * 60, self.show_temperature)
+		print '\n'
 
-		while abs(self.room_temp - tc) > 2:
+#------------------------- Temperature ramping -----------------------------------------
 
-			tc = self.temperature_control.get_temperature()
-			delta = time.time() - t0 # elapsed time in seconds
+	def ramp_temperature(self, target, set_temp, poll_temp):
+		"""Ramps flowcell temperature toward target and waits for the poll temperature. Once
+		the thermal model of the controller is fitted, it chooses the overshoot setpoint and
+		poll temperature, and the setpoint is set back to target when the poll temperature
+		is reached; until then the configured set_temp/poll_temp pair is used. The samples
+		of every ramp refine the model."""
 
-			sys.stdout.write("TIME\t ---\t-\t--> Elapsed time: %i s and current temperature: %0.2f C\r" % (int(delta), tc))
-			sys.stdout.flush()
+		model = get_model('temperature_control%i' % (self.flowcell + 1), self.config)
+		tc = self.read_temperature()  # get current flowcell temperature
+		plan = None
+
+		if self.use_thermal_model:
+			plan = model.choose(tc, target, self.temp_tolerance)
+
+		if plan is not None:
+			self.logging.info("%s\t%i\t--> Thermal model: set %0.1f C, poll %0.1f C, predicted %0.0f s to %i C (configured %i/%i C): [%s]" %
+					  (self.cycle_name, self.flowcell, plan[0], plan[1], plan[2] or 0, target, set_temp, poll_temp, self.state))
+			set_temp, poll_temp = plan[0], plan[1]
+
+		t_set = time.time()
+		self.temperature_control.set_temperature(set_temp)
+
+		try:
+			if plan is not None:
+				self.wait_for_SS(set_temp, poll_temp, 0.1)  # set back to target right at the poll temperature
+			else:
+				self.wait_for_SS(set_temp, poll_temp, self.temp_tolerance)  # wait until poll temperature is reached
+
+			samples = self.poller.samples
+			service = thermal_service.current
+
+			if service is not None:  # telemetry holds the samples of the whole ramp
+				samples = service.samples('temperature_control%i' % (self.flowcell + 1), t_set)
+
+			if model.fit(tc, set_temp, t_set, samples) is not None:
+				self.logging.info("%s\t%i\t--> Thermal model %s: [%s]" % (self.cycle_name, self.flowcell, model.describe(), self.state))
+		finally:
+			if plan is not None:
+				self.temperature_control.set_temperature(target)  # hold at target, also if the wait failed - never park at the overshoot setpoint
+
+	def start_ramp(self, target, set_temp, poll_temp):
+		"""Starts ramping flowcell temperature toward target without waiting, so fluidics
+		can run during the ramp; join_ramp() waits for it before the step that needs the
+		temperature. Nobody watches the temperature until then, so the setpoint is target
+		itself (no overshoot). Returns the ramp for join_ramp(); the mux is left on the
+		channel the fluidics were using."""
+
+		channel = self.mux.channel  # fluidics device the next commands go to
+
+		try:
+			if self.flowcell == 0:
+				self.mux.set_to_temperature_control1()  # set to temperature controller 1
+			else:
+				self.mux.set_to_temperature_control2()  # set to temperature controller 2
+
+			tc = self.read_temperature()  # get current flowcell temperature
+			t_set = time.time()
+			self.temperature_control.set_temperature(target)
+		finally:
+			if channel is not None:
+				self.mux.select(channel)  # back to the fluidics device
+
+		self.logging.info("%s\t%i\t--> Start ramp from %0.2f C to %i C ahead of fluidics: [%s]" % (self.cycle_name, self.flowcell, tc, target, self.state))
+		return (target, set_temp, poll_temp, tc, t_set)
+
+	def join_ramp(self, ramp):
+		"""Waits for a ramp started by start_ramp(): returns at once if the flowcell reached
+		the target meanwhile, else finishes it as ramp_temperature() does from the current
+		temperature. Telemetry samples taken during the fluidics refine the thermal model.
+		The mux is left on the channel the fluidics were using."""
+
+		target, set_temp, poll_temp, t0, t_set = ramp
+		channel = self.mux.channel  # fluidics device the next commands go to
+
+		try:
+			if self.flowcell == 0:
+				self.mux.set_to_temperature_control1()  # set to temperature controller 1
+			else:
+				self.mux.set_to_temperature_control2()  # set to temperature controller 2
+
+			service = thermal_service.current
+
+			if service is not None:
+				model = get_model('temperature_control%i' % (self.flowcell + 1), self.config)
+
+				if model.fit(t0, target, t_set, service.samples('temperature_control%i' % (self.flowcell + 1), t_set)) is not None:
+					self.logging.info("%s\t%i\t--> Thermal model %s: [%s]" % (self.cycle_name, self.flowcell, model.describe(), self.state))
+
+			tc = self.read_temperature()  # get current flowcell temperature
+
+			if abs(target - tc) <= self.temp_tolerance:
+				self.logging.info("%s\t%i\t--> Reached %0.2f C during fluidics, %0.2f minutes after ramp start: [%s]" % (self.cycle_name, self.flowcell, tc, (time.time() - t_set) / 60, self.state))
+				return
+
+			self.ramp_temperature(target, set_temp, poll_temp)
+		finally:
+			if channel is not None:
+				self.mux.select(channel)  # back to the fluidics device
+
+	def run_ramp_soak(self, steps):
+		"""Runs ramp/soak steps [(target, set temperature, poll temperature, soak minutes)]
+		as one program of the flowcell controller (see ramp_soak.py) and monitors it until
+		done; the Biochem thread takes no serial transactions meanwhile."""
+
+		self.queue.flush()  # the program thread must not run this thread's queued commands
+		channel = self.mux.channel  # fluidics device the next commands go to
+		program = Ramp_soak('temperature_control%i' % (self.flowcell + 1), steps, self.config, self.ser, self.mux, self.logging)
+		program.start()
+
+		t0 = time.time()  # get current time
+		step = None
+
+		try:
+			while not program.wait(1):
+				if (program.step, program.phase) != step:
+					step = (program.step, program.phase)
+					target, set_temp, poll_temp, soak = steps[program.step]
+					self.logging.info("%s\t%i\t--> Ramp/soak step %i of %i: %s at %i C: [%s]" % (self.cycle_name, self.flowcell, program.step + 1, len(steps), program.phase, target, self.state))
+
+				sys.stdout.write('TIME\t ---\t-\t--> Elapsed time: %i s\r' % int(time.time() - t0))
+				sys.stdout.flush()
+		finally:
+			if channel is not None:
+				self.mux.select(channel)  # back to the fluidics device
 
-			if delta > self.time_limit * 60:
-				break
 		print '\n'
+		self.logging.info("%s\t%i\t--> Ramp/soak program done in %0.2f minutes, %i temperature reads: [%s]" % (self.cycle_name, self.flowcell, (time.time() - t0) / 60, program.reads, self.state))
 
 #------------------------- Steady-state temperature waiting ----------------------------
 
+	def read_temperature(self):
+		"Returns current flowcell temperature: from the thermal service if it runs, else read from the controller."
+
+		service = thermal_service.current
+
+		if service is not None:
+			return service.read('temperature_control%i' % (self.flowcell + 1))
+
+		return self.temperature_control.get_temperature()
+
+	def show_temperature(self, delta, tc):
+		"Shows elapsed time and current temperature while waiting for a temperature."
+
+		sys.stdout.write("TIME\t ---\t-\t--> Elapsed time: %i s and current temperature: %0.2f C\r" % (int(delta), tc))
+		sys.stdout.flush()
+
 	def wait_for_SS(self, set_temp, poll_temp, tolerance=None):
 		"""Waits until steady-state temperature is reached, or exits wait block if ramping
 		time exceeds timeout parameter set in configuration file."""
@@ -504,36 +646,18 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 			tolerance = 1
 
 		t0 = time.time()  # get current time
-		tc = self.temperature_control.get_temperature() # get current flowcell temperature
-
-		if set_temp - poll_temp >= 0:  # if ramping up
-			if poll_temp >= tc:
-				while abs(poll_temp - tc) > tolerance:
-
-					tc = self.temperature_control.get_temperature()
-					time.sleep(1)
-
-					delta = time.time() - t0 # elapsed time in seconds
-					sys.stdout.write("TIME\t ---\t-\t--> Elapsed time: %i s and current temperature: %0.2f C\r" % (int(delta), tc))
-					sys.stdout.flush()
-                         
-					if delta > self.time_limit * 60:
-						self.logging.warn("%s\t%i\t --> Time limit %s exceeded -> [current: %0.2f, target: %0.2f] C: [%s]" % (self.cycle_name, self.flowcell, self.time_limit, tc, poll_temp, self.state))
-						break
-		else:  # if ramping down
-			if poll_temp <= tc:
-				while abs(poll_temp - tc) > tolerance:
-
-					tc = self.temperature_control.get_temperature()
-					time.sleep(1)
-
-					delta = time.time() - t0 # elapsed time in seconds
-					sys.stdout.write("TIME\t ---\t-\t--> Elapsed time: %i s and current temperature: %0.2f C\r" % (int(delta), tc))
-					sys.stdout.flush()
-                         
-					if delta > self.time_limit * 60:
-						self.logging.warn("%s\t%i\t --> Time limit %s exceeded -> [current: %0.2f, target: %0.2f] C: [%s]" % (self.cycle_name, self.flowcell, self.time_limit, tc, poll_temp, self.state))
-						break		
+		tc = self.read_temperature() # get current flowcell temperature
+
+		if (set_temp - poll_temp >= 0 and poll_temp >= tc) or (set_temp - poll_temp < 0 and poll_temp <= tc):  # poll temperature still ahead of the ramp
+			service = thermal_service.current
+
+			if service is not None:  # reached-target event of the thermal service
+				tc, reached = service.wait_until('temperature_control%i' % (self.flowcell + 1), poll_temp, tolerance, self.time_limit * 60, self.show_temperature)
+			else:
+				tc, reached = self.poller.wait_until(poll_temp, tolerance, self.time_limit * 60, self.show_temperature)
+
+			if not reached:
+				self.logging.warn("%s\t%i\t --> Time limit %s exceeded -> [current: %0.2f, target: %0.2f] C: [%s]" % (self.cycle_name, self.flowcell, self.time_limit, tc, poll_temp, self.state))
 		print '\n'
 		elapsed = (time.time() - t0) / 60
 
@@ -565,26 +689,19 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		#RCTnonamer_port = self.port_scheme[self.cycle][2]  # get nonamer port on rotary valve V1/2 from configuration schematics
 
 		if rotary_valve == 'V1':
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(1)
-			self.mux.set_to_rotary_valve1()  #RCT switch communication to ten port rotary valve V1
-			self.rotary_valve.set_valve_position(rotary_port)
+			self.queue.set_valve_position('V4', 1)  # queue rotary valve V4 to port 1
+			self.queue.set_valve_position('V1', rotary_port)  # queue rotary valve V1 to port rotary_port
 
 		elif rotary_valve == 'V2':
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(2)
-			self.mux.set_to_rotary_valve2()  #RCT switch communication to ten port rotary valve V2
-			self.rotary_valve.set_valve_position(rotary_port)
+			self.queue.set_valve_position('V4', 2)  # queue rotary valve V4 to port 2
+			self.queue.set_valve_position('V2', rotary_port)  # queue rotary valve V2 to port rotary_port
 
 		elif rotary_valve == 'V3':
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(3)
-			self.mux.set_to_rotary_valve3()  #RCT switch communication to ten port rotary valve V3
-			self.rotary_valve.set_valve_position(rotary_port)
+			self.queue.set_valve_position('V4', 3)  # queue rotary valve V4 to port 3
+			self.queue.set_valve_position('V3', rotary_port)  # queue rotary valve V3 to port rotary_port
 
 		elif rotary_valve == 'V4':
-			self.mux.set_to_rotary_valve4()  #RCT switch communication to ten port rotary valve V4
-			self.rotary_valve.set_valve_position(rotary_port)
+			self.queue.set_valve_position('V4', rotary_port)  # queue rotary valve V4 to port rotary_port
 
 		self.draw_air_to_valve(rotary_valve)
 		self.move_reagent(reagent_volume, self.slow_speed, self.flowcell+1, self.empty_speed, 3)  #RCT pull reagent volume
@@ -977,6 +1094,8 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		delta = (time.time() - t0) / 60	# calculate elapsed time for stripping
 
 		self.logging.warn("%s\t%i\t--> Finished checmical strip - duration: %0.2f minutes\n" % (self.cycle_name, self.flowcell, delta))
+		self.queue.flush()  # no valve move of this step is left unsent
+		self.queue.report(self.state)  # log mux/baud switches saved by the command queue
 
 #-------------------------------------- Hyb sub. ---------------------------------------
 
@@ -1008,15 +1127,9 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		primer_valve = self.port_scheme[self.cycle][0]  # get anchor primer rotary valve from configuration schematics
 		primer_port = self.port_scheme[self.cycle][1]  # get anchor primer port on rotary valve from configuration schematics
 
-		if self.flowcell == 0:
-			self.mux.set_to_temperature_control1()  # set to temperature controller 1
-		else:
-			self.mux.set_to_temperature_control2()  # set to temperature controller 2
-
-		self.temperature_control.set_temperature(self.hyb_set_temp1)  # set flowcell temperature to 52 C
-		self.wait_for_SS(self.hyb_set_temp1, self.hyb_poll_temp1, self.temp_tolerance)  # wait until steady-state temperature is reached
+		ramp = self.start_ramp(self.hyb_temp1, self.hyb_set_temp1, self.hyb_poll_temp1)  # ramp flowcell temperature to 52 C while primer is drawn
 		self.logging.info("%s\t%i\t--> Draw %i ul anchor primer (Ai) into system from rotary valve" % (self.cycle_name, self.flowcell, self.primer_volume))
-		self.draw_into_flowcell(9, primer_valve, primer_port, self.primer_volume + self.primer_extra)  #RCT push anchor primer into flowcell with Wash
+		self.draw_into_flowcell(9, primer_valve, primer_port, self.primer_volume + self.primer_extra, ramp)  #RCT push anchor primer into flowcell with Wash
 		self.incubate_reagent(self.hyb_time1)  # incubate reagent for 2 min
 
 		if self.flowcell == 0:
@@ -1024,8 +1137,7 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		else:
 			self.mux.set_to_temperature_control2()  # set to temperature controller 2
 
-		self.temperature_control.set_temperature(self.hyb_set_temp2)  # set flowcell temperature to 42 C
-		self.wait_for_SS(self.hyb_set_temp2, self.hyb_poll_temp2, self.temp_tolerance)  # wait until steady-state temperature is reached
+		self.ramp_temperature(self.hyb_temp2, self.hyb_set_temp2, self.hyb_poll_temp2)  # ramp flowcell temperature to 42 C
 		self.incubate_reagent(self.hyb_time2)  # incubate reagent for 2 min
 
 		if self.flowcell == 0:
@@ -1041,6 +1153,8 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		delta = (time.time() - t0) / 60	# calculate elapsed time for primer hybridization
 
 		self.logging.warn("%s\t%i\t--> Finished primer hybridization - duration: %0.2f minutes\n" % (self.cycle_name, self.flowcell, delta))
+		self.queue.flush()  # no valve move of this step is left unsent
+		self.queue.report(self.state)  # log mux/baud switches saved by the command queue
 
 #-------------------------------- Lig_stepup_peg sub. ----------------------------------
 
@@ -1079,11 +1193,10 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		nonamer_valve = self.port_scheme[self.cycle][2]  # get nonamer rotary valve from configuration schematics
 		nonamer_port = self.port_scheme[self.cycle][3]  # get nonamer port on rotary valve from configuration schematics
 
-	def draw_into_flowcell(self, draw_port, rotary_valve, rotary_port, reagent_volume):
-	def draw_reagent(self, rotary_valve, rotary_port, reagent_volume):
-
 		self.draw_reagent(nonamer_valve, 8, self.buffer_volume)  #RCT pull up ligation buffer
 		self.draw_into_flowcell(9, nonamer_valve, nonamer_port, self.nonamer_volume + self.nonamer_extra)  #RCT push anchor primer into flowcell with
+		ramp = self.start_ramp(self.lig_step1, self.lig_set_step1, self.lig_poll_step1)  # ramp flowcell temperature to 18 C while ligase-nonamer mix is prepared
+
 		b_volume = self.V4_to_syringe + self.i_volumes['V4']['LIGATION BUFFER']
 		self.logging.info("%s\t%i\t--> Draw ligase buffer up to syringe port 7 with %i ul" % (self.cycle_name, self.flowcell, b_volume))
 		self.move_reagent(b_volume, self.slow_speed, 7, self.empty_speed, 4) # draw ligase buffer up to syringe port 7
@@ -1111,42 +1224,39 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		self.logging.info("%s\t%i\t--> Draw %i ul ligase-nonamer mix just passed discrete valve V5" % (self.cycle_name, self.flowcell, self.mixer_to_V5 + self.back_gap))
 		self.move_reagent(self.mixer_to_V5 + self.back_gap, self.pull_speed, from_port, self.empty_speed, 4) # draw ligase-nonamer mix just passed V5
 
-		if self.flowcell == 0:
-			self.mux.set_to_temperature_control1()  # set to temperature controller 1
-		else:
-			self.mux.set_to_temperature_control2()  # set to temperature controller 2
-
-		self.temperature_control.set_temperature(self.lig_set_step1)  # set flowcell temperature to 18 C
-		self.wait_for_SS(self.lig_set_step1, self.lig_poll_step1, self.temp_tolerance)  # wait until steady-state temperature is reached
-		self.draw_into_flowcell(self.FC_draw + self.lig_extra, 2)  # draw reagent into flowcell with "Wash 1"
-		self.incubate_reagent(self.lig_time1)  # incubate reagent for 5 min
+		self.draw_into_flowcell(9, 'V3', 8, self.FC_draw + self.lig_extra, ramp=ramp)  # draw reagent into flowcell with "Wash 1" (V3-8), at 18 C before the mix enters it
 
-		if self.flowcell == 0:
-			self.mux.set_to_temperature_control1()  # set to temperature controller 1
+		if self.use_ramp_soak:
+			self.run_ramp_soak([(self.lig_step1, self.lig_set_step1, self.lig_poll_step1, self.lig_time1),  # ramp to and incubate at each ligation step
+					    (self.lig_step2, self.lig_set_step2, self.lig_poll_step2, self.lig_time2),
+					    (self.lig_step3, self.lig_set_step3, self.lig_poll_step3, self.lig_time3),
+					    (self.lig_step4, self.lig_set_step4, self.lig_poll_step4, self.lig_time4)])
 		else:
-			self.mux.set_to_temperature_control2()  # set to temperature controller 2
+			self.incubate_reagent(self.lig_time1)  # incubate reagent for 5 min
 
-		self.temperature_control.set_temperature(self.lig_set_step2)  # set flowcell temperature to 25 C
-		self.wait_for_SS(self.lig_set_step2, self.lig_poll_step2, self.temp_tolerance)  # wait until steady-state temperature is reached
-		self.incubate_reagent(self.lig_time2)  # incubate reagent for 5 min
+			if self.flowcell == 0:
+				self.mux.set_to_temperature_control1()  # set to temperature controller 1
+			else:
+				self.mux.set_to_temperature_control2()  # set to temperature controller 2
 
-		if self.flowcell == 0:
-			self.mux.set_to_temperature_control1()  # set to temperature controller 1
-		else:
-			self.mux.set_to_temperature_control2()  # set to temperature controller 2
+			self.ramp_temperature(self.lig_step2, self.lig_set_step2, self.lig_poll_step2)  # ramp flowcell temperature to 25 C
+			self.incubate_reagent(self.lig_time2)  # incubate reagent for 5 min
 
-		self.temperature_control.set_temperature(self.lig_set_step3)  # set flowcell temperature to 30 C
-		self.wait_for_SS(self.lig_set_step3, self.lig_poll_step3, self.temp_tolerance)  # wait until steady-state temperature is reached
-		self.incubate_reagent(self.lig_time3)  # incubate reagent for 5 min
+			if self.flowcell == 0:
+				self.mux.set_to_temperature_control1()  # set to temperature controller 1
+			else:
+				self.mux.set_to_temperature_control2()  # set to temperature controller 2
 
-		if self.flowcell == 0:
-			self.mux.set_to_temperature_control1()  # set to temperature controller 1
-		else:
-			self.mux.set_to_temperature_control2()  # set to temperature controller 2
+			self.ramp_temperature(self.lig_step3, self.lig_set_step3, self.lig_poll_step3)  # ramp flowcell temperature to 30 C
+			self.incubate_reagent(self.lig_time3)  # incubate reagent for 5 min
+
+			if self.flowcell == 0:
+				self.mux.set_to_temperature_control1()  # set to temperature controller 1
+			else:
+				self.mux.set_to_temperature_control2()  # set to temperature controller 2
 
-		self.temperature_control.set_temperature(self.lig_set_step4)  # set flowcell temperature to 37 C
-		self.wait_for_SS(self.lig_set_step4, self.lig_poll_step4, self.temp_tolerance)  # wait until steady-state temperature is reached
-		self.incubate_reagent(self.lig_time4)  # incubate reagent for 5 min
+			self.ramp_temperature(self.lig_step4, self.lig_set_step4, self.lig_poll_step4)  # ramp flowcell temperature to 37 C
+			self.incubate_reagent(self.lig_time4)  # incubate reagent for 5 min
 
 		if self.flowcell == 0:
 			self.mux.set_to_temperature_control1()  # set to temperature controller 1
@@ -1160,6 +1270,8 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		delta = (time.time() - t0) / 60	# calculate elapsed time for stepup peg ligation
 
 		self.logging.warn("%s\t%i\t--> Finished step-up peg ligation - duration: %0.2f minutes\n" % (self.cycle_name, self.flowcell, delta))
+		self.queue.flush()  # no valve move of this step is left unsent
+		self.queue.report(self.state)  # log mux/baud switches saved by the command queue
 
 #--------------------------------------------------------------------------------------# 
 # 				SEQUENCING ALGORTIHMS 				       # 
@@ -1188,6 +1300,10 @@ class Biochem(Thread):  # Biochem is a sub-class of a Thread object [inheritance
 		else:
 			self.cycle_ligation()  # perform query cycle on selected flowcell
 
+		self.queue.flush()  # valve moves of a last step that moved no fluid
+		self.ser.dump_latency()  # report serial round-trip latencies of this run
+		self.logging.info("---\t-\t--> Maestro telnet: %s" % self.mux.session.stall_summary())  # report telnet stalls
+
 #--------------------------------- Cycle_ligation sub. ---------------------------------
 
 	def cycle_ligation(self):
@@ -0,0 +1,108 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Bus_arbiter,
+ containing the process-wide lease of a serial line shared by several Biochem
+ threads (one per flowcell) in Python.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import threading
+
+class Bus_arbiter:
+
+	def __init__(self, port):
+		"""Initialize bus arbiter object of given serial port. Besides the lease, it
+		holds the line state all Serial_port objects on this port share: the open tty,
+		the mux channel latched on the line and the line speed."""
+
+		self.port = port
+		self.condition = threading.Condition(threading.Lock())
+		self.next_ticket = 0		# first come, first served between threads
+		self.serving = 0
+		self.owner = None		# thread holding the lease
+		self.depth = 0			# nested acquisitions by the owner
+
+		self.handle = None		# (serial, poll object) of the tty, opened once per process
+		self.users = 0			# Serial_port objects sharing the handle
+		self.channel = None		# mux channel latched on this line, None if unknown
+		self.baud = None		# current line speed
+
+		self.leases = 0			# lease statistics
+		self.waited = 0.0
+
+	def acquire(self):
+		"""Blocks until the calling thread holds the line lease. Threads are served in
+		order of arrival; a thread already holding the lease re-enters it."""
+
+		me = threading.currentThread()
+		self.condition.acquire()
+
+		try:
+			if self.owner is me:
+				self.depth += 1
+				return
+
+			ticket = self.next_ticket
+			self.next_ticket += 1
+			t0 = time.time()
+
+			while ticket != self.serving:
+				self.condition.wait()
+
+			self.owner = me
+			self.depth = 1
+			self.leases += 1
+			self.waited += time.time() - t0
+		finally:
+			self.condition.release()
+
+	def release(self):
+		"Releases one level of the lease; the line passes to the next thread in line when the owner fully released it."
+
+		self.condition.acquire()
+
+		try:
+			if self.owner is not threading.currentThread():
+				raise RuntimeError("serial line %s released by a thread not holding its lease" % self.port)
+
+			self.depth -= 1
+
+			if self.depth == 0:
+				self.owner = None
+				self.serving += 1
+				self.condition.notifyAll()
+		finally:
+			self.condition.release()
+
+#--------------------------------------------------------------------------------------#
+#				ARBITER REGISTRY				       #
+#--------------------------------------------------------------------------------------#
+#
+# Every Biochem thread constructs its own Serial_port and Mux, so the arbiter of a port
+# is looked up by device path: all objects on the same tty share one arbiter, and with
+# it one open handle of the tty.
+#
+
+arbiters = {}
+arbiters_lock = threading.Lock()
+
+def get_arbiter(port):
+	"Returns the process-wide arbiter of given serial port, creating it on first use."
+
+	path = os.path.realpath(port)
+	arbiters_lock.acquire()
+
+	try:
+		if not arbiters.has_key(path):
+			arbiters[path] = Bus_arbiter(path)
+		return arbiters[path]
+	finally:
+		arbiters_lock.release()
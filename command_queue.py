@@ -0,0 +1,171 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Command_queue,
+ containing the device command scheduler between Biochem and the device
+ drivers in Python.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+class Command_queue:
+
+	def __init__(self, config, mux, serial_port, rotary_valve, logger=None):
+		"Initialize device command queue object with default parameters."
+
+		if logger is not None:
+			self.logging = logger
+
+		self.mux = mux
+		self.serport = serial_port
+		self.rotary_valve = rotary_valve
+		self.pending = []
+
+		serial_port.queue = self	# any other transaction on the port flushes the queue first
+
+		self.bauds = {'syringe_pump' : int(config.get("communication","syringe_pump_baud")),	# used to count baud rate switches
+			      'rotary_valve' : int(config.get("communication","rotary_valve_baud")),
+			      'temperature_control' : int(config.get("communication","temperature_control_baud")),
+			      'reagent_block_cooler' : int(config.get("communication","temperature_control_baud"))}
+
+		self.queued = 0		# commands and mux/baud switches since last report
+		self.coalesced = 0
+		self.mux_naive = 0
+		self.mux_done = 0
+		self.baud_naive = 0
+		self.baud_done = 0
+
+#--------------------------------------------------------------------------------------#
+#				COMMAND SCHEDULING				       #
+#--------------------------------------------------------------------------------------#
+#
+# Commands queued between two barriers (syringe moves, temperature settings, discrete
+# valve switching) act on different devices and do not move any fluid, thus they are
+# commutative: they are regrouped so that all commands for one device run back to back
+# (starting with the device the mux is already set to), keeping the relative order of
+# commands on the same device. A queued command replaces an earlier one with the same
+# key on the same device, e.g. a rotary valve position that is overridden before any
+# fluid moved through the valve is never sent.
+#
+# Both Biochem threads drive the same line, so the channel latched and the line speed
+# are taken from the line's arbiter (bus_arbiter.py), not from this thread's Mux or
+# Serial_port, which do not see switches made by the other thread.
+#
+# Commands bypassing the queue (direct driver calls) are barriers too: the serial port
+# flushes the queue before any transaction of its own, and the flush leaves the mux
+# channel and line speed addressed as the caller had set them.
+#
+
+	def add(self, device, key, function, *args):
+		"""Queues function(*args) to be executed with the mux set to given device, e.g.
+		'rotary_valve1'. If key is given, an earlier pending command with the same device
+		and key is dropped (key None: never dropped)."""
+
+		self.queued += 1
+		self.mux_naive += 1	# unscheduled code re-selects the mux channel for every command
+
+		if key is not None:
+			for i in range(len(self.pending) - 1, -1, -1):
+				if self.pending[i][0] == device and self.pending[i][1] == key:
+					del self.pending[i]
+					self.coalesced += 1
+					break
+
+		self.pending.append((device, key, function, args))
+
+	def set_valve_position(self, valve, position):
+		"Queues setting rotary valve 'V1'-'V4' to given port."
+		self.add('rotary_valve' + valve[1:], 'position', self.rotary_valve.set_valve_position, position)
+
+	def schedule(self, commands):
+		"Returns commands grouped per device, starting with the device latched on the line."
+
+		groups = {}
+		order = []
+
+		for command in commands:
+			if not groups.has_key(command[0]):
+				groups[command[0]] = []
+				order.append(command[0])
+
+			groups[command[0]].append(command)
+
+		channel = self.serport.arbiter.channel
+
+		if channel in order:
+			order.remove(channel)
+			order.insert(0, channel)
+
+		scheduled = []
+		for device in order:
+			scheduled.extend(groups[device])
+		return scheduled
+
+	def baud_switches(self, devices, current):
+		"Counts baud rate changes needed to address the given device sequence."
+
+		switches = 0
+
+		for device in devices:
+			baud = self.bauds.get(device.rstrip('1234'))
+
+			if baud != current:
+				switches += 1
+				current = baud
+		return switches
+
+	def flush(self):
+		"Executes all pending commands in scheduled order."
+
+		if not self.pending:
+			return
+
+		commands = self.pending
+		self.pending = []
+		scheduled = self.schedule(commands)
+
+		self.baud_naive += self.baud_switches([command[0] for command in commands], self.serport.arbiter.baud)
+		self.baud_done += self.baud_switches([command[0] for command in scheduled], self.serport.arbiter.baud)
+
+		channel = self.mux.channel	# addressed by the caller, e.g. a direct driver call
+		baud = self.serport.baud
+
+		for device, key, function, args in scheduled:
+			self.switch(device)
+			function(*args)
+
+		if channel is not None and self.mux.channel != channel:
+			self.mux.select(channel)
+		self.serport.set_baud(baud)
+
+	def select(self, device):
+		"Executes pending commands (barrier), then sets mux to given device unless already selected."
+
+		self.flush()
+		self.mux_naive += 1
+		self.switch(device)
+
+	def switch(self, device):
+		"""Sets mux to given device unless this thread selected it already; counts a switch
+		if the line is latched to another channel."""
+
+		if self.serport.arbiter.channel != device:
+			self.mux_done += 1
+
+		if self.mux.channel != device:
+			getattr(self.mux, 'set_to_' + device)()
+
+	def report(self, protocol):
+		"Logs commands coalesced and mux/baud switches saved since last report, then resets counters."
+
+		self.logging.info("---\t-\t--> Command queue [%s]: %i commands, %i coalesced, mux switches %i of %i (saved %i), baud switches %i of %i (saved %i)" %
+				  (protocol, self.queued, self.coalesced, self.mux_done, self.mux_naive, self.mux_naive - self.mux_done,
+				   self.baud_done, self.baud_naive, self.baud_naive - self.baud_done))
+
+		self.queued = self.coalesced = 0
+		self.mux_naive = self.mux_done = 0
+		self.baud_naive = self.baud_done = 0
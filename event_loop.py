@@ -0,0 +1,437 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Event_loop, a
+ single-threaded, select-based coroutine scheduler in Python. Coroutines are
+ generators that yield what they wait for:
+
+		 yield Sleep(seconds)			- resume after given time
+		 ready = yield Readable(fd, timeout)	- resume when fd has data (False on timeout)
+		 ready = yield Writable(fd, timeout)	- resume when fd takes data (False on timeout)
+		 yield lock.acquire()			- resume when Lock is acquired
+		 result = yield task			- resume when other Task is finished
+		 result = yield coroutine(...)		- run nested coroutine, get its result
+
+ A coroutine returns a value with 'raise Return(value)'. Task.cancel() raises
+ Cancelled inside the coroutine at its current yield point, so 'finally'
+ blocks can release devices on aborts.
+
+ The process-wide loop (start_loop()) runs in a thread of its own; other
+ threads hand work to it with post(), the only thread-safe method.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import errno
+import heapq
+import select
+import types
+import threading
+
+class Return(Exception):
+	"Raised by a coroutine to return a value to its caller."
+
+	def __init__(self, value=None):
+		Exception.__init__(self)
+		self.value = value
+
+class Cancelled(Exception):
+	"Raised inside a coroutine when its task is cancelled."
+	pass
+
+class Sleep:
+
+	def __init__(self, seconds):
+		"Request to resume the coroutine after given number of seconds."
+		self.seconds = seconds
+
+class Readable:
+
+	def __init__(self, fd, timeout=None):
+		"Request to resume the coroutine when fd is readable, or with False after timeout."
+
+		self.fd = fd
+		self.timeout = timeout
+
+class Writable:
+
+	def __init__(self, fd, timeout=None):
+		"Request to resume the coroutine when fd can be written to, or with False after timeout."
+
+		self.fd = fd
+		self.timeout = timeout
+
+#--------------------------------------------------------------------------------------#
+#					TASK					       #
+#--------------------------------------------------------------------------------------#
+
+class Task:
+
+	def __init__(self, loop, coroutine, name=None):
+		"Initialize task object running given coroutine (generator) on the event loop."
+
+		self.loop = loop
+		self.name = name or getattr(coroutine, '__name__', 'task')
+		self.stack = [coroutine]	# nested coroutines, innermost last
+		self.done = False
+		self.result = None
+		self.exception = None
+		self.waiters = []		# tasks waiting for this one to finish
+		self.fd = None			# pending reader/writer registration, dropped on wake-up
+		self.waiting = None		# registry of that fd: the loop's readers or writers
+		self.timer = None		# pending timer entry, dropped on wake-up
+		self.awaiting = None		# task this one waits for, dropped on wake-up
+
+	def cancel(self):
+		"Raises Cancelled inside the coroutine at its current yield point."
+
+		if not self.done:
+			self.loop.wake(self, exception=Cancelled("task %s cancelled" % self.name))
+
+	def finish(self, result=None, exception=None):
+		"Marks task as finished and wakes all tasks waiting for it."
+
+		self.done = True
+		self.result = result
+		self.exception = exception
+
+		waiters = self.waiters
+		self.waiters = []
+
+		for waiter in waiters:
+			self.loop.wake(waiter, result, exception)
+
+#--------------------------------------------------------------------------------------#
+#					LOCK					       #
+#--------------------------------------------------------------------------------------#
+
+class Lock:
+
+	def __init__(self):
+		"Initialize first-come first-served coroutine lock object."
+
+		self.owner = None
+		self.waiters = []
+
+	def acquire(self):
+		"Coroutine: waits until the lock is free and takes it."
+
+		task = yield None	# current task is sent back by the loop
+
+		if self.owner is None:
+			self.owner = task
+			return
+
+		self.waiters.append(task)
+
+		try:
+			yield Sleep(None)	# suspended until release() hands the lock over
+		except:
+			if self.owner is task:	# cancelled right after the hand-over
+				self.release()
+			elif task in self.waiters:
+				self.waiters.remove(task)
+			raise
+
+	def release(self):
+		"Releases the lock, handing it to the longest waiting task."
+
+		if self.waiters:
+			self.owner = self.waiters.pop(0)
+			self.owner.loop.wake(self.owner)
+		else:
+			self.owner = None
+
+#--------------------------------------------------------------------------------------#
+#				      EVENT LOOP				       #
+#--------------------------------------------------------------------------------------#
+
+class Event_loop:
+
+	def __init__(self, logger=None):
+		"Initialize event loop object with no tasks."
+
+		if logger is not None:
+			self.logging = logger
+
+		self.ready = []		# (task, value, exception) to resume
+		self.timers = []	# heap of [time, sequence, task, value]
+		self.readers = {}	# fd -> list of tasks
+		self.writers = {}	# fd -> list of tasks
+		self.sequence = 0
+		self.tasks = []
+		self.locks = {}		# resource, e.g. serial port name -> Lock shared by all tasks
+
+		self.posted = []			# (function, args) posted by other threads
+		self.posted_lock = threading.Lock()
+		self.wakeup = os.pipe()			# written by post() to interrupt select()
+		self.halted = False
+
+	def lock(self, resource):
+		"Returns the Lock of given resource, e.g. a serial port name, shared by all tasks of the loop."
+		return self.locks.setdefault(resource, Lock())
+
+	def spawn(self, coroutine, name=None):
+		"Schedules coroutine to run as a new task and returns the Task object."
+
+		task = Task(self, coroutine, name)
+		self.tasks.append(task)
+		self.ready.append((task, None, None))
+		return task
+
+	def wake(self, task, value=None, exception=None):
+		"Resumes task with given value (or exception) on the next loop iteration."
+
+		self.unregister(task)
+		self.ready.append((task, value, exception))
+
+	def unregister(self, task):
+		"Drops pending timer/reader registration of task, and its place among the waiters of another task."
+
+		if task.timer is not None:
+			task.timer[2] = None	# lazily removed from heap
+			task.timer = None
+
+		if task.fd is not None:
+			task.waiting[task.fd].remove(task)
+
+			if not task.waiting[task.fd]:
+				del task.waiting[task.fd]
+			task.fd = None
+			task.waiting = None
+
+		if task.awaiting is not None:
+			if task in task.awaiting.waiters:	# e.g. cancelled while waiting
+				task.awaiting.waiters.remove(task)
+			task.awaiting = None
+
+	def drop_readers(self, exception):
+		"Wakes the tasks waiting on fds that are no longer open with given exception."
+
+		for waiting in [self.readers, self.writers]:
+			for fd in waiting.keys():
+				try:
+					os.fstat(fd)
+				except (OSError, TypeError):
+					for task in list(waiting.get(fd, [])):
+						self.wake(task, exception=exception)
+
+	def add_timer(self, task, seconds, value=None):
+		"Resumes task with given value after given number of seconds."
+
+		self.sequence += 1
+		task.timer = [time.time() + seconds, self.sequence, task, value]
+		heapq.heappush(self.timers, task.timer)
+
+	def step(self, task, value, exception):
+		"Runs task until its next yield and registers what it waits for."
+
+		while True:
+			coroutine = task.stack[-1]
+
+			try:
+				if exception is not None:
+					request = coroutine.throw(exception)
+				else:
+					request = coroutine.send(value)
+
+			except Return, e:
+				value, exception = e.value, None
+			except StopIteration:
+				value, exception = None, None
+			except Exception, e:
+				value, exception = None, e
+
+			else:
+				exception = None
+
+				if isinstance(request, types.GeneratorType):	# nested coroutine call
+					task.stack.append(request)
+					value = None
+					continue
+
+				if request is None:				# e.g. Lock.acquire() asking for current task
+					value = task
+					continue
+
+				if isinstance(request, Sleep):
+					if request.seconds is not None:
+						self.add_timer(task, request.seconds)
+					return
+
+				if isinstance(request, Readable) or isinstance(request, Writable):
+					task.waiting = [self.writers, self.readers][isinstance(request, Readable)]
+					task.waiting.setdefault(request.fd, []).append(task)
+					task.fd = request.fd
+
+					if request.timeout is not None:
+						self.add_timer(task, request.timeout, False)
+					return
+
+				if isinstance(request, Task):
+					if request.done:
+						value, exception = request.result, request.exception
+						continue
+					request.waiters.append(task)
+					task.awaiting = request
+					return
+
+				raise TypeError("coroutine %s yielded unsupported %r" % (task.name, request))
+
+			task.stack.pop()		# coroutine finished - pass result to its caller
+
+			if not task.stack:
+				task.finish(value, exception)
+				self.tasks.remove(task)
+				return
+
+	def post(self, function, *args):
+		"Calls function(*args) in the loop thread on its next iteration; may be called from any thread."
+
+		self.posted_lock.acquire()
+		self.posted.append((function, args))
+		self.posted_lock.release()
+
+		os.write(self.wakeup[1], '.')
+
+	def run_posted(self):
+		"Runs the calls posted by other threads, oldest first."
+
+		self.posted_lock.acquire()
+		posted = self.posted
+		self.posted = []
+		self.posted_lock.release()
+
+		for function, args in posted:
+			try:
+				function(*args)
+			except Exception, e:		# one failed call must not take the loop down
+				self.report("posted call %s failed" % getattr(function, '__name__', function), e)
+
+	def report(self, what, exception):
+		"Logs an error of the loop itself (not of a task)."
+
+		if hasattr(self, 'logging'):
+			self.logging.error("---\t-\t--> Event loop: %s: %s" % (what, exception))
+
+	def run_once(self, idle=False):
+		"""Runs posted calls and resumes ready tasks, then waits for the next timer, readable fd
+		or posted call; if idle, also when no task waits for anything (see run_forever())."""
+
+		self.run_posted()
+
+		ready = self.ready
+		self.ready = []
+
+		for task, value, exception in ready:
+			if not task.done:
+				self.step(task, value, exception)
+
+		if self.ready or self.posted:
+			return
+
+		timeout = None
+
+		while self.timers and self.timers[0][2] is None:
+			heapq.heappop(self.timers)
+
+		if self.timers:
+			timeout = max(0.0, self.timers[0][0] - time.time())
+
+		if timeout is None and not self.readers and not self.writers and not idle:
+			if not self.tasks:
+				return			# all tasks finished
+			raise RuntimeError("event loop deadlock: %i tasks waiting for nothing" % len(self.tasks))
+
+		try:
+			readable, writable, failed = select.select(self.readers.keys() + [self.wakeup[0]], self.writers.keys(), [], timeout)
+		except (select.error, ValueError), e:
+			if e.args and e.args[0] != errno.EINTR:
+				self.drop_readers(e)	# e.g. a task's fd was closed under it
+			return
+
+		for fd in readable:
+			if fd == self.wakeup[0]:
+				os.read(fd, 4096)	# posted calls run on the next iteration
+				continue
+
+			for task in list(self.readers.get(fd, [])):
+				self.wake(task, True)
+
+		for fd in writable:
+			for task in list(self.writers.get(fd, [])):
+				self.wake(task, True)
+
+		now = time.time()
+
+		while self.timers and (self.timers[0][2] is None or self.timers[0][0] <= now):
+			entry = heapq.heappop(self.timers)
+
+			if entry[2] is not None:
+				self.wake(entry[2], entry[3])
+
+	def run_until_complete(self, task):
+		"Runs the loop until given task is finished and returns its result."
+
+		while not task.done:
+			self.run_once()
+
+		if task.exception is not None:
+			raise task.exception
+		return task.result
+
+	def run(self):
+		"Runs the loop until all tasks are finished."
+
+		while self.tasks:
+			self.run_once()
+
+	def run_forever(self):
+		"Runs the loop until halt() is called, waiting for posted calls while there is nothing to do."
+
+		while not self.halted:
+			try:
+				self.run_once(True)
+			except Exception, e:		# keep the services of the other tasks running
+				self.report("iteration failed", e)
+				time.sleep(0.1)
+
+	def halt(self):
+		"Makes run_forever() return after the current iteration; may be called from any thread."
+
+		self.halted = True
+		os.write(self.wakeup[1], '.')	# interrupts select()
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE LOOP				       #
+#--------------------------------------------------------------------------------------#
+#
+# Runs the services of polonator_main (thermal service, status LEDs) as coroutines in
+# one thread; the Biochem threads keep their blocking drivers.
+#
+
+current = None
+current_lock = threading.Lock()
+
+def start_loop(logger=None):
+	"Starts the process-wide event loop in a thread of its own (unless running) and returns it."
+
+	global current
+
+	current_lock.acquire()
+
+	try:
+		if current is None:
+			current = Event_loop(logger)
+			thread = threading.Thread(target=current.run_forever, name='event loop')
+			thread.setDaemon(True)
+			thread.start()
+		return current
+	finally:
+		current_lock.release()
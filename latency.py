@@ -0,0 +1,81 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Latency_histogram,
+ containing low-overhead transaction latency bookkeeping in Python.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import math
+
+class Latency_histogram:
+
+	buckets = 24	# power-of-two buckets from 1 us up to ~8 s (last one open ended)
+
+	def __init__(self):
+		"Initialize empty latency histogram object."
+		self.reset()
+
+	def reset(self):
+		"Drops all recorded samples."
+		self.counts = {}	# key -> [bucket counts, count, total, min, max]
+
+	def record(self, key, seconds):
+		"Adds one latency sample (in seconds) under given key, e.g. (device, opcode)."
+
+		entry = self.counts.get(key)
+
+		if entry is None:
+			entry = [[0] * self.buckets, 0, 0.0, seconds, seconds]
+			self.counts[key] = entry
+
+		bucket = math.frexp(seconds * 1e6)[1]	# floor(log2(us)) + 1
+
+		if bucket < 0:
+			bucket = 0
+		elif bucket >= self.buckets:
+			bucket = self.buckets - 1
+
+		entry[0][bucket] += 1
+		entry[1] += 1
+		entry[2] += seconds
+
+		if seconds < entry[3]:
+			entry[3] = seconds
+		if seconds > entry[4]:
+			entry[4] = seconds
+
+	def percentile(self, key, fraction):
+		"Returns upper bucket bound (in seconds) below which given fraction of samples fall."
+
+		counts, count = self.counts[key][0], self.counts[key][1]
+		limit = fraction * count
+		running = 0
+
+		for bucket in range(0, self.buckets):
+			running += counts[bucket]
+
+			if running >= limit:
+				return math.ldexp(1.0, bucket) / 1e6
+		return self.counts[key][4]
+
+	def summary(self):
+		"Returns one formatted line per key: count, total, mean, min, p50, p90, p99, max."
+
+		lines = []
+		keys = self.counts.keys()
+		keys.sort()
+
+		for key in keys:
+			counts, count, total, minimum, maximum = self.counts[key]
+
+			lines.append("%-24s %-8s n=%-6i total=%8.2f s  mean=%7.2f ms  min=%7.2f  p50<%7.2f  p90<%7.2f  p99<%7.2f  max=%7.2f ms" %
+				     (key[0], key[1], count, total, 1e3 * total / count, 1e3 * minimum,
+				      1e3 * self.percentile(key, 0.5), 1e3 * self.percentile(key, 0.9),
+				      1e3 * self.percentile(key, 0.99), 1e3 * maximum))
+		return lines
@@ -0,0 +1,123 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Maestro, containing
+ the process-wide, thread-safe Maestro controller client in Python. It keeps a
+ pool of long-lived telnet sessions (Tel_net) shared by polonator_main (status
+ LEDs, stage homing poll, touch sensor) and all Mux objects, so Biochem cycles
+ no longer open their own connections.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import Queue
+import threading
+
+from tel_net import Tel_net, stall_summary
+
+class Maestro:
+
+	def __init__(self, size=2, logger=None, config=None):
+		"""Initialize Maestro client object with a pool of at most 'size' telnet sessions,
+		opened on first use (with the telnet settings of config, if given)."""
+
+		if logger is not None:
+			self.logging = logger
+
+		self.config = config
+
+		self.size = size
+		self.idle = Queue.Queue()	# idle sessions, handed out first come, first served
+		self.lock = threading.Lock()
+		self.opened = 0
+		self.requests = 0
+
+	def borrow(self):
+		"Returns an idle session, opening a new one while the pool is not full, else waits for one."
+
+		try:
+			return self.idle.get_nowait()
+		except Queue.Empty:
+			pass
+
+		self.lock.acquire()
+
+		try:
+			create = self.opened < self.size
+
+			if create:
+				self.opened += 1
+		finally:
+			self.lock.release()
+
+		if not create:
+			return self.idle.get()
+
+		try:
+			return Tel_net(getattr(self, 'logging', None), self.config)
+		except:
+			self.discard()
+			raise
+
+	def give_back(self, session):
+		"Returns a borrowed session to the pool."
+		self.idle.put(session)
+
+	def discard(self):
+		"Drops a broken session from the pool, so a new one is opened when needed."
+
+		self.lock.acquire()
+		self.opened -= 1
+		self.lock.release()
+
+	def call(self, method, *args):
+		"Runs a Tel_net method on a borrowed session; a session raising an error is discarded."
+
+		session = self.borrow()
+		self.requests += 1
+
+		try:
+			result = getattr(session, method)(*args)
+		except:
+			self.discard()
+			raise
+
+		self.give_back(session)
+		return result
+
+	def parse_read_string(self, write_string, find_string='>'):
+		"Writes one command and returns the reply up to find_string, as Tel_net.parse_read_string()."
+		return self.call('parse_read_string', write_string, find_string)
+
+	def pipeline(self, write_strings, find_string='>'):
+		"Writes a command burst on one session and returns the replies, as Tel_net.pipeline()."
+		return self.call('pipeline', write_strings, find_string)
+
+	def stall_summary(self):
+		"Returns the telnet stall metric of this process as a printable string."
+		return stall_summary()
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE CLIENT				       #
+#--------------------------------------------------------------------------------------#
+
+maestro = None
+maestro_lock = threading.Lock()
+
+def get_maestro(logger=None, config=None):
+	"Returns the process-wide Maestro client, creating it on first use."
+
+	global maestro
+
+	maestro_lock.acquire()
+
+	try:
+		if maestro is None:
+			maestro = Maestro(2, logger, config)
+		return maestro
+	finally:
+		maestro_lock.release()
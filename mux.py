@@ -18,404 +18,468 @@
 import sys
 import getpass
 import time
-from tel_net import Tel_net
+import threading
+from maestro import get_maestro
+from event_loop import Return
 
 class Mux:
 
-	global mux_state
-	global mux_state_00
 	global session
-	mux_state_00 = ([0,0,0,0,0])
 
-	def __init__(self, logger=None):
+	# Default output map, replaced by the [mux_channels] and [mux_discrete] sections of the
+	# configuration file if present. A channel latches a 5-bit word (m_dout[0..4]) into the
+	# bank selected by m_dout[6,7]; a discrete output is one bit of a bank word.
+
+	channels = {'temperature_control1' : ((0,1), [0,0,0,0,0], 'temperature controller 1'),
+		    'temperature_control2' : ((0,1), [1,0,0,0,0], 'temperature controller 2'),
+		    'reagent_block_cooler' : ((0,1), [0,1,0,0,0], 'reagent block cooler'),
+		    'rotary_valve1' : ((0,1), [0,0,1,0,0], 'ten port rotary valve V1'),
+		    'rotary_valve2' : ((0,1), [1,0,1,0,0], 'ten port rotary valve V2'),
+		    'rotary_valve3' : ((0,1), [0,1,1,0,0], 'ten port rotary valve V3'),
+		    'rotary_valve4' : ((0,1), [1,1,1,0,0], 'ten port rotary valve V4'),
+		    'syringe_pump' : ((0,1), [1,1,0,0,0], 'syringe pump')}
+
+	discretes = {'v4' : ((0,0), 0, '3-way discrete valve V4', 'NO (ligase)', 'NC (ligase buffer)'),
+		     'v5' : ((0,0), 1, '3-way discrete valve V5', 'NO (from V3 to FC)', 'NC (from mixer to FC)'),
+		     'v6' : ((0,0), 2, '3-way discrete valve V6', 'NO (through FC 2)', 'NC (through FC 1)'),
+		     'v7' : ((0,0), 3, '3-way discrete valve V7', 'NO (dH2O)', 'NC (air)'),
+		     'mixer' : ((0,0), 4, 'Mixing chamber', 'in use', 'off')}
+
+	# Shadow of the Maestro output register m_dout[0..7], the word held by each latch bank
+	# and the requested discrete output words, shared by all Mux objects; None/missing
+	# while unknown
+
+	outputs = [None] * 8
+	latched = {}
+	states = {}
+	compiled = {}		# (outputs, bank, word) -> (m_dout commands, resulting outputs)
+
+	live = 0		# Mux objects in this process - outputs are reset when the last one goes
+	live_lock = threading.Lock()
+
+	def __init__(self, logger=None, serial_port=None, config=None):
 		"""Initialize Ultimac Mux R/P PCB mux object with default parameters"""
 
 		if logger is not None:			# if defined, place logger into Mux
 			self.logging = logger
 
-		self.session = Tel_net()
-
-		mux_state = ([0,0,0,0,0,1,0,0])
-		mux_state_00 = ([0,0,0,0,0])
-
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state = ([0,0,0,0,0,0,1,0])
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state = ([0,0,0,0,0,0,0,1])
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state = ([0,0,0,0,0,0,1,1])
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
+		if config is not None:
+			self.read_map(config)
+
+		self.serport = serial_port		# if defined, channel switching is done under its line lease
+		self.channel = None			# device the communication channel is set to
+		self.arbiter = None
+
+		if serial_port is not None:
+			serial_port.mux = self		# serial port latches the channel before each transaction
+			self.arbiter = serial_port.shared[2]
+
+		self.precompile()
+		self.session = get_maestro(logger, config)	# long-lived telnet sessions shared by the whole process
+
+		Mux.live_lock.acquire()
+		Mux.live += 1
+		Mux.live_lock.release()
+
+		self.acquire()
+
+		try:
+			if self.outputs[5] is None:	# register unknown (first Mux, or a write failed): reset banks
+				self.reset()
+		finally:
+			self.release()
 
 		self.logging.info("---\t-\t--> Mux object constructed")
 
+	def reset(self):
+		"Latches all four banks to zero and leaves the strobe high."
+
+		self.acquire()
+
+		try:
+			self.write_outputs([(5,1), (0,0), (1,0), (2,0), (3,0), (4,0), (6,0), (7,0), (5,0), (5,1),	# all banks to zero
+					    (6,1), (7,0), (5,0), (5,1),
+					    (6,0), (7,1), (5,0), (5,1),
+					    (6,1), (7,1), (5,0), (5,1)])
+
+			for bank in [(0,0), (1,0), (0,1), (1,1)]:
+				self.latched[bank] = [0,0,0,0,0]
+
+			self.states.clear()	# discrete outputs are off now
+
+			if self.arbiter is not None:
+				self.arbiter.channel = None	# channel bank was reset - unknown to other Mux objects
+		finally:
+			self.release()
+
+	def reset_discrete(self):
+		"""Latches zero into every bank holding discrete outputs (valves V4-V7 and mixer off),
+		whatever the shadow says, and clears their requested states. Called at the start
+		of each Biochem cycle, as the banks are only reset by the first Mux of the process."""
+
+		banks = []
+
+		for bank, bit, label, on, off in self.discretes.values():
+			if bank not in banks:
+				banks.append(bank)
+
+		self.acquire()
+
+		try:
+			for bank in banks:
+				if self.latched.has_key(bank):
+					del self.latched[bank]	# always written, like the reset of the banks
+
+				self.latch(bank, [0,0,0,0,0])
+
+				if self.states.has_key(bank):
+					del self.states[bank]
+		finally:
+			self.release()
+
+		self.logging.info("---\t-\t--> Reset discrete valves and mixer")
+
+#--------------------------------------------------------------------------------------#
+#				MUX OUTPUT MAP					       #
+#--------------------------------------------------------------------------------------#
+#
+# [mux_channels]: <channel> = <m_dout[6] m_dout[7]> <m_dout[0] .. m_dout[4]>, <label>
+# [mux_discrete]: <output> = <m_dout[6] m_dout[7]> <bit 0-4>, <label>, <ON label>, <OFF label>
+#
+
+	def read_map(self, config):
+		"Reads channel and discrete output tables from the configuration file, where present."
+
+		if config.has_section("mux_channels"):
+			channels = {}
+
+			for name, value in config.items("mux_channels"):
+				bits, label = [field.strip() for field in value.split(',', 1)]
+				bits = self.parse_bits(name, bits, 7)
+				channels[name] = ((bits[0], bits[1]), bits[2:7], label)
+
+			self.channels = channels
+
+		if config.has_section("mux_discrete"):
+			discretes = {}
+
+			for name, value in config.items("mux_discrete"):
+				fields = [field.strip() for field in value.split(',')]
+
+				if len(fields) != 4:
+					raise ValueError("mux output %s: expected '<bank bits> <bit>, <label>, <ON label>, <OFF label>', got %r" % (name, value))
+
+				bits = self.parse_bits(name, fields[0], 3, 4)
+				discretes[name] = ((bits[0], bits[1]), bits[2], fields[1], fields[2], fields[3])
+
+			self.discretes = discretes
+
+	def parse_bits(self, name, text, count, last_max=1):
+		"Parses a white space separated list of 'count' bits (last value up to last_max)."
+
+		try:
+			bits = [int(bit) for bit in text.split()]
+		except ValueError:
+			bits = []
+
+		if len(bits) != count or [bit for bit in bits[:-1] if bit not in (0, 1)] or not 0 <= bits[-1] <= last_max:
+			raise ValueError("mux output %s: bad bit list %r" % (name, text))
+		return bits
+
+	def compile(self, outputs, bank, word):
+		"""Returns (m_dout commands, resulting outputs) latching word into bank, starting
+		from given output register state. The strobe m_dout[5] is active low and left low,
+		so it is raised before any bit changes; only bits differing from the register are
+		written. Sequences are memoized."""
+
+		key = (tuple(outputs), bank, tuple(word))
+		sequence = self.compiled.get(key)
+
+		if sequence is None:
+			target = list(word) + [0] + list(bank)
+			commands = []
+
+			if outputs[5] != 1:
+				commands.append('m_dout[5]=1')
+
+			for bit in [0,1,2,3,4,6,7]:
+				if outputs[bit] != target[bit]:
+					commands.append('m_dout[%i]=%i' % (bit, target[bit]))
+
+			commands.append('m_dout[5]=0')
+			sequence = (commands, target)
+			self.compiled[key] = sequence
+		return sequence
+
+	def precompile(self):
+		"Compiles switch sequences between all channels, and from unknown register state."
+
+		for bank, word, label in self.channels.values():
+			self.compile([None] * 8, bank, word)
+
+			for previous_bank, previous_word, previous_label in self.channels.values():
+				self.compile(list(previous_word) + [0] + list(previous_bank), bank, word)
+
 #--------------------------------------------------------------------------------------#
 #	 Ultimac Mux R/P PCB FUNCTIONS	 #
 #--------------------------------------------------------------------------------------#
+#
+# Both Biochem threads (one per flowcell) write the same m_dout lines of the Maestro, so
+# every latch sequence is written while holding the lease of the shared serial line
+# (bus_arbiter.py). Channel selection is lazy: select() only records the device; the
+# serial port latches the channel bank within the same lease as the transaction itself.
+#
+
+	def acquire(self):
+		"Leases the shared serial line, if any, so no other thread writes m_dout meanwhile."
+
+		if self.arbiter is not None:
+			self.arbiter.acquire()
+
+	def release(self):
+		"Releases the lease taken by acquire()."
+
+		if self.arbiter is not None:
+			self.arbiter.release()
+
+	def forget(self):
+		"""Marks output register and latch contents as unknown, e.g. after a failed telnet write;
+		requested discrete outputs are forgotten with them."""
+
+		self.outputs[:] = [None] * 8
+		self.latched.clear()
+		self.states.clear()
+
+		if self.arbiter is not None:
+			self.arbiter.channel = None
+
+	def send(self, commands):
+		"Writes m_dout commands as one pipelined telnet burst; on failure the shadow is marked unknown."
+
+		try:
+			self.session.pipeline(commands)
+		except:
+			self.forget()
+			raise
+
+	def write_outputs(self, sequence):
+		"Writes a sequence of (bit, value) m_dout settings and updates the shadow register."
+
+		self.send(['m_dout[%i]=%i' % (bit, value) for bit, value in sequence])
+
+		for bit, value in sequence:
+			self.outputs[bit] = value
+
+	def latch(self, bank, word):
+		"""Latches 5-bit word (m_dout[0..4]) into the bank selected by m_dout[6,7], unless the
+		bank already holds it. Returns the number of m_dout writes."""
+
+		if self.latched.get(bank) == list(word):
+			return 0
+
+		commands, target = self.compile(self.outputs, bank, word)
+		self.send(commands)
+
+		self.outputs[:] = target
+		self.latched[bank] = list(word)
+		return len(commands)
+
+	def latch_channel(self, device):
+		"""Latches the channel bank to given device; called by Serial_port while holding the
+		line lease (or directly if the mux has no serial port)."""
+
+		bank, word, label = self.channels[device]
+		self.acquire()
+
+		try:
+			writes = self.latch(bank, word)
+		finally:
+			self.release()
+
+		if writes:
+			self.logging.info("---\t-\t--> Switch communication to %s (%i m_dout writes)" % (label, writes))
+
+	def select(self, device):
+		"""Sets communication channel to given device, e.g. 'rotary_valve1'. With a serial
+		port, the channel is latched by the next transaction to the device (not at all if it
+		has a dedicated port)."""
+
+		if not self.channels.has_key(device):
+			raise ValueError("unknown mux channel %r" % device)
+
+		self.channel = device
+
+		if self.serport is not None:
+			self.serport.select(device)
+		else:
+			self.latch_channel(device)
+
+	def set_discrete(self, output, state):
+		"Sets discrete output (e.g. 'V4' or 'mixer') to ON (state 1) or OFF (state 0)."
+
+		bank, bit, label, on, off = self.discretes[output.lower()]
+		self.acquire()
+
+		try:
+			word = list(self.states.get(bank, [0,0,0,0,0]))
+			word[bit] = int(bool(state))
+			self.latch(bank, word)
+			self.states[bank] = word
+		finally:
+			self.release()
+
+		self.logging.info("---\t-\t--> Switch %s to %s" % (label, [off, on][bool(state)]))
+
+#--------------------------------------------------------------------------------------#
+#				COROUTINE VARIANTS				       #
+#--------------------------------------------------------------------------------------#
+#
+# The same switching over an asynchronous Maestro client (async_maestro.py), so the event
+# loop is not blocked while m_dout is written. The shadow register is updated when the
+# commands are queued: the client writes queued bursts in order, so latches of other
+# tasks compile from the state the Maestro will be in.
+#
+
+	def send_co(self, client, commands):
+		"Coroutine variant of send()."
+
+		try:
+			yield client.pipeline(commands)
+		except:
+			self.forget()
+			raise
+
+	def latch_co(self, client, bank, word):
+		"Coroutine variant of latch(); returns the number of m_dout writes."
+
+		if self.latched.get(bank) == list(word):
+			raise Return(0)
+
+		commands, target = self.compile(self.outputs, bank, word)
+		self.outputs[:] = target
+		self.latched[bank] = list(word)
+
+		yield self.send_co(client, commands)
+		raise Return(len(commands))
+
+	def latch_channel_co(self, client, device):
+		"Coroutine variant of latch_channel()."
+
+		bank, word, label = self.channels[device]
+		self.acquire()
+
+		try:
+			writes = yield self.latch_co(client, bank, word)
+		finally:
+			self.release()
+
+		if writes:
+			self.logging.info("---\t-\t--> Switch communication to %s (%i m_dout writes)" % (label, writes))
 
     # Discrete valves
 
 	def discrete_valve4_open(self):
 		"Sets valve V4 to ON state"
-		mux_state_00[0] = 1
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V4 to NO (ligase)")
+		self.set_discrete('V4', 1)
 
 	def discrete_valve4_close(self):
 		"Sets valve V4 to OFF state"
-		mux_state_00[0] = 0
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V4 to NC (ligase buffer)")
+		self.set_discrete('V4', 0)
 
 	def discrete_valve5_open(self):
 		"Sets valve V5 to ON state"
-		mux_state_00[1] = 1
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V5 to NO (from V3 to FC)")
+		self.set_discrete('V5', 1)
 
 	def discrete_valve5_close(self):
 		"Sets valve V5 to OFF state"
-		mux_state_00[1] = 0
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V5 to NC (from mixer to FC)")
+		self.set_discrete('V5', 0)
 
 	def discrete_valve6_open(self):
 		"Sets valve V6 to ON state"
-		mux_state_00[2] = 1
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V6 to NO (through FC 2)") 
+		self.set_discrete('V6', 1)
 
 	def discrete_valve6_close(self):
 		"Sets valve V6 to OFF state"
-		mux_state_00[2] = 0
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V6 to NC (through FC 1)")
+		self.set_discrete('V6', 0)
 
 	def discrete_valve7_open(self):
 		"Sets valve V7 to ON state"
-		mux_state_00[3] = 1
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V7 to NO (dH2O)")
+		self.set_discrete('V7', 1)
 
 	def discrete_valve7_close(self):
 		"Sets valve V7 to OFF state"
-		mux_state_00[3] = 0
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch 3-way discrete valve V7 to NC (air)")
+		self.set_discrete('V7', 0)
 
     	# Reagent mixer
 
 	def mixer_ON(self):
 		"Mixing in mixer: ON"
-		mux_state_00[4] = 1
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Mixing chamber in use")
+		self.set_discrete('mixer', 1)
 
 	def mixer_OFF(self):
 		"Mixing in mixer: OFF"
-		mux_state_00[4] = 0
-		mux_state = ([0,0,0,0,0,1,0,0])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state_00[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state_00[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state_00[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state_00[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state_00[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Mixing chamber is off")
+		self.set_discrete('mixer', 0)
 
     	# Flowcell heater/cooler
 
 	def set_to_temperature_control1(self):
 		"Communication channel set to temperature controller 1"
-		mux_state = ([0,0,0,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to temperature controller 1")
+		self.select('temperature_control1')
 
 	def set_to_temperature_control2(self):
 		"Communication channel set to temperature controller 2"
-		mux_state = ([1,0,0,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to temperature controller 2")
+		self.select('temperature_control2')
 
 	def set_to_reagent_block_cooler(self):
 		"Communication channel set to reagent block cooler"
-		mux_state = ([0,1,0,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to reagent block cooler")
+		self.select('reagent_block_cooler')
 
     	# Rotary valves
 
 	def set_to_rotary_valve1(self):
 		"Communication channel set to rotary valve 1"
-		mux_state = ([0,0,1,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to ten port rotary valve V1")
+		self.select('rotary_valve1')
 
 	def set_to_rotary_valve2(self):
 		"Communication channel set to rotary valve 2"
-		mux_state = ([1,0,1,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to ten port rotary valve V2")
+		self.select('rotary_valve2')
 
 	def set_to_rotary_valve3(self):
 		"Communication channel set to rotary valve 3"
-		mux_state = ([0,1,1,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to ten port rotary valve V3")
+		self.select('rotary_valve3')
 
 	def set_to_rotary_valve4(self):
-		"Communication channel set to rotary valve 3"
-		mux_state = ([1,1,1,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to ten port rotary valve V3")
+		"Communication channel set to rotary valve 4"
+		self.select('rotary_valve4')
 
 
     	# Syringe pump
 
 	def set_to_syringe_pump(self):
 		"Communication channel set to syringe pump"
-		mux_state = ([1,1,0,0,0,1,0,1])
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(mux_state[6]), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(mux_state[7]), '>')
-		mux_state[5] = 0
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		mux_state[5] = 1
-		#self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.logging.info("---\t-\t--> Switch communication to syringe pump")
+		self.select('syringe_pump')
 
 	def __del__(self):
-		mux_state = ([0,0,0,0,0,0])
-		self.session.parse_read_string('m_dout[0]=' + str(mux_state[0]), '>')
-		self.session.parse_read_string('m_dout[1]=' + str(mux_state[1]), '>')
-		self.session.parse_read_string('m_dout[2]=' + str(mux_state[2]), '>')
-		self.session.parse_read_string('m_dout[3]=' + str(mux_state[3]), '>')
-		self.session.parse_read_string('m_dout[4]=' + str(mux_state[4]), '>')
-		self.session.parse_read_string('m_dout[5]=' + str(mux_state[5]), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(1), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(1), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(0), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(0), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(1), '>')
-		self.session.parse_read_string('m_dout[7]=' + str(0), '>')
-		self.session.parse_read_string('m_dout[6]=' + str(0), '>')
-		return
+		Mux.live_lock.acquire()
+		Mux.live -= 1
+		last = Mux.live == 0
+		Mux.live_lock.release()
+
+		if not last:			# outputs still in use by the other flowcell's Mux
+			return
+
+		self.acquire()
+
+		try:
+			self.write_outputs([(0,0), (1,0), (2,0), (3,0), (4,0), (5,0),	# strobe low, sweep all banks to zero
+					    (6,1), (7,1), (6,0), (7,0), (6,1), (7,0), (6,0)])
+
+			for bank in [(0,0), (1,0), (0,1), (1,1)]:
+				self.latched[bank] = [0,0,0,0,0]
+
+			self.states.clear()	# discrete outputs are off now
 
+			if self.arbiter is not None:
+				self.arbiter.channel = None
+		finally:
+			self.release()
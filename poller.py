@@ -0,0 +1,106 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Poller, containing
+ the adaptive polling engine used to wait for a measured value (e.g. flowcell
+ temperature) to reach a target in Python.
+
+ The poll interval follows the estimated time to reach the target band: the
+ distance left divided by the observed ramp rate, times 'poll_fraction'. Far
+ from the target, or while the value moves away, the serial line is left free
+ for the other flowcell; close to the target the interval shrinks down to
+ 'poll_min_interval', so reaching the band is detected as fast as before.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+
+class Poller:
+
+	def __init__(self, read, config):
+		"""Initialize polling engine object on function read() returning the current value,
+		with interval limits from the [biochem_parameters] section of config."""
+
+		self.read = read
+		self.min_interval = float(config.get("biochem_parameters","poll_min_interval"))
+		self.max_interval = float(config.get("biochem_parameters","poll_max_interval"))
+		self.fraction = float(config.get("biochem_parameters","poll_fraction"))
+
+		self.samples = []	# (time, value) of the current wait
+		self.interval = self.min_interval
+
+	def sample(self):
+		"Reads and records one sample; returns its value."
+
+		value = self.read()
+		self.samples.append((time.time(), value))
+		return value
+
+	def rate(self, window=4):
+		"Returns the ramp rate (units per second) fitted to the last samples, None if unknown."
+
+		points = self.samples[-window:]
+
+		if len(points) < 2:
+			return None
+
+		n = len(points)
+		t_mean = sum([t for t, value in points]) / n
+		v_mean = sum([value for t, value in points]) / n
+		variance = sum([(t - t_mean) ** 2 for t, value in points])
+
+		if variance == 0:
+			return None
+		return sum([(t - t_mean) * (value - v_mean) for t, value in points]) / variance
+
+	def next_interval(self, target, tolerance):
+		"Returns seconds to the next sample, from the distance to the target band and the ramp rate."
+
+		value = self.samples[-1][1]
+		distance = abs(target - value) - tolerance
+		rate = self.rate()
+
+		if rate is None:
+			self.interval = self.min_interval	# no rate yet - second sample soon
+		else:
+			if target < value:
+				rate = -rate			# rate toward the target
+
+			if rate > 0:
+				self.interval = self.fraction * distance / rate
+			else:
+				self.interval = 2 * self.interval	# not approaching (yet) - back off
+
+		self.interval = max(self.min_interval, min(self.max_interval, self.interval))
+		return self.interval
+
+	def wait_until(self, target, tolerance, timeout, progress=None):
+		"""Samples until the value is within tolerance of target (or has passed it, coming
+		from the side of the first sample), or timeout seconds passed; progress(elapsed
+		seconds, value) is called after each sample. Returns (last value, True if target
+		was reached)."""
+
+		self.samples = []
+		self.interval = self.min_interval
+		t0 = time.time()
+		value = self.sample()
+		side = cmp(target, value)
+
+		while abs(target - value) > tolerance and cmp(target, value) == side:
+			elapsed = time.time() - t0
+
+			if elapsed > timeout:
+				return (value, False)
+
+			time.sleep(min(self.next_interval(target, tolerance), max(0.0, timeout - elapsed) + self.min_interval))
+			value = self.sample()
+
+			if progress is not None:
+				progress(time.time() - t0, value)
+
+		return (value, True)
@@ -24,52 +24,40 @@ import ConfigParser
 from threading import Thread
 from logger import Logger
 
-from tel_net import Tel_net
+import readiness
+from maestro import get_maestro
+from event_loop import start_loop
+from status_service import Status_service, OFF, ON, BLINK
+from thermal_service import start_service
 import PolonatorImager
 from biochem import Biochem
 
 print '\nINFO\t ***\t*\t--> START POLONATOR MAIN - polonator_main.py'
 print 'INFO\t ***\t*\t--> Please, slide your hand across touch sensor to activate POLONATOR\n'
 
-print 'ping', commands.getstatusoutput('ping -c 1 10.0.0.56')
-
-error = 0
-packet_loss = 0
-while (error != (-1) and packet_loss != (-1)):
-	ping_reply = commands.getstatusoutput('ping -c 1 10.0.0.56')
-	find_string = ping_reply
-	find_string = str(find_string)
-	error = find_string.find('error')
-	packet_loss = find_string.find('100% packet loss')
-	time.sleep(10)
-
-time.sleep(1)
-session = Tel_net()
-x_hmstat = 1
-y_hmstat = 1
-
-while (x_hmstat != 0 and y_hmstat != 0):
-	x_hmstat = session.parse_read_string('x.hmstat', '>')
-	x_hmstat = x_hmstat.strip('>')
-	x_hmstat = x_hmstat.strip()
-	x_hmstat = int(x_hmstat)
-	y_hmstat = session.parse_read_string('y.hmstat', '>')
-	y_hmstat = y_hmstat.strip('>')
-	y_hmstat = y_hmstat.strip()
-	y_hmstat = int(y_hmstat)
-	time.sleep(0.1)
-
 config = ConfigParser.ConfigParser()
 config.readfp(open('config.txt'))
 home_dir = config.get("communication","home_dir")
 
+waited = readiness.wait_for_controller(config)	# Maestro telnet port accepts connections (127.0.0.1 with testing/maestro_emulator.py)
+print 'INFO\t ***\t*\t--> Maestro controller ready at %s after %0.1f s' % (config.get("communication","maestro_address"), waited)
+
+session = get_maestro(None, config)	# process-wide Maestro client of the Mux of each Biochem and the homing poll
+waited = readiness.wait_for_homing(session, config)
+print 'INFO\t ***\t*\t--> Stages homed after %0.1f s' % waited
+
 logger = Logger(config)         # initialize logger object
 one_time_through=1
 
+loop = start_loop(logger)				# runs the status and thermal services in one background thread
+status = Status_service(loop, config, logger)		# status LEDs and touch sensor, written/sampled in the background
+status.start()
+thermal = start_service(config, logger)			# temperature reads, waits and telemetry of all controllers
+
 while (True):
-	touch_sensor = int(session.parse_read_string('m_din[7]', '>').strip('>').strip())
+	touch_sensor = status.wait_for_touch(0.1)	# touch sensor activated within 0.1 s
 
-#	if (touch_sensor == 1):
+#	if (touch_sensor):
 	if (one_time_through==1):
 		one_time_through = 0
 		#commands.getstatusoutput('mplayer -ao alsa speech/welcome.wav')
@@ -114,10 +102,9 @@ while (True):
 					biochem = Biochem(cycle_list[cycle_number], flowcell, logger)
 					biochem.start()
 					
-					while(biochem.isAlive()):
-						session.parse_read_string('y.ob[2]=1', '>')
-						session.parse_read_string('y.ob[2]=0', '>')
-						time.sleep(0.1)
+					status.set_led(2, BLINK)
+					biochem.join()
+					status.set_led(2, OFF)
 
 
 #				if(cycle_list[cycle_number] == 'WL1'):
@@ -126,10 +113,9 @@ while (True):
 #					imager = PolonatorImager.Imager(cycle_list[cycle_number], flowcell)
 #					imager.start()
 #
-#					while(imager.isAlive()):
-#						session.parse_read_string('y.ob[1]=1', '>')
-#						session.parse_read_string('y.ob[1]=0', '>')
-#						time.sleep(0.1)
+#					status.set_led(1, BLINK)
+#					imager.join()
+#					status.set_led(1, OFF)
 
 		if (installed_flowcells == 2):
 			while (cycle_number <= cycle_list_length):
@@ -161,28 +147,22 @@ while (True):
 					imager.start()
 					cycle_number = cycle_number + 1
 
-				session.parse_read_string('y.ob[1]=0', '>')
-				session.parse_read_string('y.ob[2]=0', '>')
+				status.set_led(1, OFF)
+				status.set_led(2, OFF)
 
 				if (cycle_number == 0 and flowcell == 1):
 					while(biochem.isAlive()):
-						if (biochem.isAlive()):
-							session.parse_read_string('y.ob[2]=1', '>')
-							time.sleep(0.1)
+						status.set_led(2, ON)
+						time.sleep(0.1)
 				else:
 					while(imager.isAlive() or biochem.isAlive()):
-						if (imager.isAlive()):
-							session.parse_read_string('y.ob[1]=1', '>')
-							time.sleep(0.1)
-
-						if (biochem.isAlive()):
-							session.parse_read_string('y.ob[2]=1', '>')
-							time.sleep(0.1)
+						status.set_led(1, [OFF, ON][imager.isAlive()])	# LED states are in memory, written on change
+						status.set_led(2, [OFF, ON][biochem.isAlive()])
+						time.sleep(0.1)
 				time.sleep(0.1)
 
-	session.parse_read_string('y.ob[1]=0', '>')
-	session.parse_read_string('y.ob[2]=0', '>')
-	time.sleep(0.1)
+	status.set_led(1, OFF)
+	status.set_led(2, OFF)
 
 delta = (time.time() - t0) / 60         # calculate elapsed time for polony sequencing cycles
 logger.warn("***\t*\t--> Finished polony sequencing - duration: %0.2f minutes\n" % delta)
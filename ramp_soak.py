@@ -0,0 +1,198 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Ramp_soak,
+ containing ramp/soak programs of a flowcell temperature controller (e.g. the
+ step-up ligation staircase) in Python.
+
+ The PR-59 has no profile memory, so the program runs in a thread of its own,
+ on the serial port and mux of the Biochem thread, which hands over all steps
+ at once and only monitors completion (no transactions of its own meanwhile). Each step ramps to its
+ target and soaks there:
+
+		 1. with a fitted thermal model, the overshoot setpoint is written and
+		    the controller left alone until shortly before the predicted time
+		    to the poll temperature; then the poll temperature is confirmed
+		    and the setpoint set back to the target
+		 2. without one, the configured set/poll temperature pair is polled
+		    as in Biochem.ramp_temperature()
+		 3. soaks take no serial transactions at all
+
+ Temperatures come from the thermal service, or from the telemetry sampler
+ while its samples are fresh.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+import threading
+
+from poller import Poller
+from thermal_model import get_model
+from temperature_control import Temperature_control
+import thermal_service
+
+RAMP = 'ramp'		# program phases
+SOAK = 'soak'
+DONE = 'done'
+
+LEAD = 0.8		# fraction of the predicted ramp time left without reads
+
+class Ramp_soak(threading.Thread):
+
+	def __init__(self, device, steps, config, serial_port, mux, logger=None):
+		"""Initialize ramp/soak program object of given controller, e.g. 'temperature_control1',
+		with steps [(target, set temperature, poll temperature, soak minutes)], on the serial
+		port and mux of the calling Biochem thread; start() runs it."""
+
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+
+		if logger is not None:
+			self.logging = logger
+
+		self.device = device
+		self.steps = steps
+		self.tolerance = float(config.get("biochem_parameters","temp_tolerance"))
+		self.time_limit = float(config.get("biochem_parameters","time_limit")) * 60
+		self.use_model = int(config.get("thermal_model","use_model"))
+		self.model = get_model(device, config)
+
+		self.ser = serial_port		# a Serial_port opens every routed tty - borrow the caller's
+		self.mux = mux
+		self.temperature_control = Temperature_control(config, self.ser, logger)
+		self.poller = Poller(self.read_temperature, config)
+
+		self.step = 0			# current step and phase
+		self.phase = RAMP
+		self.reads = 0			# statistics: temperature reads on the serial line
+		self.error = None		# exception that ended the program
+		self.finished = threading.Event()
+		self.stopped = threading.Event()
+
+	def read_temperature(self):
+		"Returns flowcell temperature: from the thermal service if it runs, else read from the controller."
+
+		service = thermal_service.current
+
+		if service is not None:
+			return service.read(self.device)
+
+		self.mux.select(self.device)
+		self.reads += 1
+		return self.temperature_control.get_temperature()
+
+	def set_temperature(self, temperature):
+		"Sets the controller setpoint (C)."
+
+		self.mux.select(self.device)
+		self.temperature_control.set_temperature(temperature)
+
+	def ramp(self, target, set_temp, poll_temp):
+		"Ramps flowcell temperature to target, unless it is there already."
+
+		t0 = self.read_temperature()
+
+		if abs(target - t0) <= self.tolerance:
+			return
+
+		plan = None
+
+		if self.use_model:
+			plan = self.model.choose(t0, target, self.tolerance)
+
+		tolerance = self.tolerance
+
+		if plan is not None:
+			set_temp, poll_temp, eta = plan
+			tolerance = 0.1		# set back to target right at the poll temperature
+
+		t_set = time.time()
+		self.set_temperature(set_temp)
+
+		try:
+			if plan is not None and eta is not None:
+				if self.stopped.wait(LEAD * eta):
+					return
+
+			tc = self.read_temperature()
+
+			if (set_temp - poll_temp >= 0 and poll_temp >= tc) or (set_temp - poll_temp < 0 and poll_temp <= tc):	# poll temperature still ahead of the ramp
+				service = thermal_service.current
+
+				if service is not None:
+					tc, reached = service.wait_until(self.device, poll_temp, tolerance, self.time_limit)
+				else:
+					tc, reached = self.poller.wait_until(poll_temp, tolerance, self.time_limit)
+
+				if not reached and hasattr(self, 'logging'):
+					self.logging.warn("---\t-\t--> Ramp/soak %s: time limit exceeded -> [current: %0.2f, target: %0.2f] C" % (self.device, tc, poll_temp))
+
+			service = thermal_service.current
+			samples = self.poller.samples
+
+			if service is not None:
+				samples = service.samples(self.device, t_set)
+
+			self.model.fit(t0, set_temp, t_set, samples)
+		finally:
+			if plan is not None:
+				self.set_temperature(target)	# hold at target, also on stop() or a failed read
+
+	def transition(self, phase):
+		"Enters given phase of the current step."
+
+		self.phase = phase
+
+		if hasattr(self, 'logging'):
+			self.logging.info("---\t-\t--> Ramp/soak %s: step %i of %i %s" % (self.device, self.step + 1, len(self.steps), phase))
+
+	def run(self):
+		"Runs the steps until done or stop() is called."
+
+		try:
+			for step in range(len(self.steps)):
+				target, set_temp, poll_temp, soak = self.steps[step]
+				self.step = step
+
+				self.transition(RAMP)
+				self.ramp(target, set_temp, poll_temp)
+
+				if self.stopped.isSet():
+					break
+
+				self.transition(SOAK)
+
+				if self.stopped.wait(soak * 60):
+					break
+
+			self.transition(DONE)
+		except Exception, e:
+			self.error = e
+
+			if hasattr(self, 'logging'):
+				self.logging.error("---\t-\t--> Ramp/soak %s: %s" % (self.device, e))
+
+		self.finished.set()
+
+	def wait(self, timeout=None):
+		"""Returns True once the program finished, False if timeout seconds passed first;
+		raises the exception that ended the program, if any."""
+
+		if not self.finished.wait(timeout):
+			return False
+
+		if self.error is not None:
+			raise self.error
+		return True
+
+	def stop(self):
+		"""Stops the program thread; an overshoot setpoint is set back to the target of its
+		step, any other setpoint is left as it is."""
+
+		self.stopped.set()
+		self.join()
@@ -0,0 +1,87 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the readiness checks of the instrument run by
+ polonator_main before sequencing in Python:
+
+		 1. the Maestro controller accepts connections on its telnet port
+		    (non-blocking TCP connect with a short timeout, no ping process)
+		 2. both stages are homed (x.hmstat and y.hmstat read 0)
+
+ Both are polled with exponential backoff from 'ready_poll_interval' up to
+ 'ready_max_interval' seconds, and return as soon as the condition holds.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+import errno
+import socket
+import select
+
+from tel_net import Telnet_error, Telnet_timeout
+
+class Backoff:
+
+	def __init__(self, config):
+		"Initialize poll interval object doubling from ready_poll_interval up to ready_max_interval."
+
+		self.interval = float(config.get("communication","ready_poll_interval"))
+		self.max_interval = float(config.get("communication","ready_max_interval"))
+
+	def wait(self):
+		"Sleeps the current interval, then doubles it."
+
+		time.sleep(self.interval)
+		self.interval = min(2 * self.interval, self.max_interval)
+
+def probe(address, port, timeout):
+	"Returns True if a TCP connection to address:port is accepted within timeout seconds."
+
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setblocking(0)
+
+	try:
+		error = sock.connect_ex((address, port))
+
+		if error == errno.EINPROGRESS:
+			if not select.select([], [sock], [], timeout)[1]:
+				return False
+			error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		return error == 0
+	finally:
+		sock.close()
+
+def wait_for_controller(config):
+	"Waits until the Maestro accepts connections on its telnet port; returns seconds waited."
+
+	address = config.get("communication","maestro_address")
+	port = int(config.get("communication","maestro_port"))
+	timeout = float(config.get("communication","ready_probe_timeout"))
+	backoff = Backoff(config)
+	t0 = time.time()
+
+	while not probe(address, port, timeout):
+		backoff.wait()
+	return time.time() - t0
+
+def wait_for_homing(session, config):
+	"""Waits until both stages are homed, reading x.hmstat and y.hmstat in one burst per
+	poll; returns seconds waited. A failed read is retried on the next poll."""
+
+	backoff = Backoff(config)
+	t0 = time.time()
+
+	while True:
+		try:
+			x_hmstat, y_hmstat = [int(reply.strip('>').strip()) for reply in session.pipeline(['x.hmstat', 'y.hmstat'])]
+		except (Telnet_error, Telnet_timeout, EOFError, socket.error, ValueError):
+			x_hmstat = y_hmstat = None
+
+		if x_hmstat == 0 and y_hmstat == 0:
+			return time.time() - t0
+		backoff.wait()
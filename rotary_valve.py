@@ -16,6 +16,11 @@
 ------------------------------------------------------------------------------- 
 """
 
+import time
+
+from serial_port import Serial_timeout
+from serial_codec import Rheodyne_codec
+
 class Rotary_valve:
 
 	global serport;
@@ -26,6 +31,10 @@ class Rotary_valve:
 		self._baud_rate = int(config.get("communication","rotary_valve_baud"))
 		self._read_length = int(config.get("communication","read_length"))
 		self._sleep_time = float(config.get("communication","sleep_time"))
+		self._busy_poll_interval = float(config.get("communication","busy_poll_interval"))
+		self._busy_timeout = float(config.get("communication","busy_timeout"))
+
+		self.codec = Rheodyne_codec()
 
 		if logger is not None:
 			self.logging = logger
@@ -57,11 +66,13 @@ class Rotary_valve:
 		valve_position_string = 'P' + valve_position + '\r'
 
 		self.serport.write_serial(valve_position_string)
+		t_end = time.time() + self._busy_timeout
 
-		find_string = valve_position
-		response_string_size = 2
+		while self.serport.transaction(self.codec, 'S\r') != valve_position:	# poll position until the move is finished
 
-		self.serport.parse_read_string('S\r', find_string, response_string_size)
+			if time.time() > t_end:
+				raise Serial_timeout("rotary valve did not reach position %s within %0.1f s" % (valve_position, self._busy_timeout))
 
-		self.logging.info("---\t-\t--> Set rotary valve to position %s" % valve_position)
+			time.sleep(self._busy_poll_interval)
 
+		self.logging.info("---\t-\t--> Set rotary valve to position %s" % valve_position)
@@ -0,0 +1,183 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for the serial framing layer,
+ containing request/response codecs for the Cavro XCalibur syringe pump, the
+ Rheodyne rotary valves and the PR-59 temperature controllers in Python.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import re
+
+from serial_port import Device_error
+
+#--------------------------------------------------------------------------------------#
+#				FRAME DECODER					       #
+#--------------------------------------------------------------------------------------#
+#
+# A codec splits the raw byte stream coming from a device into frames (incremental,
+# bytes may arrive in any number of pieces), decides which frame is the reply to the
+# command just written, and parses that reply. Serial_port.transaction() uses a codec
+# to do exactly one write and one parsed read per logical transaction.
+#
+
+class Frame_codec:
+
+	terminator = '\r'
+
+	def __init__(self):
+		"Initialize codec object with an empty receive buffer."
+		self.buffer = ''
+
+	def reset(self):
+		"Drops any partial frame left in the receive buffer."
+		self.buffer = ''
+
+	def encode(self, command):
+		"Returns the byte string written to the device for the given command."
+
+		if not command.endswith('\r'):
+			command = command + '\r'
+		return command
+
+	def feed(self, data):
+		"Appends received bytes to the buffer and returns the list of completed frames."
+
+		self.buffer = self.buffer + data
+		frames = []
+
+		while True:
+			end = self.buffer.find(self.terminator)
+
+			if end < 0:
+				break
+
+			frames.append(self.buffer[:end].strip('\r\n'))
+			self.buffer = self.buffer[end + len(self.terminator):]
+		return frames
+
+	def accept(self, frame, command):
+		"Returns True if the frame is the reply to the given command."
+		return frame != ''
+
+	def opcode(self, command):
+		"Returns the command name used to key latency statistics."
+		return command.strip()[:1]
+
+	def decode(self, frame):
+		"Parses an accepted reply frame."
+		return frame
+
+#--------------------------------------------------------------------------------------#
+#			Cavro XCalibur syringe pump CODEC			       #
+#--------------------------------------------------------------------------------------#
+#
+# Replies have the form '/0' + status byte + data + ETX (followed by CR LF). Status bit 5
+# is set when the pump is ready (idle), the low nibble carries the error code.
+#
+
+class Cavro_codec(Frame_codec):
+
+	terminator = chr(3)	# ETX
+
+	errors = {1 : 'initialization error',
+		  2 : 'invalid command',
+		  3 : 'invalid operand',
+		  4 : 'invalid command sequence',
+		  6 : 'EEPROM failure',
+		  7 : 'device not initialized',
+		  9 : 'plunger overload',
+		  10 : 'valve overload',
+		  11 : 'plunger move not allowed',
+		  15 : 'command overflow'}
+
+	def accept(self, frame, command):
+		"Returns True for a complete pump reply frame."
+		return frame.find('/0') >= 0
+
+	def opcode(self, command):
+		"Returns the command letters without operands, e.g. 'A' for '/1A1500R'."
+		return re.sub(r'[-\d]', '', command.strip()[2:]).rstrip('R') or 'R'
+
+	def decode(self, frame):
+		"Returns reply as a (ready, data) tuple; raises Device_error on pump error status."
+
+		frame = frame[frame.find('/0'):]
+		status = ord(frame[2])
+		error = status & 0x0F
+
+		if error != 0:
+			raise Device_error("syringe pump error %i: %s" % (error, self.errors.get(error, 'unknown error')))
+		return ((status & 0x20) != 0, frame[3:])
+
+#--------------------------------------------------------------------------------------#
+#			   Rheodyne rotary valve CODEC				       #
+#--------------------------------------------------------------------------------------#
+#
+# Replies are CR terminated; a position query 'S' returns the current port as two
+# upper-case hexadecimal digits.
+#
+
+class Rheodyne_codec(Frame_codec):
+
+	terminator = '\r'
+
+	def decode(self, frame):
+		"Returns reply with surrounding white space removed."
+		return frame.strip()
+
+#--------------------------------------------------------------------------------------#
+#			 PR-59 temperature controller CODEC			       #
+#--------------------------------------------------------------------------------------#
+#
+# Replies are CR (LF) terminated. The controller may echo the command before answering
+# a register query, so for queries ('?') the echo frame is skipped.
+#
+
+class PR59_codec(Frame_codec):
+
+	terminator = '\r'
+
+	number = re.compile(r'[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?')
+
+	def accept(self, frame, command):
+		"Returns True for the reply frame, skipping empty frames and query echoes."
+
+		if frame == '':
+			return False
+
+		if command.find('?') >= 0 and frame == command.strip():
+			return False
+		return True
+
+	def opcode(self, command):
+		"Returns the command up to its operand, e.g. '$R0=' for '$R0=52' and '$R100?'."
+
+		command = command.strip()
+		end = command.find('=')
+
+		if end >= 0:
+			return command[:end + 1]
+		return command
+
+	def read_register(self, register):
+		"Returns the query command of given register, e.g. '$R100?' for register 100."
+		return '$R%i?\r' % register
+
+	def write_register(self, register, value):
+		"Returns the command setting given register to value, e.g. '$R0=52' for register 0."
+		return '$R%i=%s\r' % (register, value)
+
+	def value(self, frame):
+		"Parses the register value, a float, from a query reply frame."
+
+		numbers = self.number.findall(frame)
+
+		if not numbers:
+			raise Device_error("temperature controller reply %r holds no value" % frame)
+		return float(numbers[-1])
@@ -17,8 +17,35 @@
 """
 
 import time
+import select
 import serial
 
+from latency import Latency_histogram
+from bus_arbiter import get_arbiter
+from wire_capture import open_capture, WRITE, READ
+from event_loop import Readable, Return, Sleep
+
+class Serial_error(Exception):
+	"Raised when a serial device transaction cannot be completed."
+	pass
+
+class Serial_timeout(Serial_error):
+	"Raised when a serial device does not answer before the read deadline."
+	pass
+
+class Device_error(Serial_error):
+	"Raised when a serial device reports an error in its reply."
+	pass
+
+class Retry_policy:
+
+	def __init__(self, attempts, interval):
+		"""Initialize retry policy object: a transaction is written at most 'attempts' 
+		times, waiting 'interval' seconds after each timed out attempt."""
+
+		self.attempts = attempts
+		self.interval = interval
+
 class Serial_port:
 
 	global ser
@@ -29,16 +56,40 @@ class Serial_port:
 		if logger is not None:			# if defined, place logger into Biochem
 			self.logging = logger
 
-		self.ser = serial.Serial(port = config.get("communication","serial_port"),
-					 bytesize = serial.EIGHTBITS,
-					 parity = serial.PARITY_NONE,
-					 stopbits = serial.STOPBITS_ONE,
-					 timeout = float(config.get("communication","timeout")))
+		self._timeout = float(config.get("communication","timeout"))
+		self._read_deadline = float(config.get("communication","read_deadline"))	# seconds to wait for a device reply
+		self.retry_policy = Retry_policy(int(config.get("communication","retry_attempts")),
+						 float(config.get("communication","retry_interval")))
+
+		self.shared = self.open_port(config.get("communication","serial_port"))	# line shared by all devices behind the mux
+		self.ser, self.poller, self.arbiter = self.shared
+		self.routed = False
+		self.device = None		# device addressed by the following transactions
+		self.mux = None			# set by the Mux latching channels of the shared line
+		self.queue = None		# set by the Command_queue holding commands back for this port
+
+		# Optional dedicated port per device: these devices need no mux or baud switching
+
+		device_baud = {'syringe_pump' : int(config.get("communication","syringe_pump_baud")),
+			       'rotary_valve' : int(config.get("communication","rotary_valve_baud")),
+			       'temperature_control' : int(config.get("communication","temperature_control_baud")),
+			       'reagent_block_cooler' : int(config.get("communication","temperature_control_baud"))}
+
+		self.routes = {}
+
+		if config.has_section("serial_routing"):
+			for device, port in config.items("serial_routing"):
+				self.routes[device] = self.open_port(port, device_baud[device.rstrip('1234')])
+				self.logging.info("---\t-\t--> Route %s to dedicated serial port %s" % (device, port))
 
 		self.device_bauds = {int(config.get("communication","temperature_control_baud")) : "temperature controller", 
 							 int(config.get("communication","syringe_pump_baud")) : "syringe pump",
 							 int(config.get("communication","rotary_valve_baud")) : "rotary valve"}
 
+		self.baud = None		# baud rate of the device addressed last
+		self.latency = Latency_histogram()	# per device and opcode transaction latencies
+		self.capture = open_capture(config)	# binary record of all traffic, None if off
+
 		self.logging.info("---\t-\t--> Serial port object constructed")
 
 #--------------------------------------------------------------------------------------#
@@ -49,55 +100,357 @@ class Serial_port:
 # Only one port can be read from, written to at a time. That is, ser.close() must 
 # be called before talking to a different piece of hardware with the ser.open() command.
 #
+# In two-flowcell mode each Biochem thread has its own Serial_port on the same tty, so
+# every write and transaction holds the port's lease (bus_arbiter.py) from latching the
+# mux channel and setting the line speed until the reply is read.
+#
+
+	def open_port(self, port, baudrate=9600):
+		"""Returns given serial port together with its poll object and bus arbiter. The tty
+		is opened by the first Serial_port on it; the others of the process share its handle."""
+
+		arbiter = get_arbiter(port)
+		arbiter.acquire()	# opening reconfigures the line other threads may be using
+
+		try:
+			if arbiter.handle is None:
+				ser = serial.Serial(port = port,
+						    baudrate = baudrate,
+						    bytesize = serial.EIGHTBITS,
+						    parity = serial.PARITY_NONE,
+						    stopbits = serial.STOPBITS_ONE,
+						    timeout = self._timeout)
+				arbiter.baud = baudrate
+
+				poller = select.poll()	# wakes up the reader on data arrival instead of spinning on inWaiting()
+				poller.register(ser.fileno(), select.POLLIN | select.POLLPRI)
+				arbiter.handle = (ser, poller)
+
+			arbiter.users += 1
+			ser, poller = arbiter.handle
+		finally:
+			arbiter.release()
+
+		return (ser, poller, arbiter)
+
+	def close_port(self, port):
+		"Releases given (serial, poll object, arbiter); the tty is closed by the last Serial_port using it."
+
+		ser, poller, arbiter = port
+		arbiter.condition.acquire()	# not the lease - the last user has no transaction in progress
+
+		try:
+			arbiter.users -= 1
+
+			if arbiter.users == 0:
+				arbiter.handle = None
+				ser.close()
+		finally:
+			arbiter.condition.release()
+
+	def route(self, device):
+		"""Directs following transactions to the given device (e.g. 'rotary_valve1'). 
+		Returns True if the device has a dedicated port, i.e. no mux switching is needed, 
+		otherwise selects the shared port and returns False."""
+
+		if self.routes.has_key(device):
+			self.ser, self.poller, self.arbiter = self.routes[device]
+			self.routed = True
+		else:
+			self.ser, self.poller, self.arbiter = self.shared
+			self.routed = False
+		return self.routed
+
+	def select(self, device):
+		"""Addresses following transactions to the given device; its mux channel is latched
+		when the next transaction holds the line lease."""
+
+		self.device = device
+		return self.route(device)
 
 	def set_baud(self, baudrate):
-		"Sets serial port's baud rate as defined in configuration file."
-		self.ser.setBaudrate(baudrate)
+		"""Sets serial port's baud rate as defined in configuration file; the line speed is
+		changed when the next transaction holds the line lease."""
+
+		self.baud = baudrate
 		#self.logging.info("---\t-\t--> Set serial port baud rate to %i for %s" % (baudrate, self.device_bauds[baudrate]))
 
+	def acquire(self):
+		"""Leases the current port (reentrant; threads are served first come, first served),
+		then latches the mux channel and line speed of the addressed device unless the line
+		is already set to them. Commands still held back by the command queue go first, so
+		a direct driver call never overtakes them."""
+
+		if self.queue is not None and self.queue.pending:
+			self.queue.flush()
+
+		self.arbiter.acquire()
+
+		try:
+			if not self.routed and self.mux is not None and self.device is not None and self.arbiter.channel != self.device:
+				self.mux.latch_channel(self.device)
+				self.arbiter.channel = self.device
+
+			if self.baud is not None and self.arbiter.baud != self.baud:	# dedicated ports are opened at their device's baud rate
+				self.ser.setBaudrate(self.baud)
+				self.arbiter.baud = self.baud
+		except:
+			self.arbiter.release()
+			raise
+
+	def release(self):
+		"Releases the lease taken by acquire()."
+		self.arbiter.release()
+
 	def flush_input(self):
 		"Flush the input buffer of the serial port."
-		self.ser.flushInput()
+
+		self.acquire()
+
+		try:
+			self.ser.flushInput()
+		finally:
+			self.release()
+
 		self.logging.info("---\t-\t--> Flushed serial port input buffer")
 
 	def write_serial(self, data):
 		"Flush input buffer, then write string data to serial port."
-		self.ser.flushInput()
-		self.ser.write(data)
-
-	def parse_read_string(self, write_string, find_string, find_string_size):
-		"Will read and parse string responses which return program code from the device."
-
-		self.ser.flushInput()
-		read_string_char = '-1'
-
-		while read_string_char == '-1':
-			self.write_serial(write_string)
-      			read_chars = self.read_serial(find_string_size)
-			read_string = read_chars.find(find_string)
-      			read_string_char = str(read_string)
-			time.sleep(0.001)
-			self.logging.info("---\t-\t--> Read Chars %s" % (read_chars))
-		return read_chars
 
-	def read_serial(self, num_expected):
-		"""Return the number of chars in the receive buffer and compare it to expected
-		character number passed as an argument."""
-
-		total_received = 0
-		read_chars = ""	
-	
-		while total_received < num_expected:
-			iw = self.ser.inWaiting()
-
-			if iw > num_expected:
-				iw = num_expected
-			read_chars = read_chars + self.ser.read(iw)
-			total_received += iw
-			time.sleep(0.001)
+		self.acquire()
+
+		try:
+			self.ser.flushInput()
+			self.ser.write(data)
+
+			if self.capture is not None:
+				self.capture.record(self.device or self.ser.portstr, WRITE, data)
+		finally:
+			self.release()
+
+	def read_available(self, ser, limit=None):
+		"Reads the characters waiting on given port (at least one, at most limit)."
+
+		iw = max(ser.inWaiting(), 1)
+
+		if limit is not None:
+			iw = min(iw, limit)
+
+		data = ser.read(iw)
+
+		if self.capture is not None:
+			self.capture.record(self.device or ser.portstr, READ, data)
+		return data
+
+	def transaction(self, codec, command, policy=None, deadline=None):
+		"""Writes command once and returns the codec-parsed reply frame. If no reply
+		arrives before the read deadline, the command is re-sent according to the retry 
+		policy; once all attempts are used up, Serial_timeout is raised."""
+
+		if policy is None:
+			policy = self.retry_policy
+
+		self.acquire()
+
+		try:
+			t0 = time.time()
+
+			for attempt in range(1, policy.attempts + 1):
+				codec.reset()
+				self.write_serial(codec.encode(command))
+
+				try:
+					reply = self.read_frame(codec, command, deadline)
+					self.latency.record((self.device_bauds.get(self.baud, str(self.baud)), codec.opcode(command)), time.time() - t0)
+					return reply
+
+				except Serial_timeout, e:
+					if attempt == policy.attempts:
+						raise
+
+					self.logging.warn("---\t-\t--> Serial command %r attempt %i of %i timed out: %s" % (command, attempt, policy.attempts, e))
+					time.sleep(policy.interval)
+		finally:
+			self.release()
+
+	def read_frame(self, codec, command, deadline=None):
+		"""Feeds received characters to codec until it yields the reply frame for the
+		given command and returns the parsed reply; raises Serial_timeout on deadline."""
+
+		if deadline is None:
+			deadline = self._read_deadline
+
+		t_end = time.time() + deadline
+
+		while True:
+			remaining = t_end - time.time()
+
+			if remaining <= 0 or not self.poller.poll(remaining * 1000):
+				raise Serial_timeout("no reply to %r within %0.2f s - received %r" % (command, deadline, codec.buffer))
+
+			for frame in codec.feed(self.read_available(self.ser)):
+				if codec.accept(frame, command):
+					return codec.decode(frame)
+
+	def read_serial(self, num_expected, deadline=None):
+		"""Block until the expected number of characters has been received and return
+		them. The reader sleeps in poll() until data arrives; if the device does not
+		answer within 'deadline' seconds (default from configuration file), raises
+		Serial_timeout."""
+
+		if deadline is None:
+			deadline = self._read_deadline
+
+		t_end = time.time() + deadline
+		read_chars = ""
+
+		self.acquire()
+
+		try:
+			while len(read_chars) < num_expected:
+				remaining = t_end - time.time()
+
+				if remaining <= 0 or not self.poller.poll(remaining * 1000):
+					raise Serial_timeout("no reply within %0.2f s - expected %i, received %i chars %r" % (deadline, num_expected, len(read_chars), read_chars))
+
+				read_chars = read_chars + self.read_available(self.ser, num_expected - len(read_chars))
+		finally:
+			self.release()
 		return read_chars
 
+	def dump_latency(self, reset=False):
+		"Logs the transaction latency histogram summary of every device and opcode."
+
+		self.logging.info("---\t-\t--> Serial transaction latencies:")
+
+		for line in self.latency.summary():
+			self.logging.info("---\t-\t--> %s" % line)
+
+		if reset:
+			self.latency.reset()
+
 	def __del__(self):
-		"Destructs serial port object - it closes any open session."
-		self.ser.close()
+		"Destructs serial port object - it closes any session no other Serial_port uses."
+
+		self.close_port(self.shared)
+
+		for port in self.routes.values():
+			self.close_port(port)
+
+
+#--------------------------------------------------------------------------------------#
+#				ASYNCHRONOUS TRANSPORT				       #
+#--------------------------------------------------------------------------------------#
+#
+# Coroutine (event_loop.py) variant of the transaction layer for the services on the
+# process-wide loop: only the temperature polling of the thermal service runs on it, the
+# Biochem fluidics keep the blocking drivers. A task waiting for a reply yields the loop
+# (not the line) to the other tasks, e.g. the status LEDs. The
+# mux channel, baud rate and reply of one transaction belong together, so every
+# transaction holds the line lock (and the line lease shared with other threads) from
+# mux selection until its reply is parsed. The line lease is reentrant per thread, and
+# all tasks of a loop run in one thread, so the line lock is the loop's lock of the port
+# (Event_loop.lock()), shared by all Async_serial objects on it: only its owner may
+# hold the lease across a yield.
+#
+
+class Async_serial:
+
+	def __init__(self, loop, serial_port, mux=None, maestro=None):
+		"""Initialize asynchronous transport object on top of an open Serial_port; if mux
+		is given, it is set to the addressed device before each transaction, over the
+		asynchronous Maestro client if given (else by blocking telnet writes)."""
+
+		self.loop = loop
+		self.serport = serial_port
+		self.mux = mux
+		self.maestro = maestro
+		self.lock = loop.lock(serial_port.arbiter.port)	# one transaction on the shared line at a time, per loop
+		self.logging = serial_port.logging
+
+	def select(self, device, baudrate):
+		"Points mux (or serial routing) and line speed to given device, e.g. 'rotary_valve1'."
+
+		if self.mux is not None:
+			if self.mux.channel != device:
+				getattr(self.mux, 'set_to_' + device)()
+		else:
+			self.serport.select(device)
+
+		self.serport.set_baud(baudrate)
+
+	def acquire(self):
+		"""Coroutine variant of Serial_port.acquire(): the mux channel is latched over the
+		asynchronous Maestro client, if any, while the line lease is held. Called with the
+		line lock held, so no other task of the loop enters the lease meanwhile."""
+
+		serport = self.serport
+		serport.arbiter.acquire()
+
+		try:
+			if self.maestro is not None and self.mux is not None and not serport.routed and serport.device is not None and serport.arbiter.channel != serport.device:
+				yield self.mux.latch_channel_co(self.maestro, serport.device)
+				serport.arbiter.channel = serport.device
+
+			serport.acquire()	# blocks the loop only while another thread holds the line
+		finally:
+			serport.arbiter.release()
+
+	def transaction(self, device, baudrate, codec, command, policy=None, deadline=None):
+		"""Coroutine variant of Serial_port.transaction() for given device: returns the
+		codec-parsed reply frame, re-sending the command on timeouts according to the
+		retry policy, then raises Serial_timeout."""
+
+		if policy is None:
+			policy = self.serport.retry_policy
+
+		yield self.lock.acquire()
+
+		try:
+			self.select(device, baudrate)
+			yield self.acquire()
+		except:
+			self.lock.release()
+			raise
+
+		try:
+			t0 = time.time()
+
+			for attempt in range(1, policy.attempts + 1):
+				codec.reset()
+				self.serport.write_serial(codec.encode(command))
+
+				try:
+					reply = yield self.read_frame(codec, command, deadline)
+				except Serial_timeout, e:
+					if attempt == policy.attempts:
+						raise
+
+					self.logging.warn("---\t-\t--> Serial command %r to %s attempt %i of %i timed out: %s" % (command, device, attempt, policy.attempts, e))
+					yield Sleep(policy.interval)
+				else:
+					self.serport.latency.record((self.serport.device_bauds.get(baudrate, str(baudrate)), codec.opcode(command)), time.time() - t0)
+					raise Return(reply)
+		finally:
+			self.serport.release()
+			self.lock.release()
+
+	def read_frame(self, codec, command, deadline=None):
+		"""Coroutine variant of Serial_port.read_frame(): yields to other tasks until
+		the line is readable; raises Serial_timeout on deadline."""
+
+		if deadline is None:
+			deadline = self.serport._read_deadline
+
+		ser = self.serport.ser
+		t_end = time.time() + deadline
+
+		while True:
+			remaining = t_end - time.time()
+
+			if remaining <= 0 or not (yield Readable(ser.fileno(), remaining)):
+				raise Serial_timeout("no reply to %r within %0.2f s - received %r" % (command, deadline, codec.buffer))
 
+			for frame in codec.feed(self.serport.read_available(ser)):
+				if codec.accept(frame, command):
+					raise Return(codec.decode(frame))
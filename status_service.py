@@ -0,0 +1,219 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Status_service,
+ containing the background status LED and touch sensor service of
+ polonator_main in Python. LED states are kept in memory; the service task
+ writes an LED (y.ob[n]) only when its state changed, at most every
+ 'status_interval' seconds. The touch sensor (m_din[7]) is sampled every
+ 'touch_interval' seconds in the same burst, and its changes are delivered as
+ events.
+
+ The service runs on the process-wide event loop and talks over its
+ asynchronous Maestro client (async_maestro.py), so LED writes share TCP
+ segments with the mux latches of the thermal service and never block it.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+import Queue
+import threading
+
+from tel_net import Telnet_error
+from event_loop import Cancelled, Sleep
+from async_maestro import get_async_maestro
+
+OFF = 0		# LED modes
+ON = 1
+BLINK = 2	# toggled every status_interval
+
+class Status_service:
+
+	def __init__(self, loop, config, logger=None):
+		"Initialize status service object on given event loop; start() runs it."
+
+		if logger is not None:
+			self.logging = logger
+
+		self.loop = loop
+		self.client = get_async_maestro(loop, config, logger)
+		self.status_interval = float(config.get("communication","status_interval"))
+		self.touch_interval = float(config.get("communication","touch_interval"))
+
+		self.lock = threading.Lock()
+		self.modes = {}			# LED number -> requested mode
+		self.written = {}		# LED number -> state on the controller, missing while unknown
+		self.phase = 0			# blink phase
+
+		self.touch = None		# last touch sensor sample
+		self.events = Queue.Queue()	# (time, touch sensor state) on every change
+		self.stopped = threading.Event()
+		self.finished = threading.Event()	# set when the service task ends
+		self.task = None
+		self.sleeping = False			# service task waits for its next pass
+
+		self.writes = 0			# statistics: LED writes and telnet bursts
+		self.bursts = 0
+
+	def set_led(self, led, mode):
+		"Sets status LED y.ob[led] to OFF, ON or BLINK; written by the service task."
+
+		self.lock.acquire()
+		self.modes[led] = mode
+		self.lock.release()
+
+	def changed_leds(self):
+		"Returns [(led, state)] of LEDs whose state differs from the controller."
+
+		self.lock.acquire()
+
+		try:
+			changes = []
+
+			for led, mode in self.modes.items():
+				state = mode
+
+				if mode == BLINK:
+					state = self.phase
+
+				if self.written.get(led) != state:
+					changes.append((led, state))
+			return changes
+		finally:
+			self.lock.release()
+
+	def forget(self):
+		"Marks all LED states on the controller as unknown, so they are rewritten on the next pass."
+
+		self.lock.acquire()
+		self.written.clear()
+		self.lock.release()
+
+	def wait_for_touch(self, timeout=None):
+		"Returns True if the touch sensor is activated (rising edge) within timeout seconds, else False."
+
+		t_end = None
+
+		if timeout is not None:
+			t_end = time.time() + timeout
+
+		while True:
+			remaining = None
+
+			if t_end is not None:
+				remaining = max(0.0, t_end - time.time())
+
+			try:
+				t, state = self.events.get(remaining is None or remaining > 0, remaining)
+			except Queue.Empty:
+				return False
+
+			if state == 1:
+				return True
+
+	def run(self):
+		"Coroutine: writes changed LEDs and samples the touch sensor until stop() is called."
+
+		next_led = 0.0
+		next_touch = 0.0
+
+		try:
+			while not self.stopped.isSet():
+				now = time.time()
+				changes = []
+				commands = []
+
+				if now >= next_led:
+					self.phase = int(not self.phase)
+					changes = self.changed_leds()
+					commands = ['y.ob[%i]=%i' % (led, state) for led, state in changes]
+					next_led = now + self.status_interval
+
+				sample = now >= next_touch
+
+				if sample:
+					commands.append('m_din[7]')
+					next_touch = now + self.touch_interval
+
+				if commands:
+					try:
+						yield self.flush(commands, changes, sample)
+					except Cancelled:
+						raise
+					except Exception, e:		# e.g. a malformed touch sensor reply - keep serving
+						self.forget()
+
+						if hasattr(self, 'logging'):
+							self.logging.error("---\t-\t--> Status service: %s" % e)
+
+				self.sleeping = True		# until the next pass, or woken by stop()
+				yield Sleep(max(0.0, min(next_led, next_touch) - time.time()))
+				self.sleeping = False
+
+			changes = self.changed_leds()
+
+			if changes:
+				yield self.flush(['y.ob[%i]=%i' % (led, state) for led, state in changes], changes, False)
+		finally:
+			self.finished.set()
+
+	def flush(self, commands, changes, sample):
+		"Coroutine: writes LED changes (and reads the touch sensor if sample) in one pipelined burst."
+
+		try:
+			replies = yield self.client.pipeline(commands)
+		except Telnet_error, e:
+			self.forget()
+
+			if hasattr(self, 'logging'):
+				self.logging.warn("---\t-\t--> Status service: %s" % e)
+			return
+
+		self.bursts += 1
+		self.writes += len(changes)
+
+		self.lock.acquire()
+
+		for led, state in changes:
+			self.written[led] = state
+		self.lock.release()
+
+		if sample:
+			touch = int(replies[-1].strip('>').strip())
+
+			if self.touch is not None and touch != self.touch:	# first sample is the baseline
+				self.events.put((time.time(), touch))
+			self.touch = touch
+
+	def wake(self):
+		"Resumes the service task if it waits for its next pass; runs in the loop thread."
+
+		if self.sleeping:
+			self.sleeping = False
+			self.loop.wake(self.task)
+
+	def spawn(self):
+		"Spawns the service task; runs in the loop thread."
+		self.task = self.loop.spawn(self.run(), 'status service')
+
+	def start(self):
+		"Starts the service task on the event loop."
+		self.loop.post(self.spawn)
+
+	def stop(self):
+		"Turns all LEDs off, writes them and stops the service task."
+
+		self.lock.acquire()
+
+		for led in self.modes.keys():
+			self.modes[led] = OFF
+		self.lock.release()
+
+		self.stopped.set()
+		self.loop.post(self.wake)
+		self.finished.wait()
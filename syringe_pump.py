@@ -16,6 +16,11 @@
 ------------------------------------------------------------------------------- 
 """
 
+import time
+
+from serial_port import Serial_timeout
+from serial_codec import Cavro_codec
+
 class Syringe_pump:
 
 	global serport
@@ -28,6 +33,10 @@ class Syringe_pump:
 		self._baud_rate = int(config.get("communication","syringe_pump_baud"))
 		self._read_length = int(config.get("communication","read_length"))
 		self._sleep_time = float(config.get("communication","sleep_time"))
+		self._busy_poll_interval = float(config.get("communication","busy_poll_interval"))
+		self._busy_timeout = float(config.get("communication","busy_timeout"))
+
+		self.codec = Cavro_codec()
 
 		if logger is not None:
 			self.logging = logger
@@ -57,42 +66,43 @@ class Syringe_pump:
 		self.serport.set_baud(self._baud_rate)
 
 		# Initialize syringe dead volume
-		self.serport.write_serial('/1k5R\r')
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1k5R\r')
+		self.wait_until_ready()
 
 		# Initialize move to zero position, full dispense, full force
-		self.serport.write_serial('/1Z0R\r')
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1Z0R\r')
+		self.wait_until_ready()
 
 		# Initialize speed, range is 0-40, the maximum speed is 0 (1.25 strokes/second)
-		self.serport.write_serial('/1S20R\r')
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1S20R\r')
+		self.wait_until_ready()
 
 		self.logging.info("---\t-\t--> Initialized syringe pump object")
 
+	def wait_until_ready(self):
+		"""Polls pump status until the ready bit is set, i.e. the previous command has 
+		finished executing; raises Serial_timeout if the pump stays busy too long."""
+
+		t_end = time.time() + self._busy_timeout
+
+		while True:
+			ready, data = self.serport.transaction(self.codec, '/1QR\r')
+
+			if ready:
+				return
+
+			if time.time() > t_end:
+				raise Serial_timeout("syringe pump still busy after %0.1f s" % self._busy_timeout)
+
+			time.sleep(self._busy_poll_interval)
+
 	def set_valve_position(self, valve_position):
 		"Sets to given syringe pump valve position, an integer"
 					 
 		self.serport.set_baud(self._baud_rate)
 
-		self.serport.write_serial('/1I' + str(valve_position) + 'R\r')
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1I' + str(valve_position) + 'R\r')
+		self.wait_until_ready()
 
 		self.logging.info("---\t-\t--> Set syringe pump valve position to %i" % valve_position)
 
@@ -102,12 +112,8 @@ class Syringe_pump:
 
 		self.serport.set_baud(self._baud_rate)
 
-		self.serport.write_serial('/1S' + str(speed) + 'R\r')
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1S' + str(speed) + 'R\r')
+		self.wait_until_ready()
 
 		self.logging.info("---\t-\t--> Set syringe pump speed to %i" % speed)
 
@@ -121,12 +127,7 @@ class Syringe_pump:
 		# Increments = (pump resolution * volume ul) / (syringe size ml * ul/ml)
 		absolute_steps = (3000 * absolute_volume) / (1 * 1000)
 
-		self.serport.write_serial('/1A' + str(absolute_steps) + 'R\r')	# 'P' command for relative pick-up, 'A' for absolute position 
-		self.serport.read_serial(3)
-
-		find_string = chr(96)
-		response_string_size = 4
-		self.serport.parse_read_string('/1QR\r', find_string, response_string_size)
+		self.serport.transaction(self.codec, '/1A' + str(absolute_steps) + 'R\r')	# 'P' command for relative pick-up, 'A' for absolute position 
+		self.wait_until_ready()
 
 		self.logging.info("---\t-\t--> Set syringe pump absolute volume to %i" % absolute_volume)
-
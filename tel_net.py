@@ -14,36 +14,225 @@
 ------------------------------------------------------------------------------- 
 """
 
+import re
 import sys
+import time
+import select
+import socket
 import telnetlib
+import threading
+import wire_capture
+
+from wire_capture import WRITE, READ
+
+class Telnet_error(Exception):
+	"Raised when the Maestro reports an error for a command, or the session is closed."
+	pass
+
+class Telnet_timeout(Telnet_error):
+	"Raised when the Maestro prompt does not arrive before the read deadline."
+	pass
+
+# Stall metric of all sessions in this process: time spent between a failed read/write
+# and the recovered (or abandoned) command
+
+stalls = {'count' : 0, 'seconds' : 0.0, 'reconnects' : 0, 'failures' : 0}
+stalls_lock = threading.Lock()
+
+def stall_summary():
+	"Returns the process-wide telnet stall metric as a printable string."
+	return "%(count)i stalls, %(seconds)0.1f s stalled, %(reconnects)i reconnects, %(failures)i failed commands" % stalls
 
 class Tel_net:
 
 	global telnet_session
 
-	def __init__(self, logger=None):
+	maestro_address = '10.0.0.56'	# defaults, overridden by maestro_address/maestro_port in config
+	maestro_port = 23
+	max_backoff = 30.0		# seconds, upper limit of reconnect delay
+
+	# Commands safe to replay after a lost reply: output bit writes and status reads, i.e.
+	# 'm_dout[n]=0/1', 'y.ob[n]=0/1', 'm_dout[n]', 'm_din[n]', 'y.ob[n]', 'x.hmstat' and
+	# 'y.hmstat'. Anything else (moves, homing, programs) is never replayed.
+	idempotent = re.compile(r'^\s*((m_dout|y\.ob)\[\d+\]\s*(=\s*[01])?|m_din\[\d+\]|[xy]\.hmstat)\s*$')
+
+	error_pattern = re.compile(r'error|\?', re.IGNORECASE)	# Maestro error replies
+
+	def __init__(self, logger=None, config=None):
 		"Initialize telnet connection object with default parameters"
 
 		if logger is not None:			# if defined, place logger into Tel_net
 			self.logging = logger
 
-		maestro_address = '10.0.0.56'
-		self.telnet_session = telnetlib.Telnet(maestro_address)
-		m = self.telnet_session.read_until('>')	# search return string for maestro prompt
-		self.telnet_session.write('\r')
-		d = self.telnet_session.read_until('>')	# search return string for > 
+		self.timeout = 5.0			# seconds to wait for the prompt
+		self.retries = 5			# reconnect/replay attempts per command
+		self.backoff = 0.5			# first reconnect delay, doubled every attempt
+
+		if config is not None:
+			self.maestro_address = config.get("communication","maestro_address")
+			self.maestro_port = int(config.get("communication","maestro_port"))
+			self.timeout = float(config.get("communication","telnet_timeout"))
+			self.retries = int(config.get("communication","telnet_retries"))
+			self.backoff = float(config.get("communication","telnet_backoff"))
+
+		self.telnet_session = None		# None while no session is open
+		self.connect()
 
 		if logger:
-			self.logging.info("---\t-\t--> Initialized telnet connection to address %s" % maestro_address)
+			self.logging.info("---\t-\t--> Initialized telnet connection to address %s:%i" % (self.maestro_address, self.maestro_port))
+
+	def connect(self):
+		"""Opens the telnet session and waits for the Maestro prompt; raises Telnet_timeout if it
+		does not come (the session stays closed then)."""
+
+		session = telnetlib.Telnet(self.maestro_address, self.maestro_port, self.timeout)
+
+		try:
+			m = session.read_until('>', self.timeout)	# search return string for maestro prompt
+			session.write('\r')
+			d = session.read_until('>', self.timeout)	# search return string for > 
+
+			if not d.endswith('>'):
+				raise Telnet_timeout("no Maestro prompt from %s within %0.1f s" % (self.maestro_address, self.timeout))
+		except:
+			session.close()
+			raise
+
+		self.telnet_session = session
+
+	def close(self):
+		"Closes the session; the next exchange opens a new one."
+
+		if self.telnet_session is not None:
+			self.telnet_session.close()
+			self.telnet_session = None
+
+	def reconnect(self, attempt):
+		"Closes the session and opens a new one after an exponential backoff delay."
+
+		delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+		self.close()
+		time.sleep(delay)
+
+		stalls_lock.acquire()
+		stalls['reconnects'] += 1
+		stalls_lock.release()
+
+		self.connect()
+
+	def exchange(self, write_strings, find_string):
+		"""Writes all commands as one burst, then reads one reply per command, each ending
+		with find_string, in a single read pass. Raises Telnet_timeout if the replies are
+		not complete within the read deadline. Opens the session first if it is closed."""
+
+		if self.telnet_session is None:
+			self.connect()
+
+		burst = ''.join([write_string + '\r' for write_string in write_strings])
+		capture = wire_capture.current		# opened by Serial_port if configured, else None
+
+		if capture is not None:
+			capture.record('telnet', WRITE, burst)
+
+		self.telnet_session.write(burst)
+
+		t_end = time.time() + self.timeout
+		replies = []
+		buffer = ''
+
+		while len(replies) < len(write_strings):
+			data = self.telnet_session.read_very_eager()	# all data received so far, never blocks
+
+			if data == '':
+				remaining = t_end - time.time()
+
+				if remaining <= 0:
+					raise Telnet_timeout("%i of %i replies to %r within %0.1f s - received %r" % (len(replies), len(write_strings), write_strings, self.timeout, buffer))
+
+				select.select([self.telnet_session.fileno()], [], [], remaining)
+				continue
+
+			buffer = buffer + data
+
+			while len(replies) < len(write_strings) and buffer.find(find_string) >= 0:
+				reply, buffer = buffer.split(find_string, 1)
+				replies.append(reply + find_string)
+
+		if capture is not None:
+			capture.record('telnet', READ, ''.join(replies))
+		return replies
+
+	def transact(self, write_strings, find_string):
+		"""Runs exchange(); on a lost reply or connection, reconnects with exponential
+		backoff and replays the commands if all are idempotent. A command that is not
+		replayed fails at once, the session closed for the next command to reopen. Stall
+		time is added to the process-wide stall metric."""
+
+		t0 = time.time()
+		attempt = 0
+
+		while True:
+			try:
+				replies = self.exchange(write_strings, find_string)
+			except (Telnet_timeout, EOFError, socket.error), e:
+				replay = attempt < self.retries and not [w for w in write_strings if not self.idempotent.match(w)]
+
+				if hasattr(self, 'logging'):
+					self.logging.warn("---\t-\t--> Telnet stall on %r (attempt %i of %i): %s" % (write_strings, attempt + 1, self.retries + 1, e))
+
+				if not replay:
+					self.close()		# no backoff - the next command connects again
+					self.stalled(t0, failed=True)
+					raise Telnet_error("telnet command %r failed after %i attempts: %s" % (write_strings, attempt + 1, e))
+
+				try:
+					self.reconnect(attempt)
+				except (Telnet_timeout, EOFError, socket.error):
+					pass			# session stays closed - the next attempt connects again
+
+				attempt += 1
+			else:
+				if attempt > 0:
+					self.stalled(t0)
+				return replies
+
+	def stalled(self, t0, failed=False):
+		"Adds one stall of the command started at time t0 to the stall metric."
+
+		stalls_lock.acquire()
+		stalls['count'] += 1
+		stalls['seconds'] += time.time() - t0
+
+		if failed:
+			stalls['failures'] += 1
+		stalls_lock.release()
 
 	def parse_read_string(self, write_string, find_string):
 		"Will read and parse string responses which return program code from the device"
-		
-		self.telnet_session.write(write_string + '\r')
-		read_string = self.telnet_session.read_until(find_string)	# search return string for > 
-                return read_string
-                
+		return self.transact([write_string], find_string)[0]
+
+	def pipeline(self, write_strings, find_string='>'):
+		"""Writes all commands as one burst, then reads one reply per command, each ending 
+		with find_string, in a single read pass: about one round-trip for the whole sequence.
+		Returns the list of replies; if any reply reports an error, raises Telnet_error 
+		naming each failed command."""
+
+		if not write_strings:
+			return []
+
+		replies = self.transact(write_strings, find_string)
+		errors = []
+
+		for write_string, reply in zip(write_strings, replies):
+			if self.error_pattern.search(reply.replace(write_string, '', 1)):	# ignore command echo
+				errors.append("%r -> %r" % (write_string, reply.strip()))
+
+		if errors:
+			raise Telnet_error("%i of %i pipelined commands failed: %s" % (len(errors), len(write_strings), ', '.join(errors)))
+		return replies
+
 	def __del__(self):
 		"Destructs telnet conncetion object - it closes any open session"
-		self.telnet_session.close()
 
+		if getattr(self, 'telnet_session', None) is not None:
+			self.telnet_session.close()
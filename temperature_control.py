@@ -17,6 +17,21 @@
 """
 
 import time
+import threading
+
+from serial_codec import PR59_codec
+from event_loop import Return
+
+SETPOINT = 0		# PR-59 registers
+TEMPERATURE = 100
+
+# Write-through cache of controller state (RUN flag, registers written), shared by all
+# Temperature_control objects of the process: (port, mux channel) -> {'run' or register:
+# value}. An entry is dropped when a transaction to the controller fails, so it is
+# rewritten next time; the whole port is dropped at the start of each Biochem cycle.
+
+registers = {}
+registers_lock = threading.Lock()
 
 class Temperature_control:
 
@@ -29,11 +44,14 @@ class Temperature_control:
 		self._read_length = int(config.get("communication","read_length"))
 		self._sleep_time = float(config.get("communication","sleep_time"))
 
+		self.codec = PR59_codec()
+
 		if logger is not None:
 			self.logging = logger
 
 		self.serport = serial_port	
 		self.state = 'temperature control initialized'
+		self.skipped = 0		# redundant writes skipped thanks to the register cache
 
 		self.logging.info("---\t-\t--> Temperature controller object constructed")
 
@@ -47,43 +65,101 @@ class Temperature_control:
 # it, etc). Each functional command will block until execution is complete.
 #
 #--------------------------------------------------------------------------------------#
-#																	BASIC SETTINGS																			 #
+#																	REGISTER CACHE																			 #
 #--------------------------------------------------------------------------------------#
 
-	def set_control_on(self):
-		"Sets RUN flag in regulator, so main output is opened."
+	def cache_key(self, device=None):
+		"Returns cache key of given controller, by default the one the serial port addresses."
 
-		self.serport.set_baud(self._baud_rate)
-		find_string = '\r'
-		response_string_size = 10
-		self.serport.parse_read_string('$W\r', find_string, response_string_size)	# set RUN flag command
+		if device is None:
+			device = self.serport.device
+		return (self.serport.arbiter.port, device)
 
-		self.logging.info("---\t-\t--> Set temperature control ON")
+	def cached(self, key, entry):
+		"Returns True if the controller is known to hold given value, e.g. ('run', True)."
 
-	def set_control_off(self):
-		"Clears RUN flag in regulator, so main output is blocked."
+		registers_lock.acquire()
+
+		try:
+			return registers.has_key(key) and registers[key].has_key(entry[0]) and registers[key][entry[0]] == entry[1]
+		finally:
+			registers_lock.release()
+
+	def cache(self, key, entry):
+		"Records that the controller holds given (register, value) entry."
+
+		registers_lock.acquire()
+		registers.setdefault(key, {})[entry[0]] = entry[1]
+		registers_lock.release()
+
+	def invalidate(self, key):
+		"Forgets the cached state of a controller."
+
+		registers_lock.acquire()
+
+		if registers.has_key(key):
+			del registers[key]
+		registers_lock.release()
+
+	def invalidate_all(self):
+		"""Forgets the cached state of all controllers on the serial port; called at the start
+		of each cycle, since a controller may have been power-cycled or set by hand since."""
+
+		registers_lock.acquire()
+
+		for key in registers.keys():
+			if key[0] == self.serport.arbiter.port:
+				del registers[key]
+		registers_lock.release()
+
+	def write(self, entry, command):
+		"""Writes command setting cache entry (register, value) unless the controller already
+		holds it. Returns True if the command was written."""
+
+		key = self.cache_key()
+
+		if self.cached(key, entry):
+			self.skipped += 1
+			return False
 
 		self.serport.set_baud(self._baud_rate)
-		find_string = '\r'
-		response_string_size = 10
-		self.serport.parse_read_string('$Q\r', find_string, response_string_size)	# clear RUN flag command 
 
-		self.logging.info("---\t-\t--> Set temperature control OFF")
+		try:
+			self.serport.transaction(self.codec, command)
+		except:
+			self.invalidate(key)
+			raise
+
+		self.cache(key, entry)
+		return True
+
+#--------------------------------------------------------------------------------------#
+#																	BASIC SETTINGS																			 #
+#--------------------------------------------------------------------------------------#
+
+	def set_control_on(self):
+		"Sets RUN flag in regulator, so main output is opened (unless known to be set)."
+
+		if self.write(('run', True), '$W\r'):	# set RUN flag command
+			self.logging.info("---\t-\t--> Set temperature control ON")
+
+	def set_control_off(self):
+		"Clears RUN flag in regulator, so main output is blocked (unless known to be clear)."
+
+		if self.write(('run', False), '$Q\r'):	# clear RUN flag command 
+			self.logging.info("---\t-\t--> Set temperature control OFF")
 
 #--------------------------------------------------------------------------------------#
 #																REGULATOR SETTINGS											 							 #
 #--------------------------------------------------------------------------------------#
 
 	def set_temperature(self, temperature):
-		"Sets main temperature reference (C), a float - register [0]."
+		"Sets main temperature reference (C), a float - register [0]; skipped if already set."
 
 		self.set_control_on()
-		temp_string = '$R0=' + str(temperature) + '\r'	# set register 0 value to 'temperature', a float
-		find_string = '\r'
-		response_string_size = 11
-		self.serport.parse_read_string(temp_string, find_string, response_string_size)
 
-		self.logging.info("---\t-\t--> Set temperature controller to %i C [set_temp]" % temperature)
+		if self.write((SETPOINT, float(temperature)), self.codec.write_register(SETPOINT, temperature)):	# set register 0 value to 'temperature', a float
+			self.logging.info("---\t-\t--> Set temperature controller to %i C [set_temp]" % temperature)
 
 #--------------------------------------------------------------------------------------#
 #																	STATUS CHECKING																			 #
@@ -92,16 +168,35 @@ class Temperature_control:
 	def get_temperature(self):
 		"Gets temperature sensor 1 reading, a float - register [100]."
 
+		temperature = self.read_registers([TEMPERATURE])[0]	# get register 100 value, a float
+
+		#self.logging.info("---\t-\t--> Get current temperature: %i C" % temperature)
+		return temperature
+
+	def read_registers(self, numbers):
+		"""Reads given registers (floats) in one bus visit: the line lease is held for all
+		queries, so the mux channel and line speed are set once. Returns the list of values."""
+
 		self.serport.set_baud(self._baud_rate)
+		self.serport.acquire()
 
-		find_string = '\r'
-		response_string_size = 21
+		try:
+			return [self.codec.value(self.serport.transaction(self.codec, self.codec.read_register(number))) for number in numbers]
+		finally:
+			self.serport.release()
 
-		temperature = self.serport.parse_read_string('$R100?\r', find_string, response_string_size)	# get register 100 value, a float
-		string_start_index = temperature.find('+')
-		string_end_index = temperature.find('e')
-		temperature = float(temperature[string_start_index : string_end_index] + 'e+01')
 
-		#self.logging.info("---\t-\t--> Get current temperature: %i C" % temperature)
-		return temperature
+#--------------------------------------------------------------------------------------#
+#				ASYNCHRONOUS VARIANTS				       #
+#--------------------------------------------------------------------------------------#
+#
+# Coroutine variant for the thermal service on the event loop; 'device' is the mux channel
+# of the controller: 'temperature_control1', 'temperature_control2' or 'reagent_block_cooler'.
+# Setpoints are written by the Biochem threads with the blocking functions above.
+#
+
+	def get_temperature_co(self, bus, device):
+		"Coroutine: gets temperature sensor 1 reading, a float - register [100]."
 
+		reply = yield bus.transaction(device, self._baud_rate, self.codec, self.codec.read_register(TEMPERATURE))
+		raise Return(self.codec.value(reply))
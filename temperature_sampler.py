@@ -0,0 +1,195 @@
+#!/usr/local/bin/python
+
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Telemetry,
+ containing the temperature telemetry storage of both flowcell controllers
+ and the reagent block cooler in Python, and its file decoder. The samples
+ are taken by the thermal service (thermal_service.py) on the event loop.
+
+ The samples go to a preallocated ring (array of doubles: time, device, C), which
+ is flushed every 'flush_interval' seconds to a memory-mapped file; latest()
+ returns the newest reading of a device without a serial transaction.
+
+ Usage: python temperature_sampler.py telemetry-file
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import sys
+import time
+import mmap
+import array
+import struct
+import threading
+
+from mux import Mux
+from serial_port import Serial_port
+from temperature_control import Temperature_control
+
+#--------------------------------------------------------------------------------------#
+#				TELEMETRY FILE FORMAT				       #
+#--------------------------------------------------------------------------------------#
+#
+# Header: magic, ring capacity (records), records written in total, wall clock at
+# creation, then the device names ('\0' separated). Data: 'capacity' records of three
+# doubles (time, device index, temperature); record n is stored in slot n % capacity.
+#
+
+MAGIC = 'G007TEMP'
+HEADER = struct.Struct('<8sIQd')
+NAMES = 128				# bytes reserved for device names
+DATA = HEADER.size + NAMES
+FIELDS = 3				# doubles per record
+
+class Telemetry:
+
+	def __init__(self, config, logger=None):
+		"""Initialize telemetry object: sample ring and file of the [telemetry] devices, and
+		its own serial port, mux and controller objects to read them."""
+
+		if logger is not None:
+			self.logging = logger
+
+		self.devices = config.get("telemetry","devices").split()
+		self.interval = float(config.get("telemetry","interval"))
+		self.flush_interval = float(config.get("telemetry","flush_interval"))
+		self.capacity = int(config.get("telemetry","capacity"))
+		self.path = config.get("telemetry","telemetry_file").strip()
+
+		self.ser = Serial_port(config, logger)	# transactions share the line lease with the Biochem threads
+		self.mux = Mux(logger, self.ser, config)
+		self.temperature_control = Temperature_control(config, self.ser, logger)
+
+		self.ring = array.array('d', [0.0]) * (self.capacity * FIELDS)
+		self.count = 0			# records written in total
+		self.flushed = 0		# records written to file
+		self.latest_samples = {}	# device -> (time, C)
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.errors = 0
+
+		self.map = None
+
+		if self.path != '':
+			f = open(self.path, 'w+b')
+			f.truncate(DATA + self.capacity * FIELDS * 8)
+			self.map = mmap.mmap(f.fileno(), DATA + self.capacity * FIELDS * 8)
+			f.close()
+
+			self.wall = time.time()
+			self.map[HEADER.size:HEADER.size + len('\0'.join(self.devices))] = '\0'.join(self.devices)
+			self.store_header()
+
+	def store_header(self):
+		"Writes record count to the file header."
+		self.map[0:HEADER.size] = HEADER.pack(MAGIC, self.capacity, self.flushed, self.wall)
+
+	def record(self, device, t, temperature):
+		"Appends one sample to the ring and makes it the latest of its device."
+
+		self.lock.acquire()
+
+		try:
+			slot = (self.count % self.capacity) * FIELDS
+			self.ring[slot:slot + FIELDS] = array.array('d', [t, self.devices.index(device), temperature])
+			self.count += 1
+			self.latest_samples[device] = (t, temperature)
+		finally:
+			self.lock.release()
+
+	def latest(self, device):
+		"Returns newest (time, C) sample of given device, e.g. 'temperature_control1', or None."
+
+		self.lock.acquire()
+
+		try:
+			return self.latest_samples.get(device)
+		finally:
+			self.lock.release()
+
+	def samples(self, device, since=0.0):
+		"Returns [(time, C)] of given device still in the ring, sampled after time since."
+
+		self.lock.acquire()
+
+		try:
+			index = self.devices.index(device)
+			result = []
+
+			for n in range(max(0, self.count - self.capacity), self.count):
+				slot = (n % self.capacity) * FIELDS
+
+				if self.ring[slot + 1] == index and self.ring[slot] > since:
+					result.append((self.ring[slot], self.ring[slot + 2]))
+			return result
+		finally:
+			self.lock.release()
+
+	def flush(self):
+		"Copies the records written since the last flush from the ring to the file."
+
+		if self.map is None:
+			return
+
+		self.lock.acquire()
+
+		try:
+			first = max(self.flushed, self.count - self.capacity)	# older unflushed records were overwritten
+			n = first
+
+			while n < self.count:
+				slot = n % self.capacity
+				end = min(self.capacity, slot + self.count - n)	# contiguous up to the end of the ring
+				offset = DATA + slot * FIELDS * 8
+				self.map[offset:offset + (end - slot) * FIELDS * 8] = self.ring[slot * FIELDS:end * FIELDS].tostring()
+				n = n + end - slot
+
+			self.flushed = self.count
+			self.store_header()
+		finally:
+			self.lock.release()
+
+#--------------------------------------------------------------------------------------#
+#					DECODER					       #
+#--------------------------------------------------------------------------------------#
+
+def read_telemetry(path):
+	"Returns (device names, wall clock at creation, [(time, device, C)]) of a telemetry file, oldest first."
+
+	f = open(path, 'rb')
+	contents = f.read()
+	f.close()
+
+	magic, capacity, count, wall = HEADER.unpack_from(contents, 0)
+
+	if magic != MAGIC:
+		raise ValueError("%s is not a telemetry file" % path)
+
+	names = contents[HEADER.size:DATA].rstrip('\0').split('\0')
+	data = array.array('d')
+	data.fromstring(contents[DATA:DATA + capacity * FIELDS * 8])
+	records = []
+
+	for n in range(max(0, count - capacity), count):
+		slot = (n % capacity) * FIELDS
+		records.append((data[slot], names[int(data[slot + 1])], data[slot + 2]))
+
+	return (names, wall, records)
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 2:
+		print '\n--> Error: not correct input!\n--> Usage: python temperature_sampler.py telemetry-file\n'
+		sys.exit()
+
+	names, wall, records = read_telemetry(sys.argv[1])
+	print 'INFO\t ***\t*\t--> Telemetry started %s, %i records' % (time.ctime(wall), len(records))
+
+	for t, device, temperature in records:
+		print '%0.3f\t%s\t%0.2f' % (t - wall, device, temperature)
@@ -0,0 +1,422 @@
+#!/usr/local/bin/python
+
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: emulates the serial devices of the G.007 fluidics sub-system on a
+ pseudo-terminal, so the host-side command path can be run, benchmarked and
+ profiled without the instrument. The emulated devices are:
+
+		 1. Cavro XCalibur syringe pump (motion times, busy status)
+		 2. Rheodyne rotary valves V1-V4 (port switching times)
+		 3. PR-59 temperature controllers 1/2 and reagent block cooler
+		    (first-order thermal ramps with dead time)
+
+ Like on the instrument, all devices share one serial line; the device that
+ answers is the one whose baud rate matches the current line speed (and, if a
+ mux emulator is attached, the currently selected mux channel).
+
+ Usage: python device_emulator.py config.txt [time-scale] [link-path]
+
+ Point 'serial_port' in config.txt to the printed pseudo-terminal (or to the
+ link path, e.g. /tmp/polonator_tty). A time-scale larger than 1 makes motions
+ and thermal ramps run that many times faster.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import re
+import sys
+import pty
+import tty
+import math
+import time
+import select
+import termios
+import threading
+import ConfigParser
+
+#--------------------------------------------------------------------------------------#
+#				EMULATOR CLOCK					       #
+#--------------------------------------------------------------------------------------#
+
+class Clock:
+
+	def __init__(self, time_scale=1.0):
+		"Initialize emulated clock running 'time_scale' times faster than wall clock."
+
+		self.time_scale = time_scale
+		self.t0 = time.time()
+
+	def now(self):
+		"Returns emulated time in seconds."
+		return (time.time() - self.t0) * self.time_scale
+
+#--------------------------------------------------------------------------------------#
+#			Cavro XCalibur syringe pump EMULATOR			       #
+#--------------------------------------------------------------------------------------#
+
+class Cavro_emulator:
+
+	# Speed codes 0-40 in half-increments per second (XCalibur standard resolution).
+	speeds = [6000, 5600, 5000, 4400, 3800, 3200, 2600, 2200, 2000, 1800, 1600, 1400, 1200,
+		  1000, 800, 600, 400, 200, 190, 180, 170, 160, 150, 140, 130, 120, 110, 100,
+		  90, 80, 70, 60, 50, 40, 30, 20, 18, 16, 14, 12, 10]
+
+	full_stroke = 3000	# increments
+	valve_time = 0.25	# seconds per valve move
+
+	def __init__(self, clock):
+		"Initialize syringe pump emulator in power-up (not initialized) state."
+
+		self.clock = clock
+		self.initialized = False
+		self.position = 0
+		self.speed = 11
+		self.valve = 1
+		self.busy_until = 0.0
+		self.error = 0
+
+	def move_time(self, steps):
+		"Returns time in seconds needed to move the plunger by given number of increments."
+		return abs(steps) / (self.speeds[self.speed] / 2.0)
+
+	def handle(self, line):
+		"Executes a '/1...R' command string and returns the pump reply."
+
+		if not line.startswith('/1'):
+			return None
+
+		now = self.clock.now()
+		ready = now >= self.busy_until
+		body = line[2:]
+
+		if body != 'QR' and body != 'Q':
+
+			if not ready:
+				return self.reply(ready, 15)	# command overflow - pump is busy
+
+			self.error = 0
+			duration = 0.0
+
+			for command, operand in re.findall(r'([A-Za-z])(-?\d*)', body.rstrip('R')):
+				operand = operand and int(operand) or 0
+
+				if command == 'Z':
+					duration = duration + self.move_time(self.position) + self.valve_time
+					self.position = 0
+					self.initialized = True
+
+				elif command == 'k':
+					pass
+
+				elif command == 'S':
+					if operand < 0 or operand > 40:
+						self.error = 3
+					else:
+						self.speed = operand
+
+				elif command == 'I':
+					if not self.initialized:
+						self.error = 7
+					elif operand < 0 or operand > 9:
+						self.error = 3
+					else:
+						duration = duration + self.valve_time
+						self.valve = operand
+
+				elif command == 'A':
+					if not self.initialized:
+						self.error = 7
+					elif operand < 0 or operand > self.full_stroke:
+						self.error = 3
+					else:
+						duration = duration + self.move_time(operand - self.position)
+						self.position = operand
+				else:
+					self.error = 2
+
+				if self.error:
+					break
+
+			self.busy_until = now + duration
+			ready = duration == 0
+
+		return self.reply(ready, self.error)
+
+	def reply(self, ready, error):
+		"Formats a pump reply frame for given ready state and error code."
+
+		status = 0x40 | error
+
+		if ready:
+			status = status | 0x20
+		return '/0' + chr(status) + chr(3) + '\r\n'
+
+#--------------------------------------------------------------------------------------#
+#			   Rheodyne rotary valve EMULATOR			       #
+#--------------------------------------------------------------------------------------#
+
+class Rheodyne_emulator:
+
+	ports = 10
+	port_time = 0.08	# seconds per port passed
+
+	def __init__(self, clock):
+		"Initialize rotary valve emulator at port 1."
+
+		self.clock = clock
+		self.position = 1
+		self.target = 1
+		self.arrival = 0.0
+
+	def handle(self, line):
+		"Executes 'Pxx' (move) or 'S' (position query) command and returns the reply."
+
+		now = self.clock.now()
+
+		if now >= self.arrival:
+			self.position = self.target
+
+		if line.startswith('P') and len(line) == 3:
+			target = int(line[1:], 16)
+
+			if target < 1 or target > self.ports:
+				return None
+
+			steps = abs(target - self.position)
+			steps = min(steps, self.ports - steps)
+			self.target = target
+			self.arrival = now + steps * self.port_time
+			return None
+
+		elif line == 'S':
+			return '%02X\r' % self.position	# previous port until the move is finished
+		return None
+
+#--------------------------------------------------------------------------------------#
+#			 PR-59 temperature controller EMULATOR			       #
+#--------------------------------------------------------------------------------------#
+
+class PR59_emulator:
+
+	ambient = 25.0
+	tau_on = 45.0		# regulated time constant (s)
+	tau_off = 300.0		# passive time constant (s)
+	dead_time = 4.0		# transport delay of heat-spreader (s)
+
+	def __init__(self, clock, temperature=None):
+		"Initialize temperature controller emulator with RUN flag cleared."
+
+		self.clock = clock
+		self.registers = {0 : self.ambient}
+		self.run = False
+		self.temperature = temperature or self.ambient
+		self.updated = clock.now()
+		self.changes = [(0.0, None)]	# (effective time, target) - None when output is blocked
+
+	def target(self):
+		"Returns current regulation target, or None when RUN flag is cleared."
+
+		if self.run:
+			return self.registers[0]
+		return None
+
+	def change(self):
+		"Records a change of regulation target, effective after the dead time."
+		self.changes.append((self.clock.now() + self.dead_time, self.target()))
+
+	def update(self):
+		"Integrates heat-spreader temperature up to current emulated time."
+
+		now = self.clock.now()
+		t = self.updated
+
+		while t < now:
+			target = self.changes[0][1]
+			end = now
+
+			if len(self.changes) > 1:
+				if self.changes[1][0] <= t:
+					self.changes.pop(0)
+					continue
+				end = min(now, self.changes[1][0])
+
+			if target is None:
+				goal, tau = self.ambient, self.tau_off
+			else:
+				goal, tau = target, self.tau_on
+
+			self.temperature = goal + (self.temperature - goal) * math.exp(-(end - t) / tau)
+			t = end
+
+		self.updated = now
+
+	def handle(self, line):
+		"Executes a '$...' command and returns the echo (and value for queries)."
+
+		if not line.startswith('$'):
+			return None
+
+		self.update()
+		reply = line + '\r\n'
+
+		if line == '$W':
+			self.run = True
+			self.change()
+
+		elif line == '$Q':
+			self.run = False
+			self.change()
+
+		elif line.startswith('$R') and line.endswith('?'):
+			register = int(line[2:-1])
+
+			if register == 100:
+				value = self.temperature
+			else:
+				value = self.registers.get(register, 0.0)
+			reply = reply + '%+e\r\n' % value
+
+		elif line.startswith('$R') and line.find('=') > 0:
+			register, value = line[2:].split('=', 1)
+			self.registers[int(register)] = float(value)
+
+			if int(register) == 0:
+				self.change()
+		return reply
+
+#--------------------------------------------------------------------------------------#
+#				PSEUDO-TERMINAL BUS				       #
+#--------------------------------------------------------------------------------------#
+
+class Pty_bus:
+
+	def __init__(self, config, time_scale=1.0, link=None):
+		"""Initialize pseudo-terminal serial line with one emulator per fluidics device
+		behind the mux."""
+
+		self.clock = Clock(time_scale)
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.name = os.ttyname(self.slave)
+
+		if link is not None:
+			if os.path.islink(link):
+				os.remove(link)
+			os.symlink(self.name, link)
+
+		self.devices = {'syringe_pump' : Cavro_emulator(self.clock),
+				'rotary_valve1' : Rheodyne_emulator(self.clock),
+				'rotary_valve2' : Rheodyne_emulator(self.clock),
+				'rotary_valve3' : Rheodyne_emulator(self.clock),
+				'rotary_valve4' : Rheodyne_emulator(self.clock),
+				'temperature_control1' : PR59_emulator(self.clock),
+				'temperature_control2' : PR59_emulator(self.clock),
+				'reagent_block_cooler' : PR59_emulator(self.clock)}
+
+		baud = {'syringe_pump' : int(config.get("communication","syringe_pump_baud")),
+			'rotary_valve' : int(config.get("communication","rotary_valve_baud")),
+			'temperature_control' : int(config.get("communication","temperature_control_baud")),
+			'reagent_block_cooler' : int(config.get("communication","temperature_control_baud"))}
+
+		self.bauds = {}
+		for device in self.devices.keys():
+			self.bauds[device] = baud[device.rstrip('1234')]
+
+		self.defaults = {baud['syringe_pump'] : 'syringe_pump',	# device answering when no mux is attached
+				 baud['rotary_valve'] : 'rotary_valve1',
+				 baud['temperature_control'] : 'temperature_control1'}
+
+		self.speeds = {}
+		for rate in self.defaults.keys():
+			self.speeds[getattr(termios, 'B%i' % rate)] = rate
+
+		self.channel = None
+		self.lock = threading.Lock()
+
+	def select(self, channel):
+		"Selects device answering on the line, as done by the mux on the instrument."
+
+		self.lock.acquire()
+		self.channel = channel
+		self.lock.release()
+
+	def device(self):
+		"Returns the emulator listening at the current line speed, or None."
+
+		baud = self.speeds.get(termios.tcgetattr(self.slave)[4])
+
+		if self.channel is None:
+			return self.devices.get(self.defaults.get(baud))
+
+		if self.bauds[self.channel] == baud:
+			return self.devices[self.channel]
+		return None	# baud rate mismatch - device sees garbage
+
+	def serve_forever(self):
+		"Reads CR terminated commands from the line and writes device replies back."
+
+		buffer = ''
+
+		while True:
+			select.select([self.master], [], [])
+			buffer = buffer + os.read(self.master, 1024)
+
+			while buffer.find('\r') >= 0:
+				line, buffer = buffer.split('\r', 1)
+				line = line.strip('\n')
+
+				self.lock.acquire()
+				device = self.device()
+
+				if device is not None:
+					reply = device.handle(line)
+				else:
+					reply = None
+				self.lock.release()
+
+				if reply:
+					os.write(self.master, reply)
+
+	def start(self):
+		"Serves the line from a daemon thread."
+
+		thread = threading.Thread(target=self.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+		return thread
+
+#--------------------------------------------------------------------------------------#
+#					MAIN					       #
+#--------------------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 2:
+		print '\n--> Error: not correct input!\n--> Usage: python device_emulator.py config.txt [time-scale] [link-path]\n'
+		sys.exit()
+
+	config = ConfigParser.ConfigParser()
+	config.read(sys.argv[1])
+
+	time_scale = 1.0
+	link = None
+
+	if len(sys.argv) > 2:
+		time_scale = float(sys.argv[2])
+	if len(sys.argv) > 3:
+		link = sys.argv[3]
+
+	bus = Pty_bus(config, time_scale, link)
+	print 'INFO\t ***\t*\t--> Device emulator listening on %s (time scale %0.1f)' % (bus.name, time_scale)
+
+	try:
+		bus.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -51,7 +51,7 @@ print '\n'
 logger.info('***\t*\t--> Device testing started - test.py')	# Test start.
 
 serial_port = Serial_port(config, logger)			# Initialize serial port object.
-mux = Mux(logger)						# Initialize mux object.
+mux = Mux(logger, serial_port, config)			# Initialize mux object.
 
 syringe_pump = Syringe_pump(config, serial_port, logger)		# Initialize syringe pump object.
 rotary_valve = Rotary_valve(config, serial_port, logger)		# Initialize rotary valve object.
@@ -0,0 +1,240 @@
+#!/usr/local/bin/python
+
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: emulates the Maestro motion controller on a local TCP port, so the
+ mux, touch sensor, stage homing and status LED paths can be run, benchmarked
+ and profiled without the instrument. Emulated registers:
+
+		 1. m_dout[0..7]	mux word, strobe and bank select lines
+		 2. m_din[0..7]		digital inputs, m_din[7] is the touch sensor
+		 3. x.hmstat, y.hmstat	stage homing status (0 when homed)
+		 4. y.ob[n]		status LEDs
+
+ Any other '<name>' or '<name>[<n>]' register reads 0 until assigned. Like on
+ the controller, every command is terminated by CR and answered by its reply
+ (if any) followed by the '>' prompt; unknown syntax is answered by '?'. The
+ touch sensor can be set by any client, e.g. 'm_din[7]=1'.
+
+ The serial devices of device_emulator.py are served on a pseudo-terminal
+ along with the controller; latching a channel word into the mux channel bank
+ selects the device answering on that line, as on the instrument.
+
+ Usage: python maestro_emulator.py config.txt [latency-ms] [time-scale] [link-path]
+
+ Set 'maestro_address' in config.txt to 127.0.0.1 (and 'maestro_port' to an
+ unprivileged port, e.g. 2323), and 'serial_port' to the printed pseudo-
+ terminal or link path. Latency is added to every reply.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import re
+import sys
+import time
+import socket
+import threading
+import ConfigParser
+
+from device_emulator import Clock, Pty_bus
+
+#--------------------------------------------------------------------------------------#
+#				MAESTRO EMULATOR				       #
+#--------------------------------------------------------------------------------------#
+
+class Maestro_emulator:
+
+	command = re.compile(r'^\s*([A-Za-z_][\w.]*)(?:\[(\d+)\])?\s*(?:=\s*([-+]?\d+)\s*)?$')
+
+	def __init__(self, config, bus=None, latency=0.0, clock=None, homing_time=0.0):
+		"""Initialize controller emulator object. If bus (Pty_bus) is given, latching a
+		word into the mux channel bank selects the serial device on the bus. The stages
+		report homing for 'homing_time' seconds of emulated time."""
+
+		self.bus = bus
+		self.latency = latency
+		self.clock = clock or Clock()
+		self.homed = self.clock.now() + homing_time
+
+		self.registers = {}	# (name, index) -> value, index None for scalar registers
+		self.lock = threading.Lock()
+
+		self.channels = {}	# (bank, word) -> device
+		self.discretes = {}	# (bank, bit) -> output
+
+		for name, value in config.items("mux_channels"):
+			bits = [int(bit) for bit in value.split(',', 1)[0].split()]
+			self.channels[(tuple(bits[0:2]), tuple(bits[2:7]))] = name
+
+		for name, value in config.items("mux_discrete"):
+			bits = [int(bit) for bit in value.split(',', 1)[0].split()]
+			self.discretes[(tuple(bits[0:2]), bits[2])] = name
+
+		self.banks = {}		# bank -> latched word
+		self.channel = None	# device selected by the channel bank
+
+		self.commands = 0	# statistics
+		self.dout_writes = 0
+		self.switches = 0
+
+	def read(self, name, index):
+		"Returns value of given register."
+
+		if name in ('x.hmstat', 'y.hmstat') and index is None:
+			return int(self.clock.now() < self.homed)
+		return self.registers.get((name, index), 0)
+
+	def write(self, name, index, value):
+		"Sets given register; m_dout writes drive the mux latches."
+
+		self.registers[(name, index)] = value
+
+		if name == 'm_dout':
+			self.dout_writes += 1
+			self.strobe()
+
+	def strobe(self):
+		"""The strobe m_dout[5] is active low: while low, the bank selected by m_dout[6,7]
+		follows the word on m_dout[0..4]."""
+
+		if self.read('m_dout', 5) != 0:
+			return
+
+		bank = (self.read('m_dout', 6), self.read('m_dout', 7))
+		word = tuple([self.read('m_dout', bit) for bit in range(5)])
+		self.banks[bank] = word
+
+		if self.channels.has_key((bank, word)) and self.channels[(bank, word)] != self.channel:
+			self.channel = self.channels[(bank, word)]
+			self.switches += 1
+
+			if self.bus is not None:
+				self.bus.select(self.channel)
+
+	def handle(self, line):
+		"Returns reply to one command line, including the prompt."
+
+		line = line.strip('\n').strip()
+
+		if line == '':
+			return '>'
+
+		m = self.command.match(line)
+
+		if m is None:
+			return '?\r\n>'
+
+		name, index, value = m.groups()
+
+		if index is not None:
+			index = int(index)
+
+		self.lock.acquire()
+
+		try:
+			self.commands += 1
+
+			if value is None:
+				return '%i\r\n>' % self.read(name, index)
+
+			self.write(name, index, int(value))
+			return '>'
+		finally:
+			self.lock.release()
+
+	def serve(self, connection):
+		"Serves one client connection until it is closed."
+
+		connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		connection.sendall('Maestro emulator\r\n>')
+		buffer = ''
+
+		try:
+			while True:
+				data = connection.recv(4096)
+
+				if data == '':
+					break
+
+				buffer = buffer + data
+
+				while buffer.find('\r') >= 0:
+					line, buffer = buffer.split('\r', 1)
+					reply = self.handle(line)
+
+					if self.latency > 0:
+						time.sleep(self.latency)
+					connection.sendall(reply)
+		except socket.error:
+			pass
+
+		connection.close()
+
+	def serve_forever(self, address, port):
+		"Accepts client connections, each served from its own daemon thread."
+
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		listener.bind((address, port))
+		listener.listen(5)
+
+		while True:
+			connection, peer = listener.accept()
+			thread = threading.Thread(target=self.serve, args=(connection,))
+			thread.setDaemon(True)
+			thread.start()
+
+	def report(self):
+		"Returns statistics of the commands served."
+
+		outputs = []
+		for key in self.discretes.keys():
+			bank, bit = key
+			outputs.append('%s=%i' % (self.discretes[key], self.banks.get(bank, (0, 0, 0, 0, 0))[bit]))
+		outputs.sort()
+
+		return '%i commands, %i m_dout writes, %i channel switches, channel %s, %s' % (self.commands, self.dout_writes, self.switches,
+												  self.channel, ' '.join(outputs))
+
+#--------------------------------------------------------------------------------------#
+#					MAIN					       #
+#--------------------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 2:
+		print '\n--> Error: not correct input!\n--> Usage: python maestro_emulator.py config.txt [latency-ms] [time-scale] [link-path]\n'
+		sys.exit()
+
+	config = ConfigParser.ConfigParser()
+	config.read(sys.argv[1])
+
+	latency = 0.0
+	time_scale = 1.0
+	link = None
+
+	if len(sys.argv) > 2:
+		latency = float(sys.argv[2]) / 1000.0
+	if len(sys.argv) > 3:
+		time_scale = float(sys.argv[3])
+	if len(sys.argv) > 4:
+		link = sys.argv[4]
+
+	bus = Pty_bus(config, time_scale, link)
+	bus.start()
+	print 'INFO\t ***\t*\t--> Device emulator listening on %s (time scale %0.1f)' % (bus.name, time_scale)
+
+	address = config.get("communication","maestro_address")
+	port = int(config.get("communication","maestro_port"))
+	maestro = Maestro_emulator(config, bus, latency, bus.clock)
+	print 'INFO\t ***\t*\t--> Maestro emulator listening on %s:%i (latency %0.1f ms)' % (address, port, latency * 1000.0)
+
+	try:
+		maestro.serve_forever(address, port)
+	except KeyboardInterrupt:
+		print '\nINFO\t ***\t*\t--> Maestro emulator: %s' % maestro.report()
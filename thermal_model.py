@@ -0,0 +1,188 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Thermal_model,
+ containing a first-order-plus-dead-time (FOPDT) model of the flowcell
+ temperature response to a PR-59 setpoint step in Python:
+
+		 T(t) = S - (S - T0) * exp(-(t - L) / tau)	for t > L
+
+ where T0 is the temperature at the step, S the new setpoint, L the dead time
+ and tau the time constant. The controller holds its own sensor at the
+ setpoint, so the static gain is 1. Heating and cooling (Peltier) have
+ separate parameters, fitted from the samples taken while waiting for a poll
+ temperature.
+
+ Overshoot: to reach a target temperature faster, the setpoint is first set
+ beyond the target, and set back to the target once the temperature reaches
+ the poll temperature. During the dead time after switching back, the
+ temperature keeps moving toward the overshoot setpoint by
+
+		 (S - target) * (1 - exp(-L / tau))
+
+ so the poll temperature lies that far before the target, and the overshoot
+ setpoint is the farthest one (within the setpoint limits) for which this
+ remainder stays within the temperature tolerance.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import math
+import threading
+
+UP = 'up'
+DOWN = 'down'
+
+class Thermal_model:
+
+	def __init__(self, name, config):
+		"Initialize thermal model object of given controller, e.g. 'temperature_control1'."
+
+		self.name = name
+		self.min_setpoint = float(config.get("thermal_model","min_setpoint"))
+		self.max_setpoint = float(config.get("thermal_model","max_setpoint"))
+		self.weight = float(config.get("thermal_model","fit_weight"))	# weight of a new fit against the previous ones
+
+		self.params = {}	# direction -> (tau, dead time) in seconds
+		self.fits = {UP : 0, DOWN : 0}
+
+	def fitted(self, direction):
+		"Returns True once the model has parameters for given direction (UP or DOWN)."
+		return self.params.has_key(direction)
+
+	def predict_reach(self, t0, setpoint, temperature):
+		"""Returns predicted seconds from setting setpoint at temperature t0 until the flowcell
+		reaches temperature, None if the model has no parameters or it is never reached."""
+
+		direction = direction_of(t0, setpoint)
+
+		if not self.fitted(direction) or (temperature - t0) * (setpoint - temperature) < 0 or temperature == setpoint:
+			return None
+
+		tau, dead_time = self.params[direction]
+
+		if temperature == t0:
+			return 0.0
+		return dead_time + tau * math.log((setpoint - t0) / (setpoint - temperature))
+
+	def choose(self, t0, target, tolerance):
+		"""Returns (setpoint, poll temperature, predicted seconds to the poll temperature) of
+		the fastest overshoot ramp from t0 to target, None if the model has no parameters
+		for this direction."""
+
+		direction = direction_of(t0, target)
+
+		if not self.fitted(direction):
+			return None
+
+		tau, dead_time = self.params[direction]
+		carry = 1.0 - math.exp(-dead_time / tau)	# fraction of the remaining step covered during the dead time
+
+		if carry > 0:
+			overshoot = tolerance / carry
+		else:
+			overshoot = abs(self.max_setpoint - self.min_setpoint)
+
+		if direction == UP:
+			setpoint = min(target + overshoot, self.max_setpoint)
+		else:
+			setpoint = max(target - overshoot, self.min_setpoint)
+
+		setpoint = round(setpoint, 1)
+		poll = round(target - (setpoint - target) * carry, 1)
+		return (setpoint, poll, self.predict_reach(t0, setpoint, poll))
+
+	def fit(self, t0, setpoint, t_set, samples):
+		"""Fits dead time and time constant to (time, temperature) samples of a step from t0 to
+		setpoint made at time t_set, and blends them into the model. Returns (tau, dead time),
+		or None if the samples do not cover enough of the step."""
+
+		span = setpoint - t0
+
+		if abs(span) < 1.0:
+			return None
+
+		points = []	# (seconds since step, -ln(remaining fraction of step))
+
+		for t, temperature in samples:
+			fraction = (temperature - t0) / span
+
+			if t >= t_set and 0.05 < fraction < 0.95:
+				points.append((t - t_set, -math.log(1.0 - fraction)))
+
+		if len(points) < 3:
+			return None
+
+		# z = (t - L) / tau is linear in t: least squares slope 1/tau, intercept -L/tau
+
+		n = len(points)
+		t_mean = sum([t for t, z in points]) / n
+		z_mean = sum([z for t, z in points]) / n
+		variance = sum([(t - t_mean) ** 2 for t, z in points])
+
+		if variance == 0:
+			return None
+
+		slope = sum([(t - t_mean) * (z - z_mean) for t, z in points]) / variance
+
+		if slope <= 0:
+			return None
+
+		tau = 1.0 / slope
+		dead_time = max(0.0, t_mean - z_mean * tau)
+		direction = direction_of(t0, setpoint)
+
+		if self.fitted(direction):
+			old_tau, old_dead_time = self.params[direction]
+			tau = self.weight * tau + (1 - self.weight) * old_tau
+			dead_time = self.weight * dead_time + (1 - self.weight) * old_dead_time
+
+		self.params[direction] = (tau, dead_time)
+		self.fits[direction] += 1
+		return (tau, dead_time)
+
+	def describe(self):
+		"Returns the model parameters as a printable string."
+
+		parts = []
+
+		for direction in [UP, DOWN]:
+			if self.fitted(direction):
+				parts.append("%s: tau %0.1f s, dead time %0.1f s (%i fits)" % ((direction,) + self.params[direction] + (self.fits[direction],)))
+			else:
+				parts.append("%s: not fitted" % direction)
+		return "%s %s" % (self.name, ', '.join(parts))
+
+def direction_of(t0, setpoint):
+	"Returns UP if setpoint is above t0, else DOWN."
+
+	if setpoint > t0:
+		return UP
+	return DOWN
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE MODELS				       #
+#--------------------------------------------------------------------------------------#
+#
+# A Biochem object lives for one cycle, so models are kept per controller for the whole
+# process and improve with every ramp.
+#
+
+models = {}
+models_lock = threading.Lock()
+
+def get_model(name, config):
+	"Returns the process-wide thermal model of given controller, creating it on first use."
+
+	models_lock.acquire()
+
+	try:
+		if not models.has_key(name):
+			models[name] = Thermal_model(name, config)
+		return models[name]
+	finally:
+		models_lock.release()
@@ -0,0 +1,317 @@
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Thermal_service,
+ containing the process-wide thermal scheduler of both flowcell controllers
+ and the reagent block cooler in Python.
+
+ One task on the process-wide event loop (event_loop.py) takes all temperature
+ reads, on one schedule: every device is due 'interval' seconds ([telemetry]
+ section) after its last sample, or sooner while a flowcell waits for it to
+ reach a target - then the interval follows the distance to the target and the
+ ramp rate as in poller.py. Reads are Async_serial transactions and the mux is
+ latched over the asynchronous Maestro client, so the loop waits for replies in
+ select() along with its other tasks. Biochem threads
+ subscribe to 'reached target' events (subscribe(), wait_until()) and take
+ readings with read(), so they no longer switch the mux to their controller
+ for every reading. Setpoints are still written by the Biochem threads.
+
+ The service keeps its samples in Telemetry (temperature_sampler.py), the ring
+ and telemetry file; it is the only telemetry path of the process.
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import time
+import threading
+
+from poller import Poller
+from serial_port import Async_serial, Serial_timeout
+from event_loop import Sleep, start_loop
+from async_maestro import get_async_maestro
+from temperature_sampler import Telemetry
+
+class Watch:
+
+	def __init__(self, device, target, tolerance, poller):
+		"Initialize subscription to given device reaching target within tolerance."
+
+		self.device = device
+		self.target = target
+		self.tolerance = tolerance
+		self.poller = poller		# ramp rate and poll interval of the wait
+		self.side = None		# side of the target of the first sample
+		self.value = None		# newest temperature
+		self.reached = threading.Event()
+
+	def update(self, t, temperature):
+		"""Records a sample; sets the reached event once temperature is within tolerance of
+		the target, or has passed it coming from the side of the first sample."""
+
+		self.poller.samples.append((t, temperature))
+		self.value = temperature
+
+		if self.side is None:
+			self.side = cmp(self.target, temperature)
+
+		if abs(self.target - temperature) <= self.tolerance or cmp(self.target, temperature) != self.side:
+			self.reached.set()
+
+class Thermal_service(Telemetry):
+
+	def __init__(self, loop, config, logger=None):
+		"Initialize thermal service object on the [telemetry] devices and given event loop; start() runs it."
+
+		Telemetry.__init__(self, config, logger)
+
+		self.loop = loop
+		self.bus = Async_serial(loop, self.ser, self.mux, get_async_maestro(loop, config, logger))	# mux latched without blocking the loop
+		self.config = config
+		self.watches = []
+		self.due = dict([(device, 0.0) for device in self.devices])	# device -> time of next sample
+		self.failures = {}				# device -> (time, exception) of last failed read
+		self.sampled = threading.Condition()		# notified after every read
+		self.finished = threading.Event()		# set when the service task ends
+		self.task = None
+		self.sleeping = False				# service task waits for the next due time
+		self.reads = 0
+
+	def schedule(self, device, t):
+		"Makes device due for sampling at time t (if earlier) and wakes the service task."
+
+		self.lock.acquire()
+		self.due[device] = min(self.due[device], t)
+		self.lock.release()
+		self.loop.post(self.wake)
+
+	def wake(self):
+		"Resumes the service task if it waits for the next due time; runs in the loop thread."
+
+		if self.sleeping:
+			self.sleeping = False
+			self.loop.wake(self.task)
+
+	def subscribe(self, device, target, tolerance):
+		"""Returns a Watch on device, e.g. 'temperature_control1', whose reached event is set
+		once its temperature is within tolerance of target or has passed it."""
+
+		watch = Watch(device, target, tolerance, Poller(None, self.config))
+
+		self.lock.acquire()
+		self.watches.append(watch)
+		self.lock.release()
+
+		self.schedule(device, 0.0)	# first sample sets the side of the target
+		return watch
+
+	def unsubscribe(self, watch):
+		"Ends given subscription."
+
+		self.lock.acquire()
+
+		if watch in self.watches:
+			self.watches.remove(watch)
+		self.lock.release()
+
+	def read(self, device):
+		"""Returns temperature of device, the newest sample if it is fresh, else sampled by the
+		service task right away; raises the exception if that read fails, Serial_timeout if
+		the service is not running or no read ends within the time of one transaction with
+		all its retries (plus one interval for the read in progress)."""
+
+		sample = self.latest(device)
+		t = time.time()
+
+		if sample is not None and t - sample[0] <= self.interval:
+			return sample[1]
+
+		policy = self.ser.retry_policy
+		t_end = t + self.interval + policy.attempts * (self.ser._read_deadline + policy.interval)
+
+		self.schedule(device, 0.0)
+		self.sampled.acquire()
+
+		try:
+			while True:
+				sample = self.latest(device)
+
+				if sample is not None and sample[0] >= t:
+					return sample[1]
+
+				failure = self.failures.get(device)
+
+				if failure is not None and failure[0] >= t:
+					raise failure[1]
+
+				if self.stopped.isSet() or self.finished.isSet():
+					raise Serial_timeout("thermal service is not running - no reading of %s" % device)
+
+				remaining = t_end - time.time()
+
+				if remaining <= 0:
+					raise Serial_timeout("no reading of %s from the thermal service within %0.2f s" % (device, t_end - t))
+
+				self.sampled.wait(min(self.interval, remaining))
+		finally:
+			self.sampled.release()
+
+	def wait_until(self, device, target, tolerance, timeout, progress=None):
+		"""Waits until the temperature of device is within tolerance of target (or has passed
+		it), or timeout seconds passed; progress(elapsed seconds, temperature) is called
+		about every second. Returns (last temperature, True if target was reached)."""
+
+		watch = self.subscribe(device, target, tolerance)
+		t0 = time.time()
+
+		try:
+			while not watch.reached.isSet():
+				elapsed = time.time() - t0
+
+				if elapsed > timeout:
+					return (self.read(device), False)
+
+				watch.reached.wait(min(1.0, timeout - elapsed))
+
+				if progress is not None and watch.value is not None:
+					progress(time.time() - t0, watch.value)
+
+			return (watch.value, True)
+		finally:
+			self.unsubscribe(watch)
+
+	def next_interval(self, device, t, temperature):
+		"""Updates the watches of device with a sample; returns seconds to its next sample: the
+		shortest poll interval of its watches, or interval if it has none."""
+
+		interval = self.interval
+
+		self.lock.acquire()
+
+		try:
+			for watch in self.watches:
+				if watch.device == device and not watch.reached.isSet():
+					watch.update(t, temperature)
+
+					if not watch.reached.isSet():
+						interval = min(interval, watch.poller.next_interval(watch.target, watch.tolerance))
+		finally:
+			self.lock.release()
+
+		return interval
+
+	def sample_device(self, device):
+		"Coroutine: reads one device and schedules its next sample."
+
+		try:
+			temperature = yield self.temperature_control.get_temperature_co(self.bus, device)
+		except Exception, e:
+			self.errors += 1
+			self.failures[device] = (time.time(), e)
+			interval = self.interval
+
+			if hasattr(self, 'logging'):
+				self.logging.warn("---\t-\t--> Thermal service: reading %s failed: %s" % (device, e))
+		else:
+			t = time.time()
+			self.reads += 1
+			self.record(device, t, temperature)
+			interval = self.next_interval(device, t, temperature)
+
+		self.lock.acquire()
+		self.due[device] = time.time() + interval
+		self.lock.release()
+
+		self.sampled.acquire()
+		self.sampled.notifyAll()
+		self.sampled.release()
+
+	def run(self):
+		"Coroutine: samples each device when due and flushes every flush_interval until stop() is called."
+
+		next_flush = time.time() + self.flush_interval
+
+		try:
+			while not self.stopped.isSet():
+				self.lock.acquire()
+				t, device = min([(self.due[device], device) for device in self.devices])
+				self.lock.release()
+
+				now = time.time()
+
+				if t > now:
+					self.sleeping = True		# until then, or woken by schedule()
+					yield Sleep(min(t, next_flush) - now)
+					self.sleeping = False
+				else:
+					yield self.sample_device(device)
+
+				if now >= next_flush:
+					self.flush_file()
+					next_flush = now + self.flush_interval
+
+			self.flush_file()
+		finally:
+			self.finished.set()
+
+			self.sampled.acquire()		# readers waiting for a sample give up now
+			self.sampled.notifyAll()
+			self.sampled.release()
+
+	def flush_file(self):
+		"Flushes the ring to the telemetry file; a failure is logged, the samples stay in the ring."
+
+		try:
+			self.flush()
+		except Exception, e:
+			self.errors += 1
+
+			if hasattr(self, 'logging'):
+				self.logging.warn("---\t-\t--> Thermal service: flushing telemetry failed: %s" % e)
+
+	def spawn(self):
+		"Spawns the service task; runs in the loop thread."
+		self.task = self.loop.spawn(self.run(), 'thermal service')
+
+	def start(self):
+		"Starts the service task on the event loop."
+		self.loop.post(self.spawn)
+
+	def stop(self):
+		"Stops the service task and flushes the file."
+
+		self.stopped.set()
+		self.loop.post(self.wake)
+		self.finished.wait()
+
+		if self.map is not None:
+			self.map.flush()
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE SERVICE				       #
+#--------------------------------------------------------------------------------------#
+#
+# Started by polonator_main on the process-wide event loop; Biochem threads and ramp/soak
+# programs take their temperature readings and telemetry samples from it.
+#
+
+current = None
+current_lock = threading.Lock()
+
+def start_service(config, logger=None):
+	"Starts the process-wide thermal service (unless running) and returns it."
+
+	global current
+
+	current_lock.acquire()
+
+	try:
+		if current is None:
+			current = Thermal_service(start_loop(logger), config, logger)
+			current.start()
+		return current
+	finally:
+		current_lock.release()
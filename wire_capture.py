@@ -0,0 +1,309 @@
+#!/usr/local/bin/python
+
+"""
+--------------------------------------------------------------------------------
+ For: G.007 polony sequencer design [fluidics software] at the Church Lab -
+ Genetics Department, Harvard Medical School.
+
+ Purpose: This program contains the complete code for class Wire_capture,
+ containing a binary ring-file recorder of all serial and telnet traffic in
+ Python, and its decoder.
+
+ The capture file is memory-mapped; each write or read on a device channel is
+ appended as one record (monotonic timestamp, channel, direction, payload).
+ When the file is full, the oldest records are overwritten.
+
+ Usage: python wire_capture.py capture-file [--timing] [--raw]
+
+		 (no option)	print every record
+		 --timing	per channel and command timing table (write to last reply)
+		 --raw		with --timing, do not merge numeric operands of commands
+
+ This software may be used, modified, and distributed freely, but this
+ header may not be modified and must appear at the top of this file.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import re
+import sys
+import mmap
+import time
+import struct
+import threading
+
+#--------------------------------------------------------------------------------------#
+#				MONOTONIC CLOCK					       #
+#--------------------------------------------------------------------------------------#
+
+try:
+	import ctypes
+	import ctypes.util
+
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+	clock_gettime = librt.clock_gettime
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	CLOCK_MONOTONIC = 1
+	ts = timespec()
+
+	def monotonic():
+		"Returns seconds of the monotonic clock (not affected by system time changes)."
+
+		clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+		return ts.tv_sec + ts.tv_nsec * 1e-9
+
+	monotonic()
+
+except (ImportError, OSError, AttributeError):
+	monotonic = time.time
+
+#--------------------------------------------------------------------------------------#
+#				CAPTURE FILE FORMAT				       #
+#--------------------------------------------------------------------------------------#
+#
+# Header: magic, data size, head (next write offset), tail (oldest record), wrap offset,
+# wrapped flag, wall clock and monotonic clock at creation, then a table of channel names
+# ('\0' separated). Data: records of struct RECORD followed by the payload. Until the
+# ring wraps, records fill [0, head); afterwards the oldest lie in [tail, wrap) and the
+# newest in [0, head).
+#
+
+MAGIC = 'G007WCAP'
+HEADER = struct.Struct('<8sIIIIIdd')
+NAMES = 512				# bytes reserved for channel names
+DATA = HEADER.size + NAMES
+RECORD = struct.Struct('<dBBH')		# timestamp, channel, direction, payload length
+
+WRITE = 0
+READ = 1
+
+class Wire_capture:
+
+	def __init__(self, path, size=4194304):
+		"Initialize capture object recording into a new ring file of given data size (bytes)."
+
+		self.path = path
+		self.size = size
+		self.lock = threading.Lock()	# Biochem threads of both flowcells record concurrently
+		self.channels = {}
+		self.names = ''
+
+		f = open(path, 'w+b')
+		f.truncate(DATA + size)
+		self.map = mmap.mmap(f.fileno(), DATA + size)
+		f.close()
+
+		self.head = 0
+		self.tail = 0
+		self.wrap = 0
+		self.wrapped = False
+		self.wall = time.time()
+		self.epoch = monotonic()
+		self.store_header()
+
+	def store_header(self):
+		"Writes ring pointers to the file header."
+		self.map[0:HEADER.size] = HEADER.pack(MAGIC, self.size, self.head, self.tail, self.wrap, self.wrapped, self.wall, self.epoch)
+
+	def channel(self, name):
+		"Returns the id of given channel name, e.g. 'syringe_pump' or 'telnet', adding it to the name table."
+
+		if not self.channels.has_key(name):
+			if len(self.channels) == 255 or len(self.names) + len(name) + 1 > NAMES:
+				return 255		# name table full - recorded as unknown channel
+
+			self.channels[name] = len(self.channels)
+			self.names = self.names + name + '\0'
+			self.map[HEADER.size:HEADER.size + len(self.names)] = self.names
+		return self.channels[name]
+
+	def record(self, name, direction, data):
+		"Appends one write (direction WRITE) or read (READ) of data on given channel."
+
+		t = monotonic()
+		data = data[:min(65535, self.size / 4)]
+		n = RECORD.size + len(data)
+
+		self.lock.acquire()
+
+		try:
+			channel = self.channel(name)
+
+			while True:
+				if not self.wrapped and self.head + n > self.size:	# no room up to end of file - wrap
+					self.wrap = self.head
+					self.head = 0
+					self.tail = 0
+					self.wrapped = True
+
+				elif self.wrapped and self.tail < self.head + n:	# drop oldest record being overwritten
+					self.tail = self.tail + RECORD.size + RECORD.unpack_from(self.map, DATA + self.tail)[3]
+
+					if self.tail >= self.wrap:
+						self.wrapped = False
+						self.tail = 0
+				else:
+					break
+
+			offset = DATA + self.head
+			self.map[offset:offset + RECORD.size] = RECORD.pack(t, channel, direction, len(data))
+			self.map[offset + RECORD.size:offset + n] = data
+			self.head = self.head + n
+			self.store_header()
+		finally:
+			self.lock.release()
+
+	def close(self):
+		"Flushes and unmaps the capture file."
+
+		self.lock.acquire()
+
+		try:
+			self.map.flush()
+			self.map.close()
+		finally:
+			self.lock.release()
+
+#--------------------------------------------------------------------------------------#
+#				PROCESS-WIDE CAPTURE				       #
+#--------------------------------------------------------------------------------------#
+#
+# Capture is optional: the first Serial_port finding 'capture_file' in the [communication]
+# section of the configuration file opens it; Tel_net sessions record into it once open.
+#
+
+current = None
+current_lock = threading.Lock()
+
+def open_capture(config):
+	"Returns the process-wide capture configured in config, or None if capture is off."
+
+	global current
+
+	if not config.has_option("communication", "capture_file"):
+		return None
+
+	path = config.get("communication", "capture_file").strip()
+
+	if path == '':
+		return None
+
+	current_lock.acquire()
+
+	try:
+		if current is None:
+			size = 4096 * 1024
+
+			if config.has_option("communication", "capture_size"):
+				size = int(config.get("communication", "capture_size")) * 1024
+			current = Wire_capture(path, size)
+		return current
+	finally:
+		current_lock.release()
+
+#--------------------------------------------------------------------------------------#
+#					DECODER					       #
+#--------------------------------------------------------------------------------------#
+
+def read_capture(path):
+	"Returns (channel names, wall clock at creation, records) of a capture file, oldest record first."
+
+	f = open(path, 'rb')
+	contents = f.read()
+	f.close()
+
+	magic, size, head, tail, wrap, wrapped, wall, epoch = HEADER.unpack_from(contents, 0)
+
+	if magic != MAGIC:
+		raise ValueError("%s is not a wire capture file" % path)
+
+	names = contents[HEADER.size:DATA].split('\0')
+	segments = [(0, head)]
+
+	if wrapped:
+		segments.insert(0, (tail, wrap))
+
+	records = []
+
+	for start, end in segments:
+		offset = start
+
+		while offset < end:
+			t, channel, direction, length = RECORD.unpack_from(contents, DATA + offset)
+			payload = contents[DATA + offset + RECORD.size:DATA + offset + RECORD.size + length]
+			records.append((t - epoch, channel, direction, payload))
+			offset = offset + RECORD.size + length
+
+	return (names, wall, records)
+
+def channel_name(names, channel):
+	"Returns the name of given channel id."
+
+	if channel < len(names) and names[channel] != '':
+		return names[channel]
+	return 'channel %i' % channel
+
+def print_records(names, wall, records):
+	"Prints one line per record: time, channel, direction and payload."
+
+	print 'INFO\t ***\t*\t--> Capture started %s, %i records' % (time.ctime(wall), len(records))
+
+	for t, channel, direction, payload in records:
+		print '%12.6f  %-22s %s %r' % (t, channel_name(names, channel), ['>>', '<<'][direction], payload)
+
+def print_timing(names, records, raw=False):
+	"""Prints per channel and command timing statistics: time from writing a command to
+	the last read on the same channel before the next write."""
+
+	pending = {}	# channel -> (command, write time, last read time)
+	timings = {}	# (channel, command) -> list of seconds
+
+	def close(channel):
+		if pending.has_key(channel):
+			command, t_write, t_read = pending.pop(channel)
+
+			if t_read is not None:
+				timings.setdefault((channel_name(names, channel), command), []).append(t_read - t_write)
+
+	for t, channel, direction, payload in records:
+		if direction == WRITE:
+			close(channel)
+			command = payload.strip()
+
+			if not raw:
+				command = re.sub(r'\d+(\.\d*)?', 'n', command)
+			pending[channel] = (command, t, None)
+
+		elif pending.has_key(channel):
+			pending[channel] = (pending[channel][0], pending[channel][1], t)
+
+	for channel in pending.keys():
+		close(channel)
+
+	keys = timings.keys()
+	keys.sort()
+
+	print '%-22s %-16s %6s %10s %9s %9s %9s %9s' % ('channel', 'command', 'n', 'total s', 'mean ms', 'min ms', 'p90 ms', 'max ms')
+
+	for key in keys:
+		samples = timings[key]
+		samples.sort()
+		print '%-22s %-16s %6i %10.3f %9.2f %9.2f %9.2f %9.2f' % (key[0], key[1], len(samples), sum(samples),
+									  1e3 * sum(samples) / len(samples), 1e3 * samples[0],
+									  1e3 * samples[int(0.9 * (len(samples) - 1))], 1e3 * samples[-1])
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 2:
+		print '\n--> Error: not correct input!\n--> Usage: python wire_capture.py capture-file [--timing] [--raw]\n'
+		sys.exit()
+
+	names, wall, records = read_capture(sys.argv[1])
+
+	if '--timing' in sys.argv[2:]:
+		print_timing(names, records, '--raw' in sys.argv[2:])
+	else:
+		print_records(names, wall, records)